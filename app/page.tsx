@@ -42,7 +42,7 @@ export default function Home() {
     emitOverlayResized,
   } = useWebSocketOverlay({
     onOverlayCreated: (overlay) => setOverlays((prev) => [...prev, overlay]),
-    onOverlayUpdated: (id, overlay) => setOverlays((prev) => prev.map((o) => (o._id === id ? overlay : o))),
+    onOverlayUpdated: (id, overlay) => setOverlays((prev) => prev.map((o) => (o._id === id ? { ...o, ...overlay } : o))),
     onOverlayDeleted: (id) => setOverlays((prev) => prev.filter((o) => o._id !== id)),
     onOverlayMoved: (id, position) => setOverlays((prev) => prev.map((o) => (o._id === id ? { ...o, position } : o))),
     onOverlayResized: (id, size) => setOverlays((prev) => prev.map((o) => (o._id === id ? { ...o, size } : o))),
@@ -1,14 +1,80 @@
+from config import Config
+# ASYNC_MODE=gevent doesn't monkey-patch the standard library: the gevent server and
+# Socket.IO driver use gevent natively, and blocking calls (MongoDB, FFmpeg, locks,
+# brokers) go through blocking_pool, whose OS threads share sockets gevent couldn't
 from flask import Flask
 from flask_cors import CORS
-from routes import api
+from routes import api, overlay_model, overlay_writer
 from stream_routes import stream_api
 from socketio_manager import socketio
-from config import Config
+from overlay_coalescer import overlay_coalescer
+from overlay_images import overlay_images
+from blocking_pool import blocking_pool
 import logging
 import os
 from stream_manager import stream_manager
+from werkzeug.security import safe_join
+from capabilities import capability_probe
+from message_queue import socketio_options
+import hls_playlist
+import hls_cache
+import metrics
 import atexit
 
+# Recently served HLS segments, shared by all viewers
+segment_cache = hls_cache.SegmentCache(int(Config.HLS_SEGMENT_CACHE_MB * 1024 * 1024))
+
+# Per-stream FFmpeg gauges: (metric, help, value from the stream info)
+STREAM_GAUGES = (
+    ('ffmpeg_stream_up', 'Whether the stream is running', lambda info: info['status'] == 'running'),
+    ('ffmpeg_stream_restarts', 'FFmpeg restarts of the stream', lambda info: info['restarts']),
+    ('ffmpeg_stream_startup_seconds', 'Time from start request to first playable playlist', lambda info: info['startup_time_s']),
+    ('ffmpeg_stream_cpu_percent', 'FFmpeg CPU use in percent of one core', lambda info: (info['resources'] or {}).get('cpu_percent')),
+    ('ffmpeg_stream_rss_megabytes', 'FFmpeg resident memory', lambda info: (info['resources'] or {}).get('rss_mb')),
+    ('ffmpeg_stream_fps', 'Frames encoded per second', lambda info: (info['telemetry'] or {}).get('fps')),
+    ('ffmpeg_stream_bitrate_kbps', 'Output bitrate', lambda info: (info['telemetry'] or {}).get('bitrate_kbps')),
+    ('ffmpeg_stream_speed', 'Encoding speed relative to real time', lambda info: (info['telemetry'] or {}).get('speed')),
+    ('ffmpeg_stream_dropped_frames', 'Frames dropped by FFmpeg', lambda info: (info['telemetry'] or {}).get('dropped_frames')),
+    ('ffmpeg_stream_duplicated_frames', 'Frames duplicated by FFmpeg', lambda info: (info['telemetry'] or {}).get('duplicated_frames')),
+)
+
+def collect_runtime_metrics():
+    """Gauges read at scrape time: capabilities, streams, scheduler, segment and image caches"""
+    capabilities = capability_probe.get_status()
+    lines = metrics.gauge_lines('ffmpeg_available', 'Whether ffmpeg -version succeeded at the last probe', [((), capabilities['ffmpeg'])])
+    lines += metrics.gauge_lines('database_connected', 'Whether MongoDB was connected at the last probe', [((), capabilities['database'])])
+    
+    streams = stream_manager.list_streams()
+    for name, documentation, value in STREAM_GAUGES:
+        lines += metrics.gauge_lines(
+            name, documentation, [((info['stream_id'],), value(info)) for info in streams], labels=('stream_id',)
+        )
+    
+    scheduler = stream_manager.get_scheduler_stats()
+    lines += metrics.gauge_lines('stream_scheduler_queue_depth', 'Streams waiting for resources', [((), scheduler['queue_depth'])])
+    lines += metrics.gauge_lines('stream_scheduler_cpu_committed_percent', 'CPU committed to admitted streams', [((), scheduler['cpu_committed_percent'])])
+    
+    cache = segment_cache.get_stats()
+    lines += metrics.gauge_lines(
+        'hls_segment_cache_lookups_total', 'Segment cache lookups',
+        [(('hit',), cache['hits']), (('miss',), cache['misses'])], labels=('result',), kind='counter'
+    )
+    lines += metrics.gauge_lines('hls_segment_cache_bytes', 'Bytes held by the segment cache', [((), cache['bytes'])])
+    
+    images = overlay_images.get_stats()
+    lines += metrics.gauge_lines(
+        'overlay_image_cache_lookups_total', 'Overlay image cache lookups',
+        [(('memory_hit',), images['hits']), (('disk_hit',), images['disk_hits']), (('miss',), images['misses'])],
+        labels=('result',), kind='counter'
+    )
+    lines += metrics.gauge_lines(
+        'overlay_image_cache_bytes', 'Bytes held by the overlay image cache',
+        [(('memory',), images['bytes']), (('disk',), images['disk_bytes'])], labels=('tier',)
+    )
+    return lines
+
+metrics.registry.add_collector(collect_runtime_metrics)
+
 def create_app():
     """Application factory pattern"""
     app = Flask(__name__)
@@ -22,23 +88,93 @@ def create_app():
     # Enable CORS for all routes
     CORS(app, origins=['http://localhost:3000'])
     
-    # Initialize SocketIO with app
-    socketio.init_app(app, cors_allowed_origins="*")
+    # Initialize SocketIO with app; with several workers, emits go through the message queue
+    socketio.init_app(
+        app, cors_allowed_origins="*", async_mode=Config.ASYNC_MODE,
+        **socketio_options(Config.SOCKETIO_MESSAGE_QUEUE)
+    )
+    if stream_manager.shared is not None and Config.OVERLAY_STORAGE == 'memory':
+        logging.warning("OVERLAY_STORAGE=memory is per process; workers will not see each other's overlays")
+    blocking_pool.start()
     
     # Register blueprints
     app.register_blueprint(api, url_prefix='/api')
     app.register_blueprint(stream_api, url_prefix='/api')
     
     # Serve HLS files
+    app.config['USE_X_SENDFILE'] = Config.USE_X_SENDFILE
+    hls_dir = os.path.abspath(stream_manager.hls_output_dir)
+    playlist_cache_control = f'public, max-age={Config.HLS_PLAYLIST_MAX_AGE}'
+    segment_cache_control = f'public, max-age={Config.HLS_SEGMENT_MAX_AGE}, immutable'
+    
     @app.route('/hls/<path:filename>')
     def serve_hls(filename):
-        """Serve HLS files"""
-        from flask import send_from_directory
-        hls_dir = os.path.join(os.getcwd(), 'hls')
-        response = send_from_directory(hls_dir, filename)
+        """
+        Serve HLS files: playlists briefly cacheable (with blocking reload via _HLS_msn),
+        segments immutable, everything with ETag/Last-Modified and range support
+        """
+        from flask import send_from_directory, request, Response
+        
+        if filename.endswith('.m3u8'):
+            latency_profile, is_master = stream_manager.resolve_playlist(filename)
+            low_latency = latency_profile == 'low'
+            msn = request.args.get('_HLS_msn')
+            
+            # ABR master playlists list renditions, not segments, so they never block
+            if not is_master and (msn is not None or low_latency):
+                path = safe_join(hls_dir, filename)
+                if path is None:
+                    return {'error': 'Not found'}, 404
+                if msn is not None:
+                    try:
+                        # socketio.sleep yields to other greenlets in gevent mode
+                        status, text = hls_playlist.wait_for_segment(path, int(msn), sleep=socketio.sleep)
+                    except ValueError:
+                        return {'error': '_HLS_msn must be an integer'}, 400
+                else:
+                    text = hls_playlist.read_playlist(path)
+                    status = 200 if text is not None else 404
+                if status != 200:
+                    return {'error': 'Playlist not available'}, status
+                
+                if low_latency:
+                    text = hls_playlist.add_server_control(text)
+                response = Response(text, mimetype='application/vnd.apple.mpegurl')
+                response.headers['Access-Control-Allow-Origin'] = '*'
+                response.headers['Cache-Control'] = playlist_cache_control
+                return response
+        
+        segment = hls_cache.is_segment(filename)
+        if segment and segment_cache.enabled:
+            path = safe_join(hls_dir, filename)
+            response = segment_cache.response(path, request) if path else None
+            if response is None:
+                return {'error': 'Not found'}, 404
+        else:
+            # send_file streams through wsgi.file_wrapper (sendfile) and handles Range/If-None-Match
+            response = send_from_directory(hls_dir, filename, mimetype=hls_cache.hls_mimetype(filename))
+        
         # Add CORS headers for HLS files
         response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        if segment:
+            response.headers['Cache-Control'] = segment_cache_control
+        elif filename.endswith('.m3u8'):
+            response.headers['Cache-Control'] = playlist_cache_control
+        else:
+            # Init segments keep their name across restarts, so revalidate them
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    # Serve DVR recordings; a recorded segment is never rewritten
+    recordings_dir = os.path.abspath(Config.DVR_DIR)
+    
+    @app.route('/recordings/<path:filename>')
+    def serve_recording(filename):
+        """Serve recorded segments referenced by the recording.m3u8 VOD playlists"""
+        from flask import send_from_directory
+        response = send_from_directory(recordings_dir, filename, mimetype=hls_cache.hls_mimetype(filename))
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Cache-Control'] = segment_cache_control
         return response
     
     # Serve demo video file
@@ -54,32 +190,55 @@ def create_app():
         return response
     
     # Health check endpoint
+    # FFmpeg/database checks run in the background; health checks only read the results
+    capability_probe.start()
+    
     @app.route('/health')
     def health_check():
-        from models import Database
-        db = Database()
-        db_status = "connected" if db.is_connected() else "disconnected (using in-memory storage)"
-        
-        # Check FFmpeg availability
-        import subprocess
-        try:
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-            ffmpeg_status = "installed"
-        except:
-            ffmpeg_status = "not installed"
+        capabilities = capability_probe.get_status()
+        db_status = "connected" if capabilities['database'] else "disconnected (using in-memory storage)"
+        ffmpeg_status = "installed" if capabilities['ffmpeg'] else "not installed"
         
         return {
             'status': 'healthy', 
             'message': 'RTSP Overlay API is running',
             'database': db_status,
+            'storage': overlay_model.backend,
             'ffmpeg': ffmpeg_status,
+            'ffmpeg_zmq': capabilities['ffmpeg_zmq'],
             'active_streams': len(stream_manager.list_streams()),
-            'websocket': 'enabled'
+            'websocket': 'enabled',
+            'overlay_events': overlay_coalescer.get_stats(),
+            'overlay_writes': overlay_writer.get_stats(),
+            'hls_segment_cache': segment_cache.get_stats(),
+            'overlay_images': overlay_images.get_stats(),
+            'server': blocking_pool.get_stats(),
+            'workers': stream_manager.get_worker_stats()
         }, 200
     
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """Prometheus scrape endpoint"""
+        from flask import Response
+        return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+    
+    # Take over FFmpeg processes left running by the previous backend process (or,
+    # with several workers, by workers that are gone) and start syncing with the others
+    if Config.STREAM_ADOPT or stream_manager.shared is not None:
+        stream_manager.adopt_streams()
+    
     # Cleanup streams on shutdown
     @atexit.register
     def cleanup():
+        logging.info("Shutting down - flushing overlay positions")
+        overlay_writer.stop()
+        if stream_manager.shared is not None:
+            logging.info("Shutting down - handing streams over to the other workers")
+            stream_manager.leave_shared()
+            return
+        if Config.STREAM_ADOPT:
+            logging.info("Shutting down - leaving streams running for the next backend process")
+            return
         logging.info("Shutting down - stopping all streams")
         stream_manager.stop_all_streams()
     
@@ -90,8 +249,9 @@ if __name__ == '__main__':
     # Use socketio.run instead of app.run for WebSocket support
     socketio.run(
         app,
-        debug=Config.DEBUG,
+        # The reloader and debugger are Werkzeug development tools
+        debug=Config.DEBUG and Config.ASYNC_MODE != 'gevent',
         host='0.0.0.0',
         port=Config.PORT,
-        allow_unsafe_werkzeug=True  # For development only
+        allow_unsafe_werkzeug=True  # Werkzeug is only used with ASYNC_MODE=threading (development)
     )
@@ -0,0 +1,84 @@
+"""
+Worker pool for blocking calls
+With ASYNC_MODE=gevent every request and Socket.IO connection is a greenlet on the
+event loop thread. StreamManager and Overlay calls wait on locks, subprocesses,
+disk and the database, so they run on a bounded pool of OS threads instead of
+stalling every other client. The standard library is not monkey-patched: sockets
+(e.g. PyMongo's pool) are shared by OS threads, which gevent sockets can't be
+"""
+
+import threading
+from functools import wraps
+from itertools import islice
+from config import Config
+
+class BlockingPool:
+    def __init__(self, size):
+        self.size = size
+        self._pool = None
+        self._hub = None
+        self._loop_thread = None
+
+    def start(self):
+        """Create the pool; must be called from the event loop thread (no-op outside gevent mode)"""
+        if Config.ASYNC_MODE != 'gevent' or self._pool is not None:
+            return
+        import gevent
+        from gevent.threadpool import ThreadPool
+        self._hub = gevent.get_hub()
+        self._pool = ThreadPool(self.size)
+        self._loop_thread = threading.get_ident()
+
+    def _on_loop(self):
+        return self._pool is not None and threading.get_ident() == self._loop_thread
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call fn on the pool and wait for it without blocking the event loop
+
+        Calls from other threads (worker threads, FFmpeg supervision, threading mode)
+        already block only themselves and run inline
+        """
+        if not self._on_loop():
+            return fn(*args, **kwargs)
+        return self._pool.apply(fn, args, kwargs)
+
+    def offload(self, method):
+        """Decorator running a method through run()"""
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            return self.run(method, *args, **kwargs)
+        return wrapper
+
+    def iterate(self, iterable, batch=1):
+        """
+        Iterate over a blocking iterator (e.g. a broker subscription), fetching batch items
+        at a time through run()
+
+        Successive batches may run on different pool threads, so the iterator must not be
+        tied to the thread that started it (SQLite connections are, see Overlay.iter_overlays)
+        """
+        iterator = iter(iterable)
+        while True:
+            items = self.run(lambda: list(islice(iterator, batch)))
+            if not items:
+                return
+            yield from items
+
+    def call_in_loop(self, fn, *args):
+        """Call fn on the event loop from any thread (Socket.IO emits aren't thread-safe under gevent)"""
+        if self._hub is None or self._on_loop():
+            fn(*args)
+            return
+        import gevent
+        self._hub.loop.run_callback_threadsafe(gevent.spawn, fn, *args)
+
+    def get_stats(self):
+        """Server mode and pool usage"""
+        return {
+            'async_mode': Config.ASYNC_MODE,
+            'pool_size': self.size if self._pool is not None else None,
+            'pool_threads': self._pool.size if self._pool is not None else None
+        }
+
+blocking_pool = BlockingPool(Config.BLOCKING_POOL_SIZE)
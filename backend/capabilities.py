@@ -0,0 +1,66 @@
+"""
+Cached capability probes
+Checks FFmpeg and the database once at startup and then periodically in the
+background, so health checks and metrics scrapes never fork a process
+"""
+
+import subprocess
+import threading
+import logging
+import time
+from config import Config
+
+class CapabilityProbe:
+    def __init__(self, interval):
+        self.interval = interval
+        self._status = {'ffmpeg': None, 'ffmpeg_version': None, 'ffmpeg_zmq': None, 'database': None, 'probed_at': None}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Run every probe now and cache the results"""
+        ffmpeg_version = None
+        try:
+            result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, check=True, timeout=10)
+            ffmpeg_version = result.stdout.split('\n', 1)[0].strip()
+            ffmpeg = True
+            # The zmq filter takes runtime commands for burned-in overlays
+            ffmpeg_zmq = '--enable-libzmq' in result.stdout
+        except (OSError, subprocess.SubprocessError):
+            ffmpeg = ffmpeg_zmq = False
+
+        from models import Database
+        database = Database().is_connected()
+
+        with self._lock:
+            self._status = {
+                'ffmpeg': ffmpeg,
+                'ffmpeg_version': ffmpeg_version,
+                'ffmpeg_zmq': ffmpeg_zmq,
+                'database': database,
+                'probed_at': time.time()
+            }
+
+    def start(self):
+        """Probe once, then keep refreshing in the background (idempotent)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='capability-probe', daemon=True)
+        self.refresh()
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"Error probing capabilities: {e}")
+
+    def get_status(self):
+        """Latest probe results (None before the first probe)"""
+        with self._lock:
+            return dict(self._status)
+
+capability_probe = CapabilityProbe(Config.HEALTH_PROBE_INTERVAL)
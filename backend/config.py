@@ -7,5 +7,104 @@ class Config:
     MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
     DATABASE_NAME = os.getenv('DATABASE_NAME', 'rtsp_overlay_db')
     COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'overlays')
+    # Overlay storage backend: 'mongodb' (in-memory until connected), 'sqlite' (embedded file) or 'memory'
+    OVERLAY_STORAGE = os.getenv('OVERLAY_STORAGE', 'mongodb').lower()
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'overlays.db')
+    # Upper bound (seconds) of the backoff between background MongoDB connection attempts
+    MONGODB_RETRY_MAX_DELAY = float(os.getenv('MONGODB_RETRY_MAX_DELAY', 30))
     DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
+    # Server mode: 'threading' (Werkzeug dev server, one thread per connection) or 'gevent'
+    # (production, one greenlet per connection); in gevent mode blocking stream/overlay calls
+    # run on BLOCKING_POOL_SIZE OS threads
+    ASYNC_MODE = os.getenv('ASYNC_MODE', 'threading').lower()
+    BLOCKING_POOL_SIZE = int(os.getenv('BLOCKING_POOL_SIZE', 16))
+    # How often (seconds) the FFmpeg/database checks reported by /health and /metrics are refreshed
+    HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', 30))
     PORT = int(os.getenv('PORT', 5000))
+    # Stream that overlays and Socket.IO clients belong to when none is given
+    DEFAULT_STREAM_ID = os.getenv('DEFAULT_STREAM_ID', 'default')
+    # Rate (Hz) at which coalesced overlay move/resize frames are flushed; 0 disables coalescing
+    OVERLAY_TICK_HZ = float(os.getenv('OVERLAY_TICK_HZ', 30))
+    # Live drag/resize positions are written to storage every interval (seconds) or once this many overlays are dirty
+    OVERLAY_FLUSH_INTERVAL = float(os.getenv('OVERLAY_FLUSH_INTERVAL', 0.5))
+    OVERLAY_FLUSH_THRESHOLD = int(os.getenv('OVERLAY_FLUSH_THRESHOLD', 100))
+    # 'auto' copies HLS-compatible input codecs (probed with ffprobe), 'copy' always copies, 'transcode' always re-encodes
+    STREAM_CODEC_MODE = os.getenv('STREAM_CODEC_MODE', 'auto').lower()
+    FFPROBE_TIMEOUT = float(os.getenv('FFPROBE_TIMEOUT', 10))
+    # HLS output directory; point it at a tmpfs (e.g. /dev/shm/hls) to keep segments off the disk
+    HLS_OUTPUT_DIR = os.getenv('HLS_OUTPUT_DIR', 'hls')
+    # Browser/proxy caching of live playlists (seconds); segments are cached as immutable for HLS_SEGMENT_MAX_AGE
+    HLS_PLAYLIST_MAX_AGE = int(os.getenv('HLS_PLAYLIST_MAX_AGE', 1))
+    HLS_SEGMENT_MAX_AGE = int(os.getenv('HLS_SEGMENT_MAX_AGE', 86400))
+    # In-memory cache of recently served segments (MB); 0 serves every request from the file with sendfile
+    HLS_SEGMENT_CACHE_MB = float(os.getenv('HLS_SEGMENT_CACHE_MB', 0))
+    # Let a fronting web server (nginx X-Accel/Apache mod_xsendfile) send files via the X-Sendfile header
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'False').lower() == 'true'
+    # Default HLS latency profile for new streams: 'standard' or 'low'
+    STREAM_LATENCY_PROFILE = os.getenv('STREAM_LATENCY_PROFILE', 'standard').lower()
+    # Adaptive bitrate: encode every stream to this ladder of height:kbps renditions from a single decode
+    STREAM_ABR = os.getenv('STREAM_ABR', 'False').lower() == 'true'
+    STREAM_ABR_LADDER = os.getenv('STREAM_ABR_LADDER', '1080:5000,720:2800,360:800')
+    # Admission control: share of total host CPU (percent, 0 = unlimited) and memory (MB, 0 = unlimited)
+    # FFmpeg may use; streams that don't fit are queued or rejected (STREAM_ADMISSION: 'queue' or 'reject')
+    STREAM_CPU_BUDGET = float(os.getenv('STREAM_CPU_BUDGET', 0))
+    STREAM_RSS_BUDGET_MB = float(os.getenv('STREAM_RSS_BUDGET_MB', 0))
+    STREAM_ADMISSION = os.getenv('STREAM_ADMISSION', 'queue').lower()
+    # Assumed usage (percent of one core, MB) of a stream until one with the same settings has been measured
+    STREAM_CPU_ESTIMATE = float(os.getenv('STREAM_CPU_ESTIMATE', 50))
+    STREAM_RSS_ESTIMATE_MB = float(os.getenv('STREAM_RSS_ESTIMATE_MB', 150))
+    # Priority classes (high/normal/low): default class, nice levels and CPU affinity, e.g. 'high=0-3;low=4-7'
+    STREAM_PRIORITY = os.getenv('STREAM_PRIORITY', 'normal').lower()
+    STREAM_NICE_LEVELS = os.getenv('STREAM_NICE_LEVELS', 'low=10')
+    STREAM_CPU_AFFINITY = os.getenv('STREAM_CPU_AFFINITY', '')
+    # DVR: record streams (default for new streams) into DVR_DIR, keeping segments for
+    # DVR_RETENTION_HOURS and at most DVR_MAX_DISK_MB in total (0 = no limit)
+    DVR_RECORD = os.getenv('DVR_RECORD', 'False').lower() == 'true'
+    DVR_DIR = os.getenv('DVR_DIR', 'recordings')
+    DVR_RETENTION_HOURS = float(os.getenv('DVR_RETENTION_HOURS', 24))
+    DVR_MAX_DISK_MB = float(os.getenv('DVR_MAX_DISK_MB', 10240))
+    # Overlay burn-in: an extra '<name>_overlay.m3u8' rendition with the stream's overlays drawn in
+    # (default for new streams). Overlay positions are in the frontend canvas space of
+    # OVERLAY_CANVAS_WIDTH x OVERLAY_CANVAS_HEIGHT; the rendition is OVERLAY_BURNIN_HEIGHT pixels tall
+    STREAM_BURN_IN = os.getenv('STREAM_BURN_IN', 'False').lower() == 'true'
+    OVERLAY_CANVAS_WIDTH = int(os.getenv('OVERLAY_CANVAS_WIDTH', 800))
+    OVERLAY_CANVAS_HEIGHT = int(os.getenv('OVERLAY_CANVAS_HEIGHT', 450))
+    OVERLAY_BURNIN_HEIGHT = int(os.getenv('OVERLAY_BURNIN_HEIGHT', 720))
+    # Text overlays the filter graph has room for without a restart, font file ('' = fontconfig
+    # Sans) and how often (seconds) overlay edits are picked up
+    OVERLAY_BURNIN_TEXT_SLOTS = int(os.getenv('OVERLAY_BURNIN_TEXT_SLOTS', 8))
+    OVERLAY_BURNIN_FONT = os.getenv('OVERLAY_BURNIN_FONT', '')
+    OVERLAY_BURNIN_INTERVAL = float(os.getenv('OVERLAY_BURNIN_INTERVAL', 0.5))
+    # Decoded burn-in images unused for OVERLAY_BURNIN_IMAGE_MAX_AGE seconds are removed, and the
+    # least recently used ones while there are more than OVERLAY_BURNIN_IMAGE_CACHE_MB of them
+    OVERLAY_BURNIN_IMAGE_MAX_AGE = float(os.getenv('OVERLAY_BURNIN_IMAGE_MAX_AGE', 3600))
+    OVERLAY_BURNIN_IMAGE_CACHE_MB = float(os.getenv('OVERLAY_BURNIN_IMAGE_CACHE_MB', 256))
+    # Resized image overlays served by /api/overlay-images: memory budget, optional directory that
+    # evicted images spill to ('' = memory only) with its own budget, and the largest source fetched
+    OVERLAY_IMAGE_CACHE_MB = float(os.getenv('OVERLAY_IMAGE_CACHE_MB', 64))
+    OVERLAY_IMAGE_CACHE_DIR = os.getenv('OVERLAY_IMAGE_CACHE_DIR', '')
+    OVERLAY_IMAGE_DISK_CACHE_MB = float(os.getenv('OVERLAY_IMAGE_DISK_CACHE_MB', 512))
+    OVERLAY_IMAGE_MAX_SOURCE_MB = float(os.getenv('OVERLAY_IMAGE_MAX_SOURCE_MB', 20))
+    # Let overlay images be fetched from loopback/private/link-local addresses (e.g. a LAN web server);
+    # off by default so overlays can't make the server reach internal services
+    OVERLAY_IMAGE_ALLOW_PRIVATE = os.getenv('OVERLAY_IMAGE_ALLOW_PRIVATE', 'False').lower() == 'true'
+    # Multi-worker mode: workers on one host share stream ownership and state through this
+    # SQLite file ('' = single worker); a worker silent for WORKER_TIMEOUT seconds has its
+    # FFmpeg processes taken over by the others
+    SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', '')
+    WORKER_ID = os.getenv('WORKER_ID', '')
+    WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', 10))
+    # Socket.IO fan-out between workers: a Redis/RabbitMQ/Kafka URL, 'sqlite:///<path>' for a
+    # broker-less queue on one host, or '' for a single worker
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+    # Keep FFmpeg running across backend restarts: streams are persisted in STREAM_STATE_DIR and
+    # re-adopted at startup instead of being stopped at exit
+    STREAM_ADOPT = os.getenv('STREAM_ADOPT', 'False').lower() == 'true'
+    STREAM_STATE_DIR = os.getenv('STREAM_STATE_DIR', 'stream_state')
+    # Stream supervision: check interval, output staleness limits (seconds) and restart policy
+    STREAM_SUPERVISOR_INTERVAL = float(os.getenv('STREAM_SUPERVISOR_INTERVAL', 2))
+    STREAM_STALL_TIMEOUT = float(os.getenv('STREAM_STALL_TIMEOUT', 20))
+    STREAM_STARTUP_TIMEOUT = float(os.getenv('STREAM_STARTUP_TIMEOUT', 30))
+    STREAM_MAX_RESTARTS = int(os.getenv('STREAM_MAX_RESTARTS', 5))
+    STREAM_RESTART_BACKOFF = float(os.getenv('STREAM_RESTART_BACKOFF', 2))
+    STREAM_RESTART_BACKOFF_MAX = float(os.getenv('STREAM_RESTART_BACKOFF_MAX', 60))
@@ -0,0 +1,233 @@
+"""
+Rolling DVR recording
+Files each completed live segment of a recording stream into hourly buckets
+(hard-linked, so nothing is copied or re-encoded), enforces retention by age and
+total disk budget, and builds VOD playlists for arbitrary time ranges
+"""
+
+import threading
+import logging
+import shutil
+import time
+import os
+from datetime import datetime, timezone
+from config import Config
+import hls_playlist
+from blocking_pool import blocking_pool
+
+# How often (seconds) live playlists are checked for new segments
+RECORD_INTERVAL = 1.0
+# How often (seconds) retention is enforced
+RETENTION_INTERVAL = 60.0
+# Upper bound on segment length (seconds) when looking up a time range
+MAX_SEGMENT_DURATION = 60
+
+def _bucket(start):
+    """Day and hour directories (UTC) a segment starting at `start` is filed under"""
+    moment = datetime.fromtimestamp(start, timezone.utc)
+    return moment.strftime('%Y%m%d'), moment.strftime('%H')
+
+def _parse_segment_name(name):
+    """(start, duration) in seconds from '<start ms>_<duration ms>.ts', or None"""
+    stem, ext = os.path.splitext(name)
+    start_ms, sep, duration_ms = stem.partition('_')
+    if ext != '.ts' or not sep or not start_ms.isdigit() or not duration_ms.isdigit():
+        return None
+    return int(start_ms) / 1000, int(duration_ms) / 1000
+
+class DvrRecorder:
+    def __init__(self, manager, root):
+        self.manager = manager
+        self.root = root
+        self._recorded = {}
+        self._last_retention = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the recording thread (idempotent)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='dvr-recorder', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Recording loop"""
+        while True:
+            time.sleep(RECORD_INTERVAL)
+            try:
+                self.record_segments()
+                if time.time() - self._last_retention > RETENTION_INTERVAL:
+                    self._last_retention = time.time()
+                    self.enforce_retention()
+            except Exception as e:
+                logging.error(f"Error recording streams: {e}")
+
+    def stream_dir(self, name):
+        """Recording directory of a stream (None for names that would escape the DVR root)"""
+        if not name or name in ('.', '..') or os.sep in name or (os.altsep and os.altsep in name):
+            return None
+        return os.path.join(self.root, name)
+
+    def record_segments(self):
+        """File new segments of every recording stream"""
+        with self.manager._lock:
+            streams = [
+                stream for stream in {id(s): s for s in self.manager.active_streams.values()}.values()
+                if stream['record'] and stream['process'] is not None
+            ]
+        active = set()
+        for stream in streams:
+            name = stream['output_name']
+            active.add(name)
+            text = hls_playlist.read_playlist(stream['watch_path'])
+            if not text:
+                continue
+            playlist_dir = os.path.dirname(stream['watch_path'])
+            segments = hls_playlist.parse_segments(text)
+            recorded = self._recorded.setdefault(name, set())
+            for segment in segments:
+                if segment['uri'] in recorded or segment['start'] is None or segment['duration'] is None:
+                    continue
+                if self._file_segment(name, os.path.join(playlist_dir, segment['uri']), segment):
+                    recorded.add(segment['uri'])
+            # Only the URIs still in the live playlist can come up again
+            recorded.intersection_update(segment['uri'] for segment in segments)
+        for name in set(self._recorded) - active:
+            del self._recorded[name]
+
+    def _file_segment(self, name, source, segment):
+        """Hard-link (or copy, across filesystems) one live segment into its hourly bucket"""
+        day, hour = _bucket(segment['start'])
+        bucket = os.path.join(self.root, name, day, hour)
+        target = os.path.join(
+            bucket, f"{round(segment['start'] * 1000)}_{round(segment['duration'] * 1000)}.ts"
+        )
+        if os.path.exists(target):
+            return True
+        os.makedirs(bucket, exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileNotFoundError:
+            return False  # Already deleted from the live window
+        except OSError:
+            try:
+                shutil.copyfile(source, target)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _iter_segments(self, name, start=None, end=None):
+        """Yield (start, duration, path) of a stream's recorded segments, in time order"""
+        stream_dir = self.stream_dir(name)
+        if stream_dir is None or not os.path.isdir(stream_dir):
+            return
+        # A segment filed under the previous hour can still run into the range
+        first = _bucket(start - MAX_SEGMENT_DURATION) if start is not None else None
+        last = _bucket(end) if end is not None else None
+        for day in sorted(os.listdir(stream_dir)):
+            if (first and day < first[0]) or (last and day > last[0]):
+                continue
+            day_dir = os.path.join(stream_dir, day)
+            for hour in sorted(os.listdir(day_dir)):
+                if (first and (day, hour) < first) or (last and (day, hour) > last):
+                    continue
+                hour_dir = os.path.join(day_dir, hour)
+                entries = []
+                for file_name in os.listdir(hour_dir):
+                    parsed = _parse_segment_name(file_name)
+                    if parsed is not None:
+                        entries.append((parsed[0], parsed[1], os.path.join(hour_dir, file_name)))
+                for segment_start, duration, path in sorted(entries):
+                    if start is not None and segment_start + duration <= start:
+                        continue
+                    if end is not None and segment_start >= end:
+                        continue
+                    yield segment_start, duration, path
+
+    @blocking_pool.offload
+    def vod_playlist(self, name, start, end):
+        """
+        VOD playlist of the recorded segments overlapping [start, end)
+
+        Returns:
+            str: Playlist text, or None if nothing was recorded in the range
+        """
+        segments = [
+            {
+                'uri': '/recordings/' + os.path.relpath(path, self.root).replace(os.sep, '/'),
+                'start': segment_start,
+                'duration': duration,
+            }
+            for segment_start, duration, path in self._iter_segments(name, start, end)
+        ]
+        if not segments:
+            return None
+        return hls_playlist.build_vod_playlist(segments)
+
+    @blocking_pool.offload
+    def get_recordings(self, name, gap_tolerance=0.5):
+        """Continuous recorded spans of a stream, plus segment count and size"""
+        ranges = []
+        count = size = 0
+        for segment_start, duration, path in self._iter_segments(name):
+            count += 1
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+            if ranges and abs(segment_start - ranges[-1]['end']) <= gap_tolerance:
+                ranges[-1]['end'] = segment_start + duration
+            else:
+                ranges.append({'start': segment_start, 'end': segment_start + duration})
+        return {'ranges': ranges, 'segments': count, 'bytes': size}
+
+    def enforce_retention(self):
+        """Delete segments older than DVR_RETENTION_HOURS, then the oldest ones until under DVR_MAX_DISK_MB"""
+        if not os.path.isdir(self.root):
+            return
+        cutoff = time.time() - Config.DVR_RETENTION_HOURS * 3600 if Config.DVR_RETENTION_HOURS else None
+        segments = []
+        removed = 0
+        for name in os.listdir(self.root):
+            for segment_start, duration, path in list(self._iter_segments(name)):
+                if cutoff is not None and segment_start + duration < cutoff:
+                    removed += self._remove(path)
+                    continue
+                try:
+                    segments.append((segment_start, os.path.getsize(path), path))
+                except OSError:
+                    pass
+
+        budget = Config.DVR_MAX_DISK_MB * 1024 * 1024
+        total = sum(size for _, size, _ in segments)
+        if budget and total > budget:
+            # Oldest first across all streams
+            for _, size, path in sorted(segments):
+                if total <= budget:
+                    break
+                removed += self._remove(path)
+                total -= size
+        if removed:
+            self._prune_empty_dirs()
+            logging.info(f"DVR retention removed {removed} segments")
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def _prune_empty_dirs(self):
+        """Remove hour/day directories left empty by retention"""
+        # Bottom-up, so a day emptied of its hours goes too; the listing os.walk made of
+        # it predates their removal, so rely on rmdir failing for non-empty directories
+        for directory, _, _ in os.walk(self.root, topdown=False):
+            if directory != self.root:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
@@ -0,0 +1,109 @@
+"""
+HLS segment cache
+Keeps recently requested segments in memory, bounded by total size, so a
+segment that many viewers fetch is read from disk once
+"""
+
+import threading
+import os
+from collections import OrderedDict
+from flask import Response
+
+# Segment names are unique per FFmpeg launch, so their content never changes
+SEGMENT_EXTENSIONS = ('.ts', '.m4s')
+
+# mimetypes maps .ts to Qt translation files
+HLS_MIMETYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+}
+
+def hls_mimetype(filename):
+    """Content type of an HLS file"""
+    return HLS_MIMETYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+
+def is_segment(filename):
+    """Whether a file is a media segment (as opposed to a playlist or init file)"""
+    return filename.endswith(SEGMENT_EXTENSIONS)
+
+class SegmentCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, path):
+        """
+        Contents of a segment, from memory when possible
+
+        Returns:
+            tuple: (bytes, os.stat_result), or None if the file doesn't exist
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._evict(path)
+            return None
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1], stat
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        with self._lock:
+            self.misses += 1
+            self._evict(path)
+            if len(data) <= self.max_bytes:
+                self._entries[path] = (key, data)
+                self._size += len(data)
+                while self._size > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return data, stat
+
+    def _evict(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def response(self, path, request):
+        """Conditional (ETag/Last-Modified) and range-aware response for a segment, or None if missing"""
+        cached = self.get(path)
+        if cached is None:
+            return None
+        data, stat = cached
+        response = Response(data, mimetype=hls_mimetype(path))
+        response.set_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+        response.last_modified = stat.st_mtime
+        return response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+
+    def get_stats(self):
+        """Cache occupancy and hit rate"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'segments': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
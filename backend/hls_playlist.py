@@ -0,0 +1,144 @@
+"""
+HLS playlist helpers
+Blocking playlist reload (_HLS_msn / _HLS_part) so low-latency players wait on
+the server for the next segment instead of busy-polling the /hls route
+"""
+
+import time
+import math
+import os
+from datetime import datetime, timezone
+
+SERVER_CONTROL_TAG = '#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES'
+
+def read_playlist(path):
+    """Read a playlist, or None if it doesn't exist yet"""
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def parse_playlist(text):
+    """
+    Extract the sequence numbers of a media playlist
+
+    Returns:
+        tuple: (media sequence of the first segment, number of segments, target duration)
+    """
+    media_sequence = 0
+    segments = 0
+    target_duration = None
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            media_sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            segments += 1
+    return media_sequence, segments, target_duration
+
+def parse_program_date_time(value):
+    """Parse an EXT-X-PROGRAM-DATE-TIME value into epoch seconds, or None"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    return None
+
+def parse_segments(text):
+    """
+    List the segments of a media playlist
+
+    Returns:
+        list: [{'uri', 'duration', 'start'}], where start is the wall-clock time in
+            epoch seconds from EXT-X-PROGRAM-DATE-TIME (None if the playlist has none)
+    """
+    segments = []
+    duration = None
+    start = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            start = parse_program_date_time(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line and not line.startswith('#'):
+            segments.append({'uri': line, 'duration': duration, 'start': start})
+            # Without a new tag the next segment follows on directly
+            start = start + duration if start is not None and duration is not None else None
+            duration = None
+    return segments
+
+def build_vod_playlist(segments, gap_tolerance=0.5):
+    """
+    Build a VOD playlist from [{'uri', 'start', 'duration'}] in time order, marking a
+    discontinuity wherever the recording has a gap (e.g. after an FFmpeg restart)
+    """
+    target_duration = math.ceil(max((segment['duration'] for segment in segments), default=1))
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{target_duration}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    expected_start = None
+    for segment in segments:
+        if expected_start is not None and abs(segment['start'] - expected_start) > gap_tolerance:
+            lines.append('#EXT-X-DISCONTINUITY')
+        if expected_start is None or abs(segment['start'] - expected_start) > gap_tolerance:
+            timestamp = datetime.fromtimestamp(segment['start'], timezone.utc)
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{timestamp.isoformat(timespec='milliseconds')}")
+        lines.append(f"#EXTINF:{segment['duration']:.3f},")
+        lines.append(segment['uri'])
+        expected_start = segment['start'] + segment['duration']
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+def last_sequence(text):
+    """Media sequence number of the newest segment, or -1 if there is none"""
+    media_sequence, segments, _ = parse_playlist(text)
+    return media_sequence + segments - 1
+
+def wait_for_segment(path, msn, poll_interval=0.05, sleep=time.sleep):
+    """
+    Block until the playlist contains segment msn
+
+    FFmpeg doesn't publish partial segments, so a requested _HLS_part is
+    satisfied by waiting for the whole segment. sleep lets an event loop
+    keep serving other clients while this one waits
+
+    Returns:
+        tuple: (HTTP status, playlist text or None)
+    """
+    text = read_playlist(path)
+    if text is None:
+        return 404, None
+
+    _, _, target_duration = parse_playlist(text)
+    # The spec asks for 400 when the request is too far ahead of the live edge
+    if msn > last_sequence(text) + 2:
+        return 400, None
+
+    # Give up after three target durations and return what we have
+    deadline = time.time() + 3 * (target_duration or 2)
+    last_mtime = os.path.getmtime(path)
+    while last_sequence(text) < msn and time.time() < deadline:
+        sleep(poll_interval)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if mtime != last_mtime:
+            last_mtime = mtime
+            text = read_playlist(path) or text
+    return 200, text
+
+def add_server_control(text):
+    """Advertise blocking playlist reload to players"""
+    if SERVER_CONTROL_TAG in text:
+        return text
+    header, _, rest = text.partition('\n')
+    return f"{header}\n{SERVER_CONTROL_TAG}\n{rest}"
@@ -0,0 +1,128 @@
+"""
+Socket.IO message queue
+Lets every backend worker emit to clients connected to any of the others. A
+Redis or RabbitMQ URL is handed to Flask-SocketIO as is; sqlite:///<path> uses
+a table in a local SQLite file instead, for workers on one host without a broker
+"""
+
+import threading
+import logging
+import sqlite3
+import time
+import os
+import socketio
+from socketio import PubSubManager
+from engineio import json
+from blocking_pool import blocking_pool
+from config import Config
+
+# How often listeners look for new messages, and how long messages are kept for them
+POLL_INTERVAL = 0.02
+RETENTION_SECONDS = 30
+
+class SQLiteQueueManager(PubSubManager):
+    """Client manager publishing through a SQLite table that every worker polls"""
+    name = 'sqlite'
+
+    def __init__(self, url='sqlite:///socketio.db', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('sqlite:///'):]
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        self._last_prune = 0
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, '
+            'payload TEXT NOT NULL, created REAL NOT NULL)'
+        )
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _publish(self, data):
+        # Emits come from request handlers, worker threads and the supervisor alike
+        with self._publish_lock:
+            if self._publisher is None:
+                self._publisher = self._connect()
+            now = time.time()
+            with self._publisher as conn:
+                conn.execute(
+                    'INSERT INTO messages (channel, payload, created) VALUES (?, ?, ?)',
+                    (self.channel, json.dumps(data), now)
+                )
+                if now - self._last_prune > RETENTION_SECONDS:
+                    self._last_prune = now
+                    conn.execute('DELETE FROM messages WHERE created < ?', (now - RETENTION_SECONDS,))
+
+    def _listen(self):
+        conn = self._connect()
+        # Only messages published from now on
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        while True:
+            try:
+                rows = conn.execute(
+                    'SELECT id, payload FROM messages WHERE id > ? AND channel = ? ORDER BY id',
+                    (last_id, self.channel)
+                ).fetchall()
+            except sqlite3.Error as e:
+                logging.error(f"Cannot read Socket.IO message queue {self.path}: {e}")
+                rows = []
+                time.sleep(1)
+            for message_id, payload in rows:
+                last_id = message_id
+                yield payload
+            time.sleep(POLL_INTERVAL)
+
+def _broker_manager_class(url):
+    """Client manager class Flask-SocketIO would pick for a broker URL"""
+    if url.startswith(('redis://', 'rediss://')):
+        return socketio.RedisManager
+    if url.startswith('kafka://'):
+        return socketio.KafkaManager
+    if url.startswith('zmq'):
+        return socketio.ZmqManager
+    return socketio.KombuManager
+
+def offloaded(manager_class):
+    """
+    Subclass of a client manager whose queue I/O runs on the blocking pool
+
+    In gevent mode the socket module isn't monkey-patched, so publishing or
+    listening on the event loop would block every client while it waits
+    """
+    class OffloadedManager(manager_class):
+        def initialize(self):
+            # Skip the broker managers' check for a monkey-patched socket module
+            PubSubManager.initialize(self)
+
+        def _publish(self, data):
+            return blocking_pool.run(super()._publish, data)
+
+        def _listen(self):
+            return blocking_pool.iterate(super()._listen())
+
+    OffloadedManager.__name__ = f"Offloaded{manager_class.__name__}"
+    return OffloadedManager
+
+def socketio_options(url):
+    """Keyword arguments for SocketIO.init_app() that connect it to a message queue URL"""
+    if not url:
+        return {}
+    if url.startswith('sqlite:///'):
+        manager_class, channel = SQLiteQueueManager, 'socketio'
+    elif Config.ASYNC_MODE == 'gevent':
+        # Built here rather than by Flask-SocketIO, with its default channel
+        manager_class, channel = _broker_manager_class(url), 'flask-socketio'
+    else:
+        return {'message_queue': url}
+    if Config.ASYNC_MODE == 'gevent':
+        manager_class = offloaded(manager_class)
+    return {'client_manager': manager_class(url, channel=channel)}
@@ -0,0 +1,188 @@
+"""
+Prometheus metrics
+Counters and histograms kept in process memory and rendered in the Prometheus
+text exposition format by /metrics; gauges are collected at scrape time
+"""
+
+import threading
+import time
+from functools import wraps
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers cached reads (sub-millisecond) up to blocking playlist reloads
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [per-bucket counts, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+def gauge_lines(name, documentation, samples, labels=(), kind='gauge'):
+    """
+    Render a gauge (or a counter kept elsewhere) from values collected at scrape time
+
+    Args:
+        samples: Iterable of (label values, value); None values are skipped
+    """
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+    for key, value in samples:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = int(value)
+        lines.append(f'{name}{_format_labels(labels, key)} {_format_value(value)}')
+    return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register collector() -> list of exposition lines, called on every scrape"""
+        self._collectors.append(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'API request latency by route',
+    ('blueprint', 'route', 'method', 'status')
+)
+overlay_operation_duration = registry.histogram(
+    'overlay_store_operation_duration_seconds', 'Overlay storage operation latency',
+    ('operation', 'backend')
+)
+overlay_operation_errors = registry.counter(
+    'overlay_store_operation_errors_total', 'Overlay storage operations that raised',
+    ('operation', 'backend')
+)
+socketio_events = registry.counter(
+    'socketio_events_total', 'Socket.IO events received from clients (in) and emitted (out)',
+    ('direction', 'event')
+)
+
+def instrument_blueprint(blueprint):
+    """Time every request of a blueprint; must be called before it is registered"""
+    from flask import g, request
+
+    @blueprint.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @blueprint.after_request
+    def _observe_latency(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                blueprint=blueprint.name,
+                # The URL rule, so /overlays/<overlay_id> is one series rather than one per ID
+                route=request.url_rule.rule if request.url_rule else 'unmatched',
+                method=request.method,
+                status=response.status_code
+            )
+        return response
+
+def timed_operation(operation):
+    """Decorator recording an Overlay method's duration and errors under its storage backend"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            backend = self.backend
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                overlay_operation_errors.inc(operation=operation, backend=backend)
+                raise
+            finally:
+                overlay_operation_duration.observe(time.perf_counter() - start, operation=operation, backend=backend)
+        return wrapper
+    return decorator
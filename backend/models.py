@@ -1,14 +1,27 @@
 from pymongo import MongoClient
-from bson import ObjectId
 from config import Config
+from storage import MemoryStore, MongoStore, SQLiteStore, RevisionMismatch, flatten_patch
+from metrics import timed_operation
+from blocking_pool import blocking_pool
+from shared_state import shared_state
 import logging
+from contextlib import contextmanager
 from datetime import datetime
+import threading
+import time
+import uuid
+
+# Overlays read per worker pool call (and per query) when iterating (MongoDB's default first batch)
+ITER_BATCH_SIZE = 101
 
 class Database:
     _instance = None
     _client = None
     _db = None
     _connected = False
+    _connect_thread = None
+    _listeners = []
+    _lock = threading.Lock()
     
     def __new__(cls):
         if cls._instance is None:
@@ -25,15 +38,51 @@ class Database:
             logging.info("Connected to MongoDB successfully")
         except Exception as e:
             logging.error(f"Failed to connect to MongoDB: {e}")
-            logging.warning("Application will continue with in-memory storage (data will not persist)")
             self._client = None
             self._db = None
             self._connected = False
+        return self._connected
+    
+    def connect_in_background(self):
+        """Connect without blocking the caller, retrying with exponential backoff"""
+        with self._lock:
+            if self._connected or self._connect_thread is not None:
+                return
+            Database._connect_thread = threading.Thread(
+                target=self._connect_loop, name='mongodb-connect', daemon=True
+            )
+            Database._connect_thread.start()
+    
+    def _connect_loop(self):
+        """Retry until MongoDB is reachable, then notify listeners"""
+        delay = 1.0
+        while not self.connect():
+            logging.warning(f"Serving from in-memory storage; retrying MongoDB in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, Config.MONGODB_RETRY_MAX_DELAY)
+        
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(self.get_collection())
+            except Exception as e:
+                logging.error(f"Error in MongoDB connect listener: {e}")
+    
+    def on_connect(self, listener):
+        """Call listener(collection) once MongoDB is connected (immediately if it already is)"""
+        with self._lock:
+            self._listeners.append(listener)
+            connected = self._connected
+        if connected:
+            listener(self.get_collection())
     
     def get_collection(self):
-        if self._db is None and not self._connected:
-            self.connect()
-        return self._db[Config.COLLECTION_NAME] if self._db is not None else None
+        """Get the overlays collection, or None while MongoDB isn't connected yet"""
+        if not self._connected:
+            self.connect_in_background()
+            return None
+        return self._db[Config.COLLECTION_NAME]
     
     def is_connected(self):
         return self._connected
@@ -41,101 +90,296 @@ class Database:
 class Overlay:
     def __init__(self):
         self.db = Database()
-        self.collection = self.db.get_collection()
-        # In-memory storage for when MongoDB is not available
-        self._memory_store = {}
-        self._next_id = 1
+        # Collection version, bumped on every write so readers can cache by it
+        self._version = 0
+        self._version_lock = threading.Lock()
+        self._epoch = uuid.uuid4().hex[:12]
+        # Writes in flight; new ones wait while _switching is set (see _on_database_connected)
+        self._store_cond = threading.Condition()
+        self._writers = 0
+        self._switching = False
+        
+        backend = Config.OVERLAY_STORAGE
+        if backend == 'sqlite':
+            self.store = SQLiteStore(Config.SQLITE_PATH)
+        elif backend == 'memory':
+            self.store = MemoryStore()
+        else:
+            if backend != 'mongodb':
+                logging.error(f"Unknown OVERLAY_STORAGE '{backend}', using mongodb")
+            # Served from memory until MongoDB is reachable, see _on_database_connected
+            self.store = MemoryStore()
+            self.db.on_connect(self._on_database_connected)
+            self.db.connect_in_background()
+    
+    @property
+    def backend(self):
+        """Name of the storage backend currently serving overlays"""
+        return self.store.name
+    
+    @contextmanager
+    def _writable_store(self):
+        """The store a write goes to; waits while overlays are being moved to MongoDB"""
+        with self._store_cond:
+            self._store_cond.wait_for(lambda: not self._switching)
+            self._writers += 1
+            store = self.store
+        try:
+            yield store
+        finally:
+            with self._store_cond:
+                self._writers -= 1
+                self._store_cond.notify_all()
+    
+    def _on_database_connected(self, collection):
+        """Replay overlays written while MongoDB was unreachable, then switch to it"""
+        memory = self.store
+        mongo = MongoStore(collection)
+        
+        # Copy the bulk while memory keeps serving reads and writes
+        snapshot = memory.snapshot()
+        skipped = mongo.import_overlays(snapshot)
+        
+        # Hold new writes until the ones in flight have landed, then copy what changed
+        # since the snapshot and swap; reads keep being served from memory meanwhile
+        with self._store_cond:
+            self._switching = True
+            self._store_cond.wait_for(lambda: self._writers == 0)
+        try:
+            skipped += mongo.import_overlays(memory.snapshot(), already_synced=snapshot)
+            self.store = mongo
+        finally:
+            with self._store_cond:
+                self._switching = False
+                self._store_cond.notify_all()
+        
+        memory.drain()
+        self._bump_version()
+        if skipped:
+            logging.warning(f"Kept {skipped} MongoDB overlays that conflicted with in-memory ones")
+        logging.info(f"Switched overlay storage to MongoDB ({len(snapshot)} in-memory overlays synced)")
+    
+    @property
+    def version(self):
+        """Current collection version, unique across process restarts"""
+        if shared_state is not None:
+            # Every worker serves the same collection, so they share one version
+            return f"{shared_state.epoch:x}-{shared_state.counter('overlays')}"
+        return f"{self._epoch}-{self._version}"
     
-    def _generate_id(self):
-        """Generate a fake ObjectId for in-memory storage"""
-        id_str = f"{self._next_id:024d}"
-        self._next_id += 1
-        return id_str
+    def _bump_version(self):
+        """Invalidate cached reads after a write"""
+        if shared_state is not None:
+            shared_state.increment('overlays')
+            return
+        with self._version_lock:
+            self._version += 1
     
+    @blocking_pool.offload
+    @timed_operation('create')
     def create(self, overlay_data):
         """Create a new overlay"""
         try:
-            if self.collection is not None:
-                # Use MongoDB
-                result = self.collection.insert_one(overlay_data)
-                return str(result.inserted_id)
-            else:
-                # Use in-memory storage
-                overlay_id = self._generate_id()
-                self._memory_store[overlay_id] = {**overlay_data, '_id': overlay_id}
-                logging.info(f"Created overlay in memory: {overlay_id}")
-                return overlay_id
+            overlay_data['rev'] = 1
+            with self._writable_store() as store:
+                overlay_id = store.create(overlay_data)
         except Exception as e:
             logging.error(f"Error creating overlay: {e}")
             raise
+        self._bump_version()
+        return overlay_id
     
-    def get_all(self):
-        """Get all overlays"""
+    @blocking_pool.offload
+    @timed_operation('create_many')
+    def create_many(self, overlays):
+        """
+        Create many overlays in one operation
+        
+        Args:
+            overlays: List of overlay documents
+        
+        Returns:
+            list: IDs of the created overlays, in input order
+        """
+        if not overlays:
+            return []
+        for overlay_data in overlays:
+            overlay_data['rev'] = 1
         try:
-            if self.collection is not None:
-                # Use MongoDB
-                overlays = list(self.collection.find())
-                for overlay in overlays:
-                    overlay['_id'] = str(overlay['_id'])
-                return overlays
-            else:
-                # Use in-memory storage
-                return list(self._memory_store.values())
+            with self._writable_store() as store:
+                overlay_ids = store.create_many(overlays)
+        except Exception as e:
+            logging.error(f"Error creating overlays: {e}")
+            raise
+        self._bump_version()
+        return overlay_ids
+    
+    @blocking_pool.offload
+    @timed_operation('get_all')
+    def get_all(self, stream_id=None):
+        """Get all overlays, optionally only those of one stream"""
+        try:
+            return self.store.get_all(stream_id=stream_id)
         except Exception as e:
             logging.error(f"Error fetching overlays: {e}")
             raise
     
+    def iter_overlays(self, stream_id=None, after=None, limit=None, fields=None):
+        """
+        Lazily iterate overlays in ID order without loading the collection
+        
+        Args:
+            stream_id: Only overlays of this stream
+            after: Only overlays with an ID greater than this one (pagination cursor)
+            limit: Maximum number of overlays
+            fields: Fields to return besides _id (all when None)
+        
+        Yields:
+            dict: Overlay documents with string IDs
+        """
+        # One keyset query per batch on the worker pool: successive batches may run on different
+        # pool threads, so no cursor (or SQLite connection) is carried from one to the next
+        remaining = limit or None
+        while remaining is None or remaining > 0:
+            batch = ITER_BATCH_SIZE if remaining is None else min(ITER_BATCH_SIZE, remaining)
+            overlays = blocking_pool.run(self._read_batch, stream_id, after, batch, fields)
+            yield from overlays
+            if len(overlays) < batch:
+                return
+            after = overlays[-1]['_id']
+            if remaining is not None:
+                remaining -= len(overlays)
+    
+    def _read_batch(self, stream_id, after, limit, fields):
+        try:
+            return list(self.store.iter_overlays(stream_id=stream_id, after=after, limit=limit, fields=fields))
+        except Exception as e:
+            logging.error(f"Error iterating overlays: {e}")
+            raise
+    
+    @blocking_pool.offload
+    @timed_operation('get_stream_ids')
+    def get_stream_ids(self, overlay_ids):
+        """
+        Look up which overlays exist and the stream each belongs to
+        
+        Returns:
+            dict: Overlay ID -> stream ID, for existing overlays only
+        """
+        try:
+            return self.store.get_stream_ids(overlay_ids)
+        except Exception as e:
+            logging.error(f"Error looking up overlay streams: {e}")
+            raise
+    
+    @blocking_pool.offload
+    @timed_operation('get_by_id')
     def get_by_id(self, overlay_id):
         """Get overlay by ID"""
         try:
-            if self.collection is not None:
-                # Use MongoDB
-                overlay = self.collection.find_one({'_id': ObjectId(overlay_id)})
-                if overlay:
-                    overlay['_id'] = str(overlay['_id'])
-                return overlay
-            else:
-                # Use in-memory storage
-                return self._memory_store.get(overlay_id)
+            return self.store.get_by_id(overlay_id)
         except Exception as e:
             logging.error(f"Error fetching overlay by ID: {e}")
             raise
     
-    def update(self, overlay_id, update_data):
-        """Update overlay by ID"""
+    @blocking_pool.offload
+    @timed_operation('update')
+    def update(self, overlay_id, update_data, expected_rev=None, partial=False):
+        """
+        Update overlay by ID in a single atomic operation
+        
+        Args:
+            overlay_id: Overlay ID
+            update_data: Fields to set
+            expected_rev: Only update if the overlay is still at this revision
+            partial: Treat nested objects as patches (e.g. only position.x) instead of replacing them
+        
+        Returns:
+            dict: The updated overlay, or None if it doesn't exist
+        
+        Raises:
+            RevisionMismatch: If the overlay is no longer at expected_rev
+        """
+        fields = flatten_patch(update_data) if partial else dict(update_data)
+        fields.pop('rev', None)
+        fields.pop('_id', None)
         try:
-            if self.collection is not None:
-                # Use MongoDB
-                result = self.collection.update_one(
-                    {'_id': ObjectId(overlay_id)},
-                    {'$set': update_data}
-                )
-                return result.modified_count > 0
-            else:
-                # Use in-memory storage
-                if overlay_id in self._memory_store:
-                    self._memory_store[overlay_id].update(update_data)
-                    logging.info(f"Updated overlay in memory: {overlay_id}")
-                    return True
-                return False
+            with self._writable_store() as store:
+                overlay = store.update(overlay_id, fields, expected_rev=expected_rev)
+        except RevisionMismatch:
+            raise
         except Exception as e:
             logging.error(f"Error updating overlay: {e}")
             raise
+        if overlay is not None:
+            self._bump_version()
+        return overlay
     
-    def delete(self, overlay_id):
-        """Delete overlay by ID"""
+    @blocking_pool.offload
+    @timed_operation('bulk_update')
+    def bulk_update(self, updates, live=False):
+        """
+        Apply field updates to many overlays at once
+        
+        Args:
+            updates: Dict mapping overlay ID to the fields to set
+            live: Positions/sizes of drags in progress; rev and the collection version
+                are left alone, so clients' If-Match revisions stay valid mid-drag
+                (call mark_changed once the drag has settled)
+        
+        Returns:
+            int: Number of overlays modified
+        """
         try:
-            if self.collection is not None:
-                # Use MongoDB
-                result = self.collection.delete_one({'_id': ObjectId(overlay_id)})
-                return result.deleted_count > 0
-            else:
-                # Use in-memory storage
-                if overlay_id in self._memory_store:
-                    del self._memory_store[overlay_id]
-                    logging.info(f"Deleted overlay from memory: {overlay_id}")
-                    return True
-                return False
+            with self._writable_store() as store:
+                modified = store.bulk_update(updates, bump_rev=not live)
+        except Exception as e:
+            logging.error(f"Error bulk updating overlays: {e}")
+            raise
+        if modified and not live:
+            self._bump_version()
+        return modified
+    
+    def mark_changed(self):
+        """Invalidate cached reads after writes made with live=True"""
+        self._bump_version()
+    
+    @blocking_pool.offload
+    @timed_operation('delete')
+    def delete(self, overlay_id, expected_rev=None):
+        """
+        Delete overlay by ID in a single atomic operation
+        
+        Returns:
+            dict: The deleted overlay, or None if it didn't exist
+        
+        Raises:
+            RevisionMismatch: If the overlay is no longer at expected_rev
+        """
+        try:
+            with self._writable_store() as store:
+                overlay = store.delete(overlay_id, expected_rev=expected_rev)
+        except RevisionMismatch:
+            raise
         except Exception as e:
             logging.error(f"Error deleting overlay: {e}")
             raise
+        if overlay is not None:
+            self._bump_version()
+        return overlay
+    
+    @blocking_pool.offload
+    @timed_operation('delete_many')
+    def delete_many(self, overlay_ids):
+        """Delete many overlays in one operation; returns the number deleted"""
+        if not overlay_ids:
+            return 0
+        try:
+            with self._writable_store() as store:
+                deleted = store.delete_many(overlay_ids)
+        except Exception as e:
+            logging.error(f"Error deleting overlays: {e}")
+            raise
+        if deleted:
+            self._bump_version()
+        return deleted
@@ -0,0 +1,415 @@
+"""
+Server-side overlay burn-in
+Draws a stream's text and image overlays into an extra HLS rendition with
+FFmpeg's drawtext/overlay filters, so kiosks and wall displays can play a plain
+stream. Edits reach the running filter graph through FFmpeg's zmq command
+interface; only changes the graph has no room for (a new image, more text
+overlays than reserved slots) relaunch FFmpeg. Images are fetched and decoded
+through the image proxy and handed to FFmpeg as local files, so FFmpeg never
+opens an overlay URL itself
+"""
+
+import threading
+import hashlib
+import logging
+import time
+import io
+import os
+from config import Config
+from overlay_images import overlay_images, ImageFetchError
+
+# Text as the frontend canvas draws it: 16px, inset 5px into the overlay box
+TEXT_FONT_SIZE = 16
+TEXT_INSET = 5
+# Relaunches that apply overlay edits happen at most this often per stream (seconds)
+MIN_RELAUNCH_INTERVAL = 5
+# How long to wait for FFmpeg to answer a filter command (milliseconds)
+COMMAND_TIMEOUT_MS = 1000
+# URL schemes image overlays may be burned in from
+IMAGE_SCHEMES = ('http', 'https')
+# How often unused decoded images are cleaned up (seconds)
+IMAGE_PRUNE_INTERVAL = 60
+
+def _escape(value, special):
+    return ''.join(f'\\{char}' if char in special else char for char in str(value))
+
+def option_value(value):
+    """Escape a value for a filter option string (e.g. a drawtext reinit argument)"""
+    return _escape(value, "\\':")
+
+def filter_value(value):
+    """Escape a value for a filter option inside a filter graph, which unescapes it twice"""
+    return _escape(option_value(value), "\\'[],;")
+
+def output_size():
+    """(width, height) of the composited rendition: the canvas aspect ratio at OVERLAY_BURNIN_HEIGHT"""
+    height = Config.OVERLAY_BURNIN_HEIGHT // 2 * 2
+    width = round(height * Config.OVERLAY_CANVAS_WIDTH / Config.OVERLAY_CANVAS_HEIGHT / 2) * 2
+    return width, height
+
+def render_spec(overlay):
+    """Pixel geometry of an overlay in the composited rendition, or None if it can't be drawn"""
+    try:
+        position, size = overlay['position'], overlay['size']
+        scale = output_size()[1] / Config.OVERLAY_CANVAS_HEIGHT
+        spec = {'id': overlay['_id'], 'type': overlay['type'], 'content': overlay['content']}
+        if overlay['type'] == 'text':
+            spec.update(
+                x=round((position['x'] + TEXT_INSET) * scale),
+                y=round((position['y'] + TEXT_INSET) * scale),
+                fontsize=max(1, round(TEXT_FONT_SIZE * scale))
+            )
+        else:
+            spec.update(
+                x=round(position['x'] * scale),
+                y=round(position['y'] * scale),
+                width=max(1, round(size['width'] * scale)),
+                height=max(1, round(size['height'] * scale))
+            )
+        return spec
+    except (KeyError, TypeError):
+        return None
+
+def image_dir():
+    """Directory decoded burn-in images are kept in"""
+    return os.path.abspath(os.path.join(Config.STREAM_STATE_DIR, 'overlay_images'))
+
+def image_path(url):
+    """Local file an image overlay's decoded source is kept in for FFmpeg"""
+    name = hashlib.sha256(url.encode()).hexdigest()[:32]
+    return os.path.join(image_dir(), f"{name}.png")
+
+def touch_image(path):
+    """Mark a decoded image as used now; False if it doesn't exist"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def fetch_image(url):
+    """
+    Fetch, decode and re-encode an image overlay's source into a local PNG (once per URL
+    while the file is in use, see prune_images)
+
+    Returns:
+        str: Path of the file, or None if the URL isn't a usable http(s) image
+    """
+    path = image_path(url)
+    if touch_image(path):
+        return path
+    scheme = url.split(':', 1)[0].lower()
+    if scheme not in IMAGE_SCHEMES:
+        logging.warning(f"Not burning in image overlay with unsupported URL scheme '{scheme}'")
+        return None
+    if not overlay_images.available():
+        logging.warning("Not burning in image overlays: Pillow is not installed")
+        return None
+    width, height = output_size()
+    try:
+        data, content_type = overlay_images.fit(url, width, height)
+    except ImageFetchError as e:
+        logging.warning(f"Not burning in image overlay: {e}")
+        return None
+    if content_type != 'image/png':
+        # Re-encoded losslessly so every burned-in image is a PNG FFmpeg can loop
+        from PIL import Image
+        output = io.BytesIO()
+        Image.open(io.BytesIO(data)).save(output, 'PNG')
+        data = output.getvalue()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside and renamed, so FFmpeg never opens a partial file
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+def prune_images(keep):
+    """
+    Remove decoded images unused for OVERLAY_BURNIN_IMAGE_MAX_AGE, then the least recently
+    used ones while the directory is over OVERLAY_BURNIN_IMAGE_CACHE_MB
+
+    Args:
+        keep: Paths of images in this process's applied layouts; they are marked as used
+            (so other workers sharing STREAM_STATE_DIR keep them too) and never removed
+
+    Returns:
+        int: Number of files removed
+    """
+    directory = image_dir()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for path in keep:
+        touch_image(path)
+    cutoff = time.time() - Config.OVERLAY_BURNIN_IMAGE_MAX_AGE
+    total = 0
+    candidates = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        total += stat.st_size
+        # Temporary files are only left behind by interrupted writes
+        if path not in keep and (name.endswith('.png') or stat.st_mtime < cutoff):
+            candidates.append((stat.st_mtime, stat.st_size, path))
+
+    budget = Config.OVERLAY_BURNIN_IMAGE_CACHE_MB * 1024 * 1024
+    removed = 0
+    for mtime, size, path in sorted(candidates):
+        if mtime >= cutoff and total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logging.info(f"Removed {removed} unused burn-in images")
+    return removed
+
+def command_address(output_name):
+    """zmq endpoint a source's FFmpeg process takes filter commands on"""
+    return f"ipc://{os.path.abspath(os.path.join(Config.STREAM_STATE_DIR, output_name))}.zmq"
+
+def _text_options(spec):
+    """drawtext options that change with the overlay (the rest is fixed when the graph is built)"""
+    return {'text': spec['content'], 'x': spec['x'], 'y': spec['y'], 'fontsize': spec['fontsize']}
+
+def _place_texts(slots, texts):
+    """Give text overlays slots, keeping each in the slot it already has"""
+    by_id = {spec['id']: spec for spec in texts}
+    placed = [by_id.pop(spec['id'], None) if spec else None for spec in slots]
+    placed += [None] * max(0, len(texts) - len(placed))
+    free = (i for i, spec in enumerate(placed) if spec is None)
+    for spec in texts:
+        if spec['id'] in by_id:
+            placed[next(free)] = spec
+    return placed
+
+class OverlayCompositor:
+    def __init__(self, manager, interval):
+        self.manager = manager
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        # output name -> zmq REQ socket, and -> (overlay version, process) last synced
+        self._sockets = {}
+        self._synced = {}
+        self._relaunched_at = {}
+
+    def live_commands(self):
+        """Whether overlay edits can be sent to running FFmpeg processes (pyzmq and an FFmpeg with libzmq)"""
+        try:
+            import zmq  # noqa: F401
+        except ImportError:
+            return False
+        from capabilities import capability_probe
+        return bool(capability_probe.get_status()['ffmpeg_zmq'])
+
+    def layout(self, stream_id, previous=None):
+        """
+        Overlay layout baked into a source's filter graph
+
+        Returns:
+            dict: {'stream_id', 'live', 'texts': one spec or None per drawtext slot, 'images': specs}
+        """
+        from routes import overlay_model
+        specs = [render_spec(overlay) for overlay in overlay_model.get_all(stream_id=stream_id)]
+        specs = [spec for spec in specs if spec is not None]
+        texts = sorted((spec for spec in specs if spec['type'] == 'text'), key=lambda spec: spec['id'])
+        images = sorted((spec for spec in specs if spec['type'] == 'image'), key=lambda spec: spec['id'])
+        # Images that can't be fetched or decoded are left out instead of breaking the filter graph
+        for spec in images:
+            spec['file'] = fetch_image(spec['content'])
+        images = [spec for spec in images if spec['file'] is not None]
+        slots = previous['texts'] if previous else [None] * Config.OVERLAY_BURNIN_TEXT_SLOTS
+        return {
+            'stream_id': stream_id,
+            'live': previous['live'] if previous else self.live_commands(),
+            'texts': _place_texts(slots, texts),
+            'images': images
+        }
+
+    def filter_graph(self, output_name, layout):
+        """
+        Filter graph drawing a layout over the input video
+
+        Returns:
+            tuple: (filter_complex string, label of the composited output)
+        """
+        width, height = output_size()
+        # Letterboxed like the browser player, so canvas coordinates land on the same pixels
+        chain = [
+            f"[0:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease",
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+            'setsar=1',
+        ]
+        if layout['live']:
+            os.makedirs(Config.STREAM_STATE_DIR, exist_ok=True)
+            chain.append(f"zmq=bind_address={filter_value(command_address(output_name))}")
+        scale = height / Config.OVERLAY_CANVAS_HEIGHT
+        font = (
+            f"fontfile={filter_value(Config.OVERLAY_BURNIN_FONT)}" if Config.OVERLAY_BURNIN_FONT else 'font=Sans'
+        )
+        for slot, spec in enumerate(layout['texts']):
+            # Unused slots stay in the graph, disabled, so text overlays can be added live
+            options = _text_options(spec) if spec else {'text': ' ', 'x': 0, 'y': 0, 'fontsize': 1}
+            chain.append(
+                f"drawtext@text{slot}={font}:expansion=none:fontcolor=white:box=1:boxcolor=black@0.5:"
+                f"boxborderw={max(1, round(TEXT_INSET * scale))}:"
+                + ':'.join(f"{key}={filter_value(value)}" for key, value in options.items())
+                + ('' if spec else ':enable=0')
+            )
+        graph = [','.join(chain) + '[base0]']
+        label = 'base0'
+        for i, spec in enumerate(layout['images']):
+            # Looping keeps frames flowing through the scale filter, so resizes apply live
+            graph.append(
+                f"movie=filename={filter_value(spec['file'])}:loop=0,setpts=N/FRAME_RATE/TB,"
+                f"scale@size{i}=w={spec['width']}:h={spec['height']}[image{i}]"
+            )
+            graph.append(f"[{label}][image{i}]overlay@position{i}=x={spec['x']}:y={spec['y']}[base{i + 1}]")
+            label = f"base{i + 1}"
+        return ';'.join(graph), label
+
+    def _commands(self, previous, layout):
+        """
+        Filter commands turning the applied layout into a new one
+
+        Returns:
+            list: 'target command argument' strings, or None if FFmpeg must be relaunched
+        """
+        if not previous['live'] or len(layout['texts']) > len(previous['texts']):
+            return None
+        # Layouts persisted by older versions name no file, so they're relaunched once
+        if [(spec['id'], spec.get('file')) for spec in layout['images']] != \
+                [(spec['id'], spec.get('file')) for spec in previous['images']]:
+            return None
+        commands = []
+        for slot, (old, new) in enumerate(zip(previous['texts'], layout['texts'])):
+            target = f"drawtext@text{slot}"
+            if new is None:
+                if old is not None:
+                    commands.append(f"{target} enable 0")
+                continue
+            if old is None or _text_options(old) != _text_options(new):
+                options = ':'.join(f"{key}={option_value(value)}" for key, value in _text_options(new).items())
+                commands.append(f"{target} reinit {options}")
+            if old is None:
+                commands.append(f"{target} enable 1")
+        for i, (old, new) in enumerate(zip(previous['images'], layout['images'])):
+            for key, command in (('width', 'w'), ('height', 'h')):
+                if old[key] != new[key]:
+                    commands.append(f"scale@size{i} {command} {new[key]}")
+            for key in ('x', 'y'):
+                if old[key] != new[key]:
+                    commands.append(f"overlay@position{i} {key} {new[key]}")
+        return commands
+
+    def _send(self, output_name, commands):
+        """Send filter commands over zmq; False if FFmpeg didn't answer (it may be restarting)"""
+        import zmq
+        socket = self._sockets.get(output_name)
+        if socket is None:
+            socket = zmq.Context.instance().socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.RCVTIMEO, COMMAND_TIMEOUT_MS)
+            socket.setsockopt(zmq.SNDTIMEO, COMMAND_TIMEOUT_MS)
+            socket.connect(command_address(output_name))
+            self._sockets[output_name] = socket
+        try:
+            for command in commands:
+                socket.send_string(command)
+                reply = socket.recv_string()
+                if not reply.startswith('0 '):
+                    # Rejected by the filter (e.g. a missing font); retrying won't help
+                    logging.warning(f"Overlay command '{command}' failed on stream {output_name}: {reply}")
+        except zmq.ZMQError as e:
+            # A REQ socket that missed a reply is stuck; start over with a new one
+            logging.warning(f"Overlay commands to stream {output_name} not delivered: {e}")
+            self._close(output_name)
+            return False
+        return True
+
+    def _close(self, output_name):
+        socket = self._sockets.pop(output_name, None)
+        if socket is not None:
+            socket.close(linger=0)
+
+    def sync(self, stream, version):
+        """Bring one source's composited rendition up to date with its overlays"""
+        manager = self.manager
+        with manager._lock:
+            process = stream['process']
+            previous = stream['burn_in']
+            if stream['ffmpeg_cmd'] is None or process is None:
+                return  # Not launched yet; the launch bakes in the current overlays
+        output_name = stream['output_name']
+        if self._synced.get(output_name) == (version, process):
+            return
+        layout = self.layout(previous['stream_id'], previous)
+        if layout == previous:
+            self._synced[output_name] = (version, process)
+            return
+
+        commands = self._commands(previous, layout)
+        if commands is None:
+            if time.time() - self._relaunched_at.get(output_name, 0) < MIN_RELAUNCH_INTERVAL:
+                return  # Picked up again on a later tick
+            # Make room for every text overlay, plus the reserved spare slots
+            if len(layout['texts']) > len(previous['texts']):
+                layout['texts'] += [None] * Config.OVERLAY_BURNIN_TEXT_SLOTS
+            with manager._lock:
+                manager.set_burn_in_layout(stream, layout)
+            self._relaunched_at[output_name] = time.time()
+            self._close(output_name)
+            manager.relaunch(stream, 'applying overlay changes')
+            return
+        if commands and not self._send(output_name, commands):
+            return
+        with manager._lock:
+            manager.set_burn_in_layout(stream, layout)
+        self._synced[output_name] = (version, process)
+
+    def start(self):
+        """Start following overlay edits (idempotent)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='overlay-burnin', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from routes import overlay_model
+        pruned_at = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.manager._lock:
+                    sources = [
+                        stream for stream in {id(s): s for s in self.manager.active_streams.values()}.values()
+                        if stream['burn_in']
+                    ]
+                names = {stream['output_name'] for stream in sources}
+                for name in set(self._sockets) - names:
+                    self._close(name)
+                for name in set(self._synced) - names:
+                    self._synced.pop(name)
+                    self._relaunched_at.pop(name, None)
+                version = overlay_model.version
+                for stream in sources:
+                    self.sync(stream, version)
+                if time.monotonic() - pruned_at >= IMAGE_PRUNE_INTERVAL:
+                    pruned_at = time.monotonic()
+                    with self.manager._lock:
+                        keep = {spec.get('file') for stream in sources for spec in stream['burn_in']['images']}
+                    keep.discard(None)
+                    prune_images(keep)
+            except Exception as e:
+                logging.error(f"Error updating burned-in overlays: {e}")
@@ -0,0 +1,128 @@
+"""
+Coalescing layer for high-frequency overlay events
+Keeps only the latest position/size per overlay and flushes them to clients
+as one batched frame per tick instead of rebroadcasting every drag event
+"""
+
+import threading
+import logging
+import time
+from config import Config
+
+# Field carried by each coalesced event type
+COALESCED_FIELDS = {
+    'overlay_moved': 'position',
+    'overlay_resized': 'size',
+}
+
+class OverlayCoalescer:
+    def __init__(self, tick_hz=30):
+        self.tick_hz = tick_hz
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._socketio = None
+        self._task = None
+        self._seq = 0
+        self._stats = {
+            'events_received': 0,
+            'events_merged': 0,
+            'frames_sent': 0,
+            'overlays_sent': 0,
+        }
+
+    @property
+    def enabled(self):
+        """Coalescing is disabled with a tick rate of 0"""
+        return self.tick_hz > 0
+
+    def start(self, socketio):
+        """Start the flush loop as a SocketIO background task (idempotent)"""
+        with self._lock:
+            if self._task is not None:
+                return
+            self._socketio = socketio
+            self._task = socketio.start_background_task(self._run)
+        logging.info(f"Overlay coalescer flushing at {self.tick_hz} Hz")
+
+    def submit(self, event, data, origin=None, room=None):
+        """
+        Record a move/resize event, merging it with any pending one
+
+        Args:
+            event: 'overlay_moved' or 'overlay_resized'
+            data: Event payload with 'id' and 'position' or 'size'
+            origin: Session ID of the sender, echoed so it can ignore its own updates
+            room: Socket.IO room the frame is delivered to (None broadcasts to everyone)
+        """
+        field = COALESCED_FIELDS[event]
+        overlay_id = data.get('id')
+        if overlay_id is None or field not in data:
+            return
+
+        with self._lock:
+            self._stats['events_received'] += 1
+            key = (room, overlay_id)
+            # Field -> (latest value, its sender); a move and a resize may come from different clients
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = {}
+                self._pending[key] = entry
+            else:
+                self._stats['events_merged'] += 1
+            entry[field] = (data[field], origin)
+
+    def flush(self):
+        """Emit pending changes as one frame per room; returns the number of overlays sent"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending = self._pending
+            self._pending = {}
+            self._seq += 1
+            seq = self._seq
+
+        frames = {}
+        for (room, overlay_id), entry in pending.items():
+            # One change per sender, so each client skips exactly the values it sent itself
+            changes = {}
+            for field, (value, origin) in entry.items():
+                changes.setdefault(origin, {'id': overlay_id, 'origin': origin})[field] = value
+            frames.setdefault(room, []).extend(changes.values())
+
+        for room, overlays in frames.items():
+            origins = {change['origin'] for change in overlays}
+            # When a single client produced every change in the frame it doesn't need the echo
+            skip_sid = origins.pop() if len(origins) == 1 else None
+            self._socketio.emit('overlay_batch', {
+                'seq': seq,
+                'overlays': overlays
+            }, to=room, skip_sid=skip_sid)
+
+        with self._lock:
+            self._stats['frames_sent'] += len(frames)
+            self._stats['overlays_sent'] += len(pending)
+        return len(pending)
+
+    def _run(self):
+        """Flush loop"""
+        interval = 1.0 / self.tick_hz
+        while True:
+            started = time.monotonic()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing overlay batch: {e}")
+            self._socketio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def get_stats(self):
+        """Get coalescing counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        stats['tick_hz'] = self.tick_hz
+        received = stats['events_received']
+        stats['merge_ratio'] = round(stats['events_merged'] / received, 3) if received else 0.0
+        return stats
+
+# Global overlay coalescer instance
+overlay_coalescer = OverlayCoalescer(tick_hz=Config.OVERLAY_TICK_HZ)
@@ -0,0 +1,366 @@
+"""
+Overlay image proxy
+Fetches an image overlay's source URL once, resizes it to fit the overlay's
+size (times the viewer's device pixel ratio) and keeps the results in a
+byte-bounded LRU, optionally spilling evicted images to disk, so viewers
+download a 120x60 thumbnail instead of a multi-megabyte original
+"""
+
+import urllib.request
+import urllib.error
+import http.client
+import ipaddress
+import mimetypes
+import threading
+import hashlib
+import math
+import logging
+import socket
+import io
+import os
+from collections import OrderedDict
+from blocking_pool import blocking_pool
+from config import Config
+
+# Device pixel ratios are rounded to halves in this range, bounding the variants per overlay
+MAX_DPR = 3
+FETCH_TIMEOUT = 10
+FETCH_SCHEMES = ('http', 'https', 'data')
+JPEG_QUALITY = 85
+
+class ImageFetchError(Exception):
+    """The source image couldn't be fetched, isn't allowed or isn't an image"""
+
+def parse_dpr(value):
+    """Device pixel ratio from a query parameter, rounded to halves within 1..MAX_DPR"""
+    dpr = float(value)
+    if not math.isfinite(dpr):
+        raise ValueError("dpr must be a finite number")
+    return min(max(round(dpr * 2) / 2, 1), MAX_DPR)
+
+def _etag(data):
+    return hashlib.sha1(data).hexdigest()[:20]
+
+class ImageCache:
+    """
+    LRU of (bytes, content type, ETag) bounded by total size. Entries evicted from
+    memory are written to spill_dir, if set, which is bounded by max_disk_bytes
+    """
+
+    def __init__(self, max_bytes, spill_dir='', max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        # Spilled files, least recently used first: file stem -> (extension, size)
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            # File names are derived from the keys, so spilled images survive restarts
+            files = sorted(
+                (entry for entry in os.scandir(spill_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime
+            )
+            for entry in files:
+                stem, extension = os.path.splitext(entry.name)
+                self._disk[stem] = (extension, entry.stat().st_size)
+                self._disk_size += entry.stat().st_size
+            self._prune_disk()
+
+    @staticmethod
+    def _stem(prefix, key):
+        return f"{prefix}-{hashlib.sha1(repr(key).encode()).hexdigest()}"
+
+    def get(self, prefix, key):
+        """
+        Cached image stored under key
+
+        Returns:
+            tuple: (bytes, content type, ETag), or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1:]
+            stem = self._stem(prefix, key)
+            if stem not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(stem)
+            name = stem + self._disk[stem][0]
+        try:
+            with open(os.path.join(self.spill_dir, name), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                if stem in self._disk:
+                    self._drop_file(stem)
+                self.misses += 1
+            return None
+        entry = (data, mimetypes.guess_type(name)[0] or 'application/octet-stream', _etag(data))
+        with self._lock:
+            self.disk_hits += 1
+            self._store(prefix, key, entry, spilled=True)
+        return entry
+
+    def put(self, prefix, key, data, content_type):
+        """Cache an image; prefix groups keys for invalidate()"""
+        entry = (data, content_type, _etag(data))
+        with self._lock:
+            self._store(prefix, key, entry)
+        return entry
+
+    def _store(self, prefix, key, entry, spilled=False):
+        """Insert into memory, spilling what falls out (caller holds the lock)"""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        if len(entry[0]) > self.max_bytes:
+            if not spilled:
+                self._spill(prefix, key, entry)
+            return
+        self._entries[key] = (prefix, *entry)
+        self._size += len(entry[0])
+        while self._size > self.max_bytes:
+            evicted_key, (evicted_prefix, *evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted[0])
+            self._spill(evicted_prefix, evicted_key, evicted)
+
+    def _spill(self, prefix, key, entry):
+        if not self.spill_dir or len(entry[0]) > self.max_disk_bytes:
+            return
+        stem = self._stem(prefix, key)
+        if stem in self._disk:
+            self._disk.move_to_end(stem)
+            return
+        extension = mimetypes.guess_extension(entry[1]) or '.bin'
+        try:
+            with open(os.path.join(self.spill_dir, stem + extension), 'wb') as f:
+                f.write(entry[0])
+        except OSError as e:
+            logging.warning(f"Could not spill overlay image to disk: {e}")
+            return
+        self._disk[stem] = (extension, len(entry[0]))
+        self._disk_size += len(entry[0])
+        self._prune_disk()
+
+    def _prune_disk(self):
+        while self._disk_size > self.max_disk_bytes:
+            self._drop_file(next(iter(self._disk)))
+
+    def _drop_file(self, stem):
+        extension, size = self._disk.pop(stem)
+        self._disk_size -= size
+        try:
+            os.remove(os.path.join(self.spill_dir, stem + extension))
+        except OSError:
+            pass
+
+    def invalidate(self, prefix):
+        """Drop every entry stored under a prefix, in memory and on disk"""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == prefix]:
+                self._size -= len(self._entries.pop(key)[1])
+            for stem in [stem for stem in self._disk if stem.startswith(f"{prefix}-")]:
+                self._drop_file(stem)
+
+    def get_stats(self):
+        """Occupancy and hit counts"""
+        with self._lock:
+            return {
+                'images': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'disk_images': len(self._disk),
+                'disk_bytes': self._disk_size,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
+
+def _public_address(host, port):
+    """
+    Resolve a host to an address the proxy may connect to
+
+    Loopback, private, link-local and other non-global addresses are refused unless
+    OVERLAY_IMAGE_ALLOW_PRIVATE is set, so overlays can't reach internal services
+    """
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ImageFetchError(f"Cannot resolve {host}: {e}")
+    for family, _, _, _, address in addresses:
+        ip = ipaddress.ip_address(address[0].split('%', 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if Config.OVERLAY_IMAGE_ALLOW_PRIVATE or (ip.is_global and not ip.is_multicast):
+            return address[0]
+    raise ImageFetchError(f"{host} does not resolve to a public address")
+
+def _connect_public(address, timeout, source_address=None):
+    """socket.create_connection() to the vetted address, so DNS can't change between check and connect"""
+    host, port = address
+    return socket.create_connection((_public_address(host, port), port), timeout, source_address)
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+def _build_opener():
+    """
+    URL opener for http(s) and data URLs only, without environment proxies; every
+    connection, redirects included, goes through _connect_public
+    """
+    opener = urllib.request.OpenerDirector()
+    for handler in (
+        _PublicHTTPHandler(), _PublicHTTPSHandler(), urllib.request.DataHandler(),
+        urllib.request.HTTPRedirectHandler(), urllib.request.HTTPDefaultErrorHandler(),
+        urllib.request.HTTPErrorProcessor(), urllib.request.UnknownHandler()
+    ):
+        opener.add_handler(handler)
+    return opener
+
+class OverlayImageProxy:
+    def __init__(self, cache, max_source_bytes):
+        self.cache = cache
+        self.max_source_bytes = max_source_bytes
+        self._opener = _build_opener()
+        # URL -> lock, so concurrent misses fetch a source once
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Whether images can be served: only bodies Pillow decoded and re-encoded ever are"""
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def _fetch(self, url):
+        """Download a source image, at most max_source_bytes"""
+        scheme = url.split(':', 1)[0].lower()
+        if scheme not in FETCH_SCHEMES:
+            raise ImageFetchError(f"Unsupported image URL scheme '{scheme}'")
+        request = urllib.request.Request(url, headers={'User-Agent': 'rtsp-overlay-image-proxy'})
+        try:
+            with self._opener.open(request, timeout=FETCH_TIMEOUT) as response:
+                data = response.read(self.max_source_bytes + 1)
+        except (urllib.error.URLError, OSError, ValueError, http.client.HTTPException) as e:
+            raise ImageFetchError(f"Could not fetch {url}: {e}")
+        if len(data) > self.max_source_bytes:
+            raise ImageFetchError(f"Image at {url} is larger than {self.max_source_bytes} bytes")
+        return data
+
+    def source(self, url):
+        """Source bytes of a URL, fetched once and then served from the cache"""
+        with self._lock:
+            lock = self._fetching.setdefault(url, threading.Lock())
+        with lock:
+            try:
+                # Checked under the lock: a concurrent request may have just fetched it
+                cached = self.cache.get('source', url)
+                if cached is not None:
+                    return cached[0]
+                data = self._fetch(url)
+                # Raw upstream bytes are only ever decoded, never served
+                self.cache.put('source', url, data, 'application/octet-stream')
+                return data
+            finally:
+                with self._lock:
+                    self._fetching.pop(url, None)
+
+    def _render(self, data, width, height):
+        """
+        Decode a source and fit it into width x height (never enlarging it)
+
+        Returns:
+            tuple: (JPEG for JPEG sources, PNG otherwise, content type)
+        """
+        from PIL import Image
+        try:
+            image = Image.open(io.BytesIO(data))
+            source_format = image.format
+            image.draft('RGB', (width, height))  # JPEG: decode at a reduced scale
+            image.thumbnail((width, height), Image.LANCZOS)
+        except Exception as e:
+            # Anything Pillow can't decode (HTML, SVG, truncated files, decompression bombs)
+            raise ImageFetchError(f"Not a decodable image: {e}")
+        output = io.BytesIO()
+        if source_format == 'JPEG' and image.mode in ('RGB', 'L'):
+            image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+            return output.getvalue(), 'image/jpeg'
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            image = image.convert('RGBA')
+        image.save(output, 'PNG', optimize=True)
+        return output.getvalue(), 'image/png'
+
+    @blocking_pool.offload
+    def get(self, overlay, dpr=1):
+        """
+        An image overlay's image, fitted to its size at a device pixel ratio
+
+        Returns:
+            tuple: (bytes, content type, ETag)
+
+        Raises:
+            ImageFetchError: The source couldn't be fetched or decoded
+        """
+        width = max(1, round(overlay['size']['width'] * dpr))
+        height = max(1, round(overlay['size']['height'] * dpr))
+        # Content and size are part of the key, so an edit never serves a stale variant
+        key = (overlay['_id'], overlay['content'], width, height)
+        cached = self.cache.get(overlay['_id'], key)
+        if cached is not None:
+            return cached
+        data, content_type = self._render(self.source(overlay['content']), width, height)
+        return self.cache.put(overlay['_id'], key, data, content_type)
+
+    def fit(self, url, width, height):
+        """
+        A URL's image decoded and fitted into width x height, without caching the result
+
+        Returns:
+            tuple: (bytes, content type)
+
+        Raises:
+            ImageFetchError: The source couldn't be fetched or decoded
+        """
+        return self._render(self.source(url), width, height)
+
+    def invalidate(self, overlay_id):
+        """Forget every resized variant of an overlay"""
+        self.cache.invalidate(overlay_id)
+
+    def get_stats(self):
+        return self.cache.get_stats()
+
+overlay_images = OverlayImageProxy(
+    ImageCache(
+        int(Config.OVERLAY_IMAGE_CACHE_MB * 1024 * 1024),
+        Config.OVERLAY_IMAGE_CACHE_DIR,
+        int(Config.OVERLAY_IMAGE_DISK_CACHE_MB * 1024 * 1024)
+    ),
+    int(Config.OVERLAY_IMAGE_MAX_SOURCE_MB * 1024 * 1024)
+)
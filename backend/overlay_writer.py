@@ -0,0 +1,128 @@
+"""
+Write-behind persistence for live overlay positions and sizes
+Keeps the latest value from drag/resize events in memory and flushes dirty
+overlays to storage in one bulk write per interval or when a threshold is hit.
+Flushes leave overlay revisions alone; the collection version is bumped once
+an interval passes without new values, i.e. when the drag has settled
+"""
+
+import threading
+import logging
+
+class OverlayWriteBehind:
+    def __init__(self, overlay_model, flush_interval=0.5, flush_threshold=100):
+        self.overlay_model = overlay_model
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+        # Live values written since the collection version was last bumped
+        self._unpublished = False
+        self._stats = {
+            'events_buffered': 0,
+            'flushes': 0,
+            'overlays_written': 0,
+            'errors': 0,
+        }
+
+    def _ensure_started(self):
+        """Start the flush thread on first use"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name='overlay-write-behind', daemon=True)
+                self._thread.start()
+
+    def record(self, overlay_id, fields):
+        """
+        Remember the latest live values of an overlay
+
+        Args:
+            overlay_id: Overlay ID
+            fields: Dict of fields to persist, e.g. {'position': {...}}
+        """
+        with self._lock:
+            self._dirty.setdefault(overlay_id, {}).update(fields)
+            self._stats['events_buffered'] += 1
+            dirty_count = len(self._dirty)
+        self._ensure_started()
+        if dirty_count >= self.flush_threshold:
+            self._wakeup.set()
+
+    def discard(self, overlay_id, fields=None):
+        """Drop pending values superseded by a direct update or delete"""
+        with self._lock:
+            pending = self._dirty.get(overlay_id)
+            if pending is None:
+                return
+            if fields is None:
+                del self._dirty[overlay_id]
+                return
+            for field in fields:
+                pending.pop(field, None)
+            if not pending:
+                del self._dirty[overlay_id]
+
+    def flush(self):
+        """Write all dirty overlays in one bulk operation; returns the number written"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                dirty = self._dirty
+                self._dirty = {}
+
+            try:
+                written = self.overlay_model.bulk_update(dirty, live=True)
+            except Exception as e:
+                logging.error(f"Error flushing overlay positions: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+                    # Re-queue, keeping any newer values that arrived meanwhile
+                    for overlay_id, fields in dirty.items():
+                        self._dirty[overlay_id] = {**fields, **self._dirty.get(overlay_id, {})}
+                return 0
+
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['overlays_written'] += len(dirty)
+                self._unpublished = True
+            return written
+
+    def publish(self):
+        """Bump the collection version if live values were written since the last bump"""
+        with self._lock:
+            unpublished, self._unpublished = self._unpublished, False
+        if unpublished:
+            self.overlay_model.mark_changed()
+
+    def _run(self):
+        """Flush loop"""
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self._lock:
+                pending = bool(self._dirty)
+            if pending:
+                self.flush()
+            else:
+                self.publish()
+
+    def stop(self):
+        """Stop the flush loop and write out anything still pending"""
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+        self.publish()
+
+    def get_stats(self):
+        """Get write-behind counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._dirty)
+        return stats
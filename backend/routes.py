@@ -1,10 +1,32 @@
-from flask import Blueprint, request, jsonify
-from models import Overlay
+from flask import Blueprint, request, jsonify, current_app, stream_with_context
+from models import Overlay, RevisionMismatch
+from overlay_writer import OverlayWriteBehind
+from overlay_images import overlay_images, parse_dpr, ImageFetchError
+from config import Config
 from bson import ObjectId
+import metrics
+import itertools
 import logging
 
 api = Blueprint('api', __name__)
+metrics.instrument_blueprint(api)
 overlay_model = Overlay()
+overlay_writer = OverlayWriteBehind(
+    overlay_model,
+    flush_interval=Config.OVERLAY_FLUSH_INTERVAL,
+    flush_threshold=Config.OVERLAY_FLUSH_THRESHOLD
+)
+
+# Serialized overlay lists keyed by stream filter: {stream_id: (version, body)}
+_overlay_list_cache = {}
+_OVERLAY_LIST_CACHE_SIZE = 256
+
+# Paginated listing
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+PROJECTABLE_FIELDS = {'type', 'content', 'position', 'size', 'stream_id'}
+# Maintained by the server; ignored when clients send them
+READ_ONLY_FIELDS = ('_id', 'rev')
 
 def validate_overlay_data(data, is_update=False):
     """Validate overlay data"""
@@ -18,6 +40,10 @@ def validate_overlay_data(data, is_update=False):
         if 'content' not in data or not isinstance(data['content'], str) or not data['content'].strip():
             errors.append("Content must be a non-empty string")
     
+    if 'stream_id' in data:
+        if not isinstance(data['stream_id'], str) or not data['stream_id'].strip():
+            errors.append("Stream ID must be a non-empty string")
+    
     if not is_update or 'position' in data:
         if 'position' not in data or not isinstance(data['position'], dict):
             errors.append("Position must be an object")
@@ -42,6 +68,59 @@ def validate_overlay_data(data, is_update=False):
     
     return errors
 
+def validate_overlay_patch(data):
+    """Validate a partial update where position/size may carry only some of their keys"""
+    scalars = {key: value for key, value in data.items() if key not in ('position', 'size')}
+    errors = validate_overlay_data(scalars, is_update=True)
+    
+    nested = {
+        'position': ('Position', ('x', 'y')),
+        'size': ('Size', ('width', 'height')),
+    }
+    for field, (label, keys) in nested.items():
+        if field not in data:
+            continue
+        value = data[field]
+        if not isinstance(value, dict) or not value:
+            errors.append(f"{label} must be a non-empty object")
+            continue
+        unknown = set(value) - set(keys)
+        if unknown:
+            errors.append(f"{label} only accepts {' and '.join(keys)}")
+        elif not all(isinstance(v, (int, float)) for v in value.values()):
+            errors.append(f"{label} values must be numbers")
+        elif field == 'size' and any(v <= 0 for v in value.values()):
+            errors.append("Size dimensions must be positive numbers")
+    
+    return errors
+
+def _expected_rev():
+    """Parse the optional If-Match header into an overlay revision"""
+    header = request.headers.get('If-Match')
+    if not header or header.strip() == '*':
+        return None, None
+    tag = header.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    try:
+        return int(tag.strip('"')), None
+    except ValueError:
+        return None, (jsonify({'error': 'If-Match must be an overlay revision'}), 400)
+
+def _overlay_response(body, overlay, status=200):
+    """JSON response carrying the overlay's revision as its ETag"""
+    response = jsonify(body)
+    response.status_code = status
+    response.set_etag(str(overlay.get('rev', 0)))
+    return response
+
+def _revision_conflict(error):
+    """412 response for an edit based on a stale revision"""
+    return _overlay_response({
+        'error': 'Overlay was modified by someone else',
+        'overlay': error.current
+    }, error.current, 412)
+
 @api.route('/overlays', methods=['POST'])
 def create_overlay():
     """Create a new overlay"""
@@ -56,24 +135,104 @@ def create_overlay():
         if errors:
             return jsonify({'errors': errors}), 400
         
+        data.setdefault('stream_id', Config.DEFAULT_STREAM_ID)
+        
         # Create overlay
         overlay_id = overlay_model.create(data)
         
         return jsonify({
             'message': 'Overlay created successfully',
-            'id': overlay_id
+            'id': overlay_id,
+            'rev': data['rev']
         }), 201
         
     except Exception as e:
         logging.error(f"Error in create_overlay: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def _stream_overlay_page(first, overlays, limit):
+    """
+    Encode one page of overlays as chunked JSON straight from the cursor
+    
+    The caller fetches the first overlay, so a failing query is still answered with a 500;
+    if the cursor fails once the 200 is sent, the body still ends as valid JSON, with an
+    'error' and the 'next_after' to resume from
+    """
+    encode = current_app.json.dumps
+    
+    yield '{"overlays": ['
+    last_id = None
+    next_after = None
+    error = None
+    try:
+        if first is not None:
+            for count, overlay in enumerate(itertools.chain([first], overlays)):
+                if count == limit:
+                    next_after = last_id
+                    break
+                yield (', ' if count else '') + encode(overlay)
+                last_id = overlay['_id']
+    except Exception as e:
+        logging.error(f"Error streaming overlays: {e}")
+        error = 'Internal server error'
+        next_after = last_id
+    yield '], "next_after": ' + encode(next_after) + (', "error": ' + encode(error) if error else '') + '}'
+
 @api.route('/overlays', methods=['GET'])
 def get_all_overlays():
-    """Get all overlays"""
+    """Get all overlays, optionally filtered with ?stream_id=
+    
+    Passing ?after=, ?limit= or ?fields= returns a streamed page instead
+    """
     try:
-        overlays = overlay_model.get_all()
-        return jsonify({'overlays': overlays}), 200
+        stream_id = request.args.get('stream_id')
+        
+        if any(arg in request.args for arg in ('after', 'limit', 'fields')):
+            after = request.args.get('after') or None
+            if after is not None and not ObjectId.is_valid(after):
+                return jsonify({'error': 'Invalid after cursor'}), 400
+            
+            try:
+                limit = int(request.args.get('limit', DEFAULT_PAGE_LIMIT))
+            except ValueError:
+                return jsonify({'error': 'Limit must be an integer'}), 400
+            if not 1 <= limit <= MAX_PAGE_LIMIT:
+                return jsonify({'error': f'Limit must be between 1 and {MAX_PAGE_LIMIT}'}), 400
+            
+            fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+            unknown = set(fields) - PROJECTABLE_FIELDS
+            if unknown:
+                return jsonify({'error': f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+            
+            # One extra document tells whether another page follows
+            overlays = overlay_model.iter_overlays(stream_id=stream_id, after=after, limit=limit + 1, fields=fields or None)
+            first = next(overlays, None)
+            return current_app.response_class(
+                stream_with_context(_stream_overlay_page(first, overlays, limit)),
+                status=200,
+                mimetype='application/json'
+            )
+        
+        version = overlay_model.version
+        
+        # Unchanged since the client's copy - no query, no encoding
+        if request.if_none_match.contains(version):
+            response = current_app.response_class(status=304)
+        else:
+            cached = _overlay_list_cache.get(stream_id)
+            if cached is not None and cached[0] == version:
+                body = cached[1]
+            else:
+                overlays = overlay_model.get_all(stream_id=stream_id)
+                body = current_app.json.dumps({'overlays': overlays})
+                if len(_overlay_list_cache) >= _OVERLAY_LIST_CACHE_SIZE:
+                    _overlay_list_cache.clear()
+                _overlay_list_cache[stream_id] = (version, body)
+            response = current_app.response_class(body, status=200, mimetype='application/json')
+        
+        response.set_etag(version)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
         logging.error(f"Error in get_all_overlays: {e}")
@@ -92,15 +251,60 @@ def get_overlay(overlay_id):
         if not overlay:
             return jsonify({'error': 'Overlay not found'}), 404
         
-        return jsonify({'overlay': overlay}), 200
+        return _overlay_response({'overlay': overlay}, overlay)
         
     except Exception as e:
         logging.error(f"Error in get_overlay: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
-@api.route('/overlays/<overlay_id>', methods=['PUT'])
+@api.route('/overlay-images/<overlay_id>', methods=['GET'])
+def get_overlay_image(overlay_id):
+    """Image overlay's picture resized to fit its size; ?dpr=2 for high-density screens"""
+    try:
+        # Validate ObjectId format
+        if not ObjectId.is_valid(overlay_id):
+            return jsonify({'error': 'Invalid overlay ID format'}), 400
+        
+        try:
+            dpr = parse_dpr(request.args.get('dpr', 1))
+        except ValueError:
+            return jsonify({'error': 'dpr must be a number'}), 400
+        
+        overlay = overlay_model.get_by_id(overlay_id)
+        
+        if not overlay:
+            return jsonify({'error': 'Overlay not found'}), 404
+        # Legacy overlays may have no type at all
+        if overlay.get('type') != 'image':
+            return jsonify({'error': 'Overlay is not an image'}), 404
+        if not overlay_images.available():
+            return jsonify({'error': 'Overlay images need Pillow, which is not installed'}), 503
+        
+        try:
+            data, content_type, etag = overlay_images.get(overlay, dpr)
+        except ImageFetchError as e:
+            # The reason (e.g. a refused address or connect error) stays in the log
+            logging.warning(f"Overlay image {overlay_id} unavailable: {e}")
+            return jsonify({'error': 'Could not fetch overlay image'}), 502
+        
+        response = current_app.response_class(data, status=200, mimetype=content_type)
+        response.set_etag(etag)
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        # Revalidated with If-None-Match, so an edited overlay shows its new picture right away
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        logging.error(f"Error in get_overlay_image: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@api.route('/overlays/<overlay_id>', methods=['PUT', 'PATCH'])
 def update_overlay(overlay_id):
-    """Update overlay by ID"""
+    """Update overlay by ID
+    
+    PUT replaces the given fields; PATCH merges nested objects so e.g. only
+    position.x can be sent. Send If-Match: <rev> to reject concurrent edits.
+    """
     try:
         # Validate ObjectId format
         if not ObjectId.is_valid(overlay_id):
@@ -111,27 +315,41 @@ def update_overlay(overlay_id):
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
+        if all(key in READ_ONLY_FIELDS for key in data):
+            return jsonify({'error': 'No fields to update'}), 400
+        
         # Log the incoming data for debugging
         logging.info(f"Update request for {overlay_id}: {data}")
         
+        partial = request.method == 'PATCH'
+        
         # Validate data
-        errors = validate_overlay_data(data, is_update=True)
+        errors = validate_overlay_patch(data) if partial else validate_overlay_data(data, is_update=True)
         if errors:
             logging.error(f"Validation errors: {errors}")
             return jsonify({'errors': errors}), 400
         
-        # Check if overlay exists
-        existing_overlay = overlay_model.get_by_id(overlay_id)
-        if not existing_overlay:
-            return jsonify({'error': 'Overlay not found'}), 404
+        expected_rev, error = _expected_rev()
+        if error:
+            return error
+        
+        # Pending live values must not overwrite this update later
+        overlay_writer.discard(overlay_id, data.keys())
         
         # Update overlay
-        success = overlay_model.update(overlay_id, data)
+        try:
+            overlay = overlay_model.update(overlay_id, data, expected_rev=expected_rev, partial=partial)
+        except RevisionMismatch as e:
+            return _revision_conflict(e)
         
-        if success:
-            return jsonify({'message': 'Overlay updated successfully'}), 200
-        else:
-            return jsonify({'error': 'Failed to update overlay'}), 500
+        if not overlay:
+            return jsonify({'error': 'Overlay not found'}), 404
+        
+        # Variants of the old picture or size can't be requested again; free their cache space
+        if 'content' in data or 'size' in data:
+            overlay_images.invalidate(overlay_id)
+        
+        return _overlay_response({'message': 'Overlay updated successfully', 'overlay': overlay}, overlay)
         
     except Exception as e:
         logging.error(f"Error in update_overlay: {e}", exc_info=True)
@@ -145,19 +363,166 @@ def delete_overlay(overlay_id):
         if not ObjectId.is_valid(overlay_id):
             return jsonify({'error': 'Invalid overlay ID format'}), 400
         
-        # Check if overlay exists
-        existing_overlay = overlay_model.get_by_id(overlay_id)
-        if not existing_overlay:
-            return jsonify({'error': 'Overlay not found'}), 404
+        expected_rev, error = _expected_rev()
+        if error:
+            return error
+        
+        overlay_writer.discard(overlay_id)
         
         # Delete overlay
-        success = overlay_model.delete(overlay_id)
+        try:
+            overlay = overlay_model.delete(overlay_id, expected_rev=expected_rev)
+        except RevisionMismatch as e:
+            return _revision_conflict(e)
         
-        if success:
-            return jsonify({'message': 'Overlay deleted successfully'}), 200
-        else:
-            return jsonify({'error': 'Failed to delete overlay'}), 500
+        if not overlay:
+            return jsonify({'error': 'Overlay not found'}), 404
+        
+        overlay_images.invalidate(overlay_id)
+        
+        return jsonify({'message': 'Overlay deleted successfully'}), 200
         
     except Exception as e:
         logging.error(f"Error in delete_overlay: {e}")
         return jsonify({'error': 'Internal server error'}), 500
+
+# Bulk endpoints
+MAX_BULK_ITEMS = 500
+
+def _get_bulk_items(data, key):
+    """Extract the list of items from a bulk request body, or return an error response"""
+    if not data or not isinstance(data.get(key), list) or not data[key]:
+        return None, (jsonify({'error': f"'{key}' must be a non-empty list"}), 400)
+    if len(data[key]) > MAX_BULK_ITEMS:
+        return None, (jsonify({'error': f"At most {MAX_BULK_ITEMS} items per request"}), 400)
+    return data[key], None
+
+def _bulk_status(results, ok_status):
+    """201/200 when every item succeeded, 400 when none did, 207 otherwise"""
+    succeeded = sum(1 for result in results if 'errors' not in result and 'error' not in result)
+    if succeeded == len(results):
+        return ok_status
+    return 400 if succeeded == 0 else 207
+
+def _emit_bulk(action, items_by_stream):
+    """Send one combined Socket.IO event per affected stream"""
+    from socketio_manager import socketio, stream_room
+    for stream_id, items in items_by_stream.items():
+        socketio.emit('overlays_bulk', {'action': action, 'overlays': items}, to=stream_room(stream_id))
+
+@api.route('/overlays/bulk', methods=['POST'])
+def bulk_create_overlays():
+    """Create many overlays in one request"""
+    try:
+        items, error = _get_bulk_items(request.get_json(silent=True), 'overlays')
+        if error:
+            return error
+        
+        results = []
+        valid = []
+        for index, item in enumerate(items):
+            errors = validate_overlay_data(item) if isinstance(item, dict) else ['Overlay must be an object']
+            if errors:
+                results.append({'index': index, 'errors': errors})
+            else:
+                item.setdefault('stream_id', Config.DEFAULT_STREAM_ID)
+                results.append({'index': index})
+                valid.append((index, item))
+        
+        overlay_ids = overlay_model.create_many([item for _, item in valid])
+        
+        created = {}
+        for (index, item), overlay_id in zip(valid, overlay_ids):
+            results[index]['id'] = overlay_id
+            created.setdefault(item['stream_id'], []).append({**item, '_id': overlay_id})
+        _emit_bulk('created', created)
+        
+        return jsonify({'results': results, 'created': len(overlay_ids)}), _bulk_status(results, 201)
+        
+    except Exception as e:
+        logging.error(f"Error in bulk_create_overlays: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@api.route('/overlays/bulk', methods=['PUT'])
+def bulk_update_overlays():
+    """Update many overlays in one request; each item carries its 'id' and the fields to set"""
+    try:
+        items, error = _get_bulk_items(request.get_json(silent=True), 'overlays')
+        if error:
+            return error
+        
+        results = []
+        updates = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not ObjectId.is_valid(item.get('id', '')):
+                results.append({'index': index, 'error': 'Invalid overlay ID format'})
+                continue
+            fields = {key: value for key, value in item.items() if key != 'id' and key not in READ_ONLY_FIELDS}
+            errors = validate_overlay_data(fields, is_update=True) if fields else ['No fields to update']
+            if errors:
+                results.append({'index': index, 'id': item['id'], 'errors': errors})
+                continue
+            results.append({'index': index, 'id': item['id']})
+            updates.setdefault(item['id'], {}).update(fields)
+        
+        streams = overlay_model.get_stream_ids(list(updates))
+        for result in results:
+            if 'id' in result and 'errors' not in result and result['id'] not in streams:
+                result['error'] = 'Overlay not found'
+                updates.pop(result['id'], None)
+        
+        for overlay_id, fields in updates.items():
+            overlay_writer.discard(overlay_id, fields.keys())
+        overlay_model.bulk_update(updates)
+        for overlay_id, fields in updates.items():
+            if 'content' in fields or 'size' in fields:
+                overlay_images.invalidate(overlay_id)
+        
+        updated = {}
+        for overlay_id, fields in updates.items():
+            stream_id = fields.get('stream_id', streams[overlay_id])
+            updated.setdefault(stream_id, []).append({'id': overlay_id, **fields})
+        _emit_bulk('updated', updated)
+        
+        return jsonify({'results': results, 'updated': len(updates)}), _bulk_status(results, 200)
+        
+    except Exception as e:
+        logging.error(f"Error in bulk_update_overlays: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@api.route('/overlays/bulk', methods=['DELETE'])
+def bulk_delete_overlays():
+    """Delete many overlays in one request"""
+    try:
+        overlay_ids, error = _get_bulk_items(request.get_json(silent=True), 'ids')
+        if error:
+            return error
+        
+        valid_ids = [overlay_id for overlay_id in overlay_ids if isinstance(overlay_id, str) and ObjectId.is_valid(overlay_id)]
+        streams = overlay_model.get_stream_ids(valid_ids)
+        
+        results = []
+        for index, overlay_id in enumerate(overlay_ids):
+            if overlay_id not in valid_ids:
+                results.append({'index': index, 'error': 'Invalid overlay ID format'})
+            elif overlay_id not in streams:
+                results.append({'index': index, 'id': overlay_id, 'error': 'Overlay not found'})
+            else:
+                results.append({'index': index, 'id': overlay_id})
+        
+        for overlay_id in streams:
+            overlay_writer.discard(overlay_id)
+        deleted = overlay_model.delete_many(list(streams))
+        for overlay_id in streams:
+            overlay_images.invalidate(overlay_id)
+        
+        removed = {}
+        for overlay_id, stream_id in streams.items():
+            removed.setdefault(stream_id, []).append({'id': overlay_id})
+        _emit_bulk('deleted', removed)
+        
+        return jsonify({'results': results, 'deleted': deleted}), _bulk_status(results, 200)
+        
+    except Exception as e:
+        logging.error(f"Error in bulk_delete_overlays: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
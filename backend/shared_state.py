@@ -0,0 +1,214 @@
+"""
+State shared by backend workers
+A SQLite file in WAL mode holding which worker owns each FFmpeg source, the
+stream IDs mapped onto it, a status snapshot per source and worker heartbeats,
+so any worker on the host can list, start and stop any stream. Also keeps
+shared counters (e.g. the overlay collection version used for caching)
+"""
+
+import threading
+import logging
+import sqlite3
+import socket
+import json
+import time
+import os
+from contextlib import contextmanager
+from config import Config
+
+class SharedState:
+    def __init__(self, path, worker_id=None):
+        self.path = path
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sources ('
+                'output_name TEXT PRIMARY KEY, owner TEXT NOT NULL, source_key TEXT NOT NULL, '
+                'entry TEXT NOT NULL, info TEXT, updated REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS sources_source_key ON sources (source_key)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS stream_ids ('
+                'stream_id TEXT PRIMARY KEY, output_name TEXT NOT NULL, claimed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            # Identifies this state file, so counters restarting in a recreated file never repeat a value
+            conn.execute(
+                "INSERT OR IGNORE INTO counters (name, value) VALUES ('epoch', ?)", (int(time.time() * 1000),)
+            )
+        self.epoch = self.counter('epoch')
+        logging.info(f"Sharing stream state as worker {self.worker_id}: {path}")
+
+    def _connection(self):
+        """One connection per thread; SQLite connections must not be shared"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; takes the write lock up front so read-modify-write is atomic"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Workers
+
+    def heartbeat(self):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)', (self.worker_id, time.time())
+            )
+
+    def leave(self):
+        """Drop this worker's heartbeat so the others take over its sources right away"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM workers WHERE worker_id = ?', (self.worker_id,))
+
+    def live_workers(self):
+        cutoff = time.time() - Config.WORKER_TIMEOUT
+        rows = self._connection().execute('SELECT worker_id FROM workers WHERE heartbeat >= ?', (cutoff,))
+        return {worker_id for worker_id, in rows}
+
+    # Stream IDs
+
+    def claim(self, stream_id, output_name):
+        """Map a stream ID onto a source; False if another request got the ID first"""
+        now = time.time()
+        with self._transaction() as conn:
+            # A claim whose source never got saved (its worker died while starting it) lapses
+            conn.execute(
+                'DELETE FROM stream_ids WHERE stream_id = ? AND claimed_at < ? '
+                'AND output_name NOT IN (SELECT output_name FROM sources)',
+                (stream_id, now - Config.WORKER_TIMEOUT)
+            )
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO stream_ids (stream_id, output_name, claimed_at) VALUES (?, ?, ?)',
+                (stream_id, output_name, now)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, stream_id):
+        """Unmap a stream ID; the owner of its source stops FFmpeg once no IDs are left"""
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM stream_ids WHERE stream_id = ?', (stream_id,)).rowcount == 1
+
+    def lookup(self, stream_id):
+        """(output name, owner) of a stream ID, or None"""
+        row = self._connection().execute(
+            'SELECT s.output_name, s.owner FROM stream_ids i JOIN sources s ON s.output_name = i.output_name '
+            'WHERE i.stream_id = ?', (stream_id,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def stream_ids(self, output_names=None):
+        """{output name: set of stream IDs}, for all sources or the given ones"""
+        rows = self._connection().execute('SELECT stream_id, output_name FROM stream_ids')
+        result = {name: set() for name in output_names or ()}
+        for stream_id, output_name in rows:
+            if output_names is None or output_name in result:
+                result.setdefault(output_name, set()).add(stream_id)
+        return result
+
+    # Sources
+
+    def output_names(self):
+        """Output names in use by any worker, including IDs claimed for sources not yet saved"""
+        conn = self._connection()
+        names = {name for name, in conn.execute('SELECT output_name FROM sources')}
+        return names | {name for name, in conn.execute('SELECT output_name FROM stream_ids')}
+
+    def find_source(self, source_key):
+        """Output name of a live, non-failed source with these settings on any worker, or None"""
+        live = self.live_workers()
+        rows = self._connection().execute(
+            'SELECT output_name, owner, entry FROM sources WHERE source_key = ?', (json.dumps(list(source_key)),)
+        )
+        for output_name, owner, entry in rows:
+            if owner in live and json.loads(entry)['state'] != 'failed':
+                return output_name
+        return None
+
+    def save(self, entries):
+        """
+        Replace this worker's sources
+
+        Args:
+            entries: Registry entries (see StreamRegistry) with an extra 'info' status snapshot
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            names = []
+            for entry in entries:
+                entry = dict(entry)
+                info = entry.pop('info')
+                names.append(entry['output_name'])
+                conn.execute(
+                    'INSERT OR REPLACE INTO sources (output_name, owner, source_key, entry, info, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (entry['output_name'], self.worker_id, json.dumps(list(entry['source_key'])),
+                     json.dumps(entry), json.dumps(info), now)
+                )
+            placeholders = ','.join('?' * len(names))
+            conn.execute(
+                f'DELETE FROM sources WHERE owner = ? AND output_name NOT IN ({placeholders})',
+                [self.worker_id, *names]
+            )
+
+    def sources(self):
+        """
+        Every source with its owner, entry, info snapshot and stream IDs
+
+        Returns:
+            list: [{'output_name', 'owner', 'entry', 'info', 'stream_ids'}]
+        """
+        stream_ids = self.stream_ids()
+        rows = self._connection().execute('SELECT output_name, owner, entry, info FROM sources')
+        return [
+            {
+                'output_name': output_name,
+                'owner': owner,
+                'entry': json.loads(entry),
+                'info': json.loads(info) if info else None,
+                'stream_ids': stream_ids.get(output_name, set())
+            }
+            for output_name, owner, entry, info in rows
+        ]
+
+    def take_over(self, output_name, previous_owner):
+        """Become the owner of a dead worker's source; False if another worker was faster"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'UPDATE sources SET owner = ?, updated = ? WHERE output_name = ? AND owner = ?',
+                (self.worker_id, time.time(), output_name, previous_owner)
+            )
+            return cursor.rowcount == 1
+
+    # Counters
+
+    def counter(self, name):
+        row = self._connection().execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def increment(self, name):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO counters (name, value) VALUES (?, 1) '
+                'ON CONFLICT (name) DO UPDATE SET value = value + 1', (name,)
+            )
+
+shared_state = SharedState(Config.SHARED_STATE_DB, Config.WORKER_ID) if Config.SHARED_STATE_DB else None
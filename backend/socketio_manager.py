@@ -1,48 +1,135 @@
 """
 WebSocket manager for real-time overlay updates
+Clients join one room per stream so overlay events only reach viewers of that stream
 """
 
-from flask_socketio import SocketIO, emit
+from flask import request
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from functools import wraps
+from overlay_coalescer import overlay_coalescer
+from routes import overlay_writer, validate_overlay_data
+from stream_manager import stream_manager
+from blocking_pool import blocking_pool
+from config import Config
+import metrics
 import logging
 
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO that counts events received and emitted per event name for /metrics"""
+    
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+        
+        def decorator(handler):
+            @wraps(handler)
+            def counted(*args, **kwargs):
+                metrics.socketio_events.inc(direction='in', event=message)
+                return handler(*args, **kwargs)
+            register(counted)
+            return handler
+        return decorator
+    
+    def emit(self, event, *args, **kwargs):
+        # flask_socketio.emit() inside handlers also ends up here
+        metrics.socketio_events.inc(direction='out', event=event)
+        return super().emit(event, *args, **kwargs)
+
 # Initialize SocketIO
-socketio = SocketIO(cors_allowed_origins="*")
+socketio = InstrumentedSocketIO(cors_allowed_origins="*")
+
+# Stream each connected client is watching, keyed by session ID
+_client_streams = {}
+
+def stream_room(stream_id):
+    """Socket.IO room name for a stream"""
+    return f"stream:{stream_id}"
+
+def _join_stream(stream_id):
+    """Move the current client into the room of a stream"""
+    previous = _client_streams.get(request.sid)
+    if previous == stream_id:
+        return
+    if previous is not None:
+        leave_room(stream_room(previous))
+    join_room(stream_room(stream_id))
+    _client_streams[request.sid] = stream_id
+
+def _persist_live(data, field):
+    """Queue a live position/size for write-behind persistence"""
+    overlay_id = data.get('id')
+    if not isinstance(overlay_id, str) or field not in data:
+        return
+    if validate_overlay_data({field: data[field]}, is_update=True):
+        return
+    overlay_writer.record(overlay_id, {field: data[field]})
+
+def _event_room(data):
+    """Room an overlay event should be delivered to"""
+    stream_id = data.get('stream_id') or _client_streams.get(request.sid, Config.DEFAULT_STREAM_ID)
+    return stream_room(stream_id)
 
 @socketio.on('connect')
-def handle_connect():
-    """Handle client connection"""
-    logging.info("Client connected")
-    emit('connection_response', {'status': 'connected'})
+def handle_connect(auth=None):
+    """Handle client connection and join the requested stream room"""
+    stream_id = (auth or {}).get('stream_id') or request.args.get('stream_id') or Config.DEFAULT_STREAM_ID
+    _join_stream(stream_id)
+    logging.info(f"Client connected to stream {stream_id}")
+    emit('connection_response', {'status': 'connected', 'stream_id': stream_id})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
+    _client_streams.pop(request.sid, None)
     logging.info("Client disconnected")
 
+@socketio.on('join_stream')
+def handle_join_stream(data):
+    """Switch the client to another stream's room without reconnecting"""
+    stream_id = data.get('stream_id') or Config.DEFAULT_STREAM_ID
+    _join_stream(stream_id)
+    emit('stream_joined', {'stream_id': stream_id})
+
 @socketio.on('overlay_created')
 def handle_overlay_created(data):
-    """Broadcast overlay creation to all clients"""
+    """Broadcast overlay creation to viewers of the stream"""
     logging.info(f"Overlay created: {data.get('id', 'unknown')}")
-    emit('overlay_created', data, broadcast=True, include_self=False)
+    emit('overlay_created', data, to=_event_room(data), include_self=False)
 
 @socketio.on('overlay_updated')
 def handle_overlay_updated(data):
-    """Broadcast overlay update to all clients"""
+    """Broadcast overlay update to viewers of the stream"""
     logging.info(f"Overlay updated: {data.get('id', 'unknown')}")
-    emit('overlay_updated', data, broadcast=True, include_self=False)
+    emit('overlay_updated', data, to=_event_room(data), include_self=False)
 
 @socketio.on('overlay_deleted')
 def handle_overlay_deleted(data):
-    """Broadcast overlay deletion to all clients"""
+    """Broadcast overlay deletion to viewers of the stream"""
     logging.info(f"Overlay deleted: {data.get('id', 'unknown')}")
-    emit('overlay_deleted', data, broadcast=True, include_self=False)
+    emit('overlay_deleted', data, to=_event_room(data), include_self=False)
 
 @socketio.on('overlay_moved')
 def handle_overlay_moved(data):
-    """Broadcast overlay movement to all clients (real-time)"""
-    emit('overlay_moved', data, broadcast=True, include_self=False)
+    """Broadcast overlay movement to viewers of the stream (coalesced per tick)"""
+    _persist_live(data, 'position')
+    if not overlay_coalescer.enabled:
+        emit('overlay_moved', data, to=_event_room(data), include_self=False)
+        return
+    overlay_coalescer.start(socketio)
+    overlay_coalescer.submit('overlay_moved', data, origin=request.sid, room=_event_room(data))
 
 @socketio.on('overlay_resized')
 def handle_overlay_resized(data):
-    """Broadcast overlay resize to all clients (real-time)"""
-    emit('overlay_resized', data, broadcast=True, include_self=False)
+    """Broadcast overlay resize to viewers of the stream (coalesced per tick)"""
+    _persist_live(data, 'size')
+    if not overlay_coalescer.enabled:
+        emit('overlay_resized', data, to=_event_room(data), include_self=False)
+        return
+    overlay_coalescer.start(socketio)
+    overlay_coalescer.submit('overlay_resized', data, origin=request.sid, room=_event_room(data))
+
+def _forward_stream_event(event, data):
+    """Push stream_ready / stream_failed to every client, so players start as soon as a stream is up"""
+    # Stream events come from FFmpeg supervision threads
+    blocking_pool.call_in_loop(socketio.emit, event, data)
+
+stream_manager.on_event(_forward_stream_event)
@@ -0,0 +1,523 @@
+"""
+Storage backends for overlays
+Overlay (models.py) delegates to one of these; all of them take and return
+documents with string IDs
+"""
+
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
+from contextlib import contextmanager
+from config import Config
+import threading
+import sqlite3
+import logging
+import json
+import copy
+
+# Rows SQLiteStore.iter_overlays reads per query
+SQLITE_BATCH_SIZE = 500
+
+class RevisionMismatch(Exception):
+    """Raised when an overlay changed since the revision the client based its edit on"""
+    def __init__(self, current):
+        super().__init__(f"Overlay is at revision {current.get('rev', 0)}")
+        self.current = current
+
+def flatten_patch(patch, prefix=''):
+    """Turn a nested partial document into dotted field paths, e.g. {'position.x': 5}"""
+    flat = {}
+    for key, value in patch.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            flat.update(flatten_patch(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+def apply_fields(document, fields):
+    """Apply (possibly dotted) field assignments to a document held in Python"""
+    for path, value in fields.items():
+        target = document
+        *parents, leaf = path.split('.')
+        for parent in parents:
+            if not isinstance(target.get(parent), dict):
+                target[parent] = {}
+            target = target[parent]
+        target[leaf] = value
+
+def _in_stream(overlay, stream_id):
+    """Whether an overlay belongs to a stream (None matches every stream)"""
+    return stream_id is None or overlay.get('stream_id', Config.DEFAULT_STREAM_ID) == stream_id
+
+def _project(overlay, fields):
+    """Keep only _id and the requested fields"""
+    if not fields:
+        return overlay
+    return {key: overlay[key] for key in ('_id', *fields) if key in overlay}
+
+class OverlayStore:
+    """Interface implemented by every overlay storage backend"""
+    name = None
+
+    def create(self, overlay_data):
+        """Insert one overlay; returns its ID"""
+        raise NotImplementedError
+
+    def create_many(self, overlays):
+        """Insert many overlays; returns their IDs in input order"""
+        raise NotImplementedError
+
+    def iter_overlays(self, stream_id=None, after=None, limit=None, fields=None):
+        """Yield overlays in ID order, optionally filtered, paginated and projected"""
+        raise NotImplementedError
+
+    def get_all(self, stream_id=None):
+        """Get all overlays, optionally only those of one stream"""
+        return list(self.iter_overlays(stream_id=stream_id))
+
+    def get_by_id(self, overlay_id):
+        """Get one overlay, or None"""
+        raise NotImplementedError
+
+    def get_stream_ids(self, overlay_ids):
+        """Map the existing overlays among overlay_ids to their stream IDs"""
+        raise NotImplementedError
+
+    def update(self, overlay_id, fields, expected_rev=None):
+        """Set (possibly dotted) fields and bump rev atomically; returns the new overlay or None"""
+        raise NotImplementedError
+
+    def bulk_update(self, updates, bump_rev=True):
+        """Set fields on many overlays in one operation (bumping rev unless told not to); returns the number modified"""
+        raise NotImplementedError
+
+    def delete(self, overlay_id, expected_rev=None):
+        """Delete one overlay atomically; returns the deleted overlay or None"""
+        raise NotImplementedError
+
+    def delete_many(self, overlay_ids):
+        """Delete many overlays in one operation; returns the number deleted"""
+        raise NotImplementedError
+
+class MemoryStore(OverlayStore):
+    """Process-local dict, used until MongoDB is reachable; lost on restart"""
+    name = 'memory'
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def create(self, overlay_data):
+        # Real ObjectIds, so they stay unique when imported into MongoDB after a restart
+        with self._lock:
+            overlay_id = str(ObjectId())
+            self._documents[overlay_id] = {**overlay_data, '_id': overlay_id}
+        logging.info(f"Created overlay in memory: {overlay_id}")
+        return overlay_id
+
+    def create_many(self, overlays):
+        overlay_ids = []
+        with self._lock:
+            for overlay_data in overlays:
+                overlay_id = str(ObjectId())
+                self._documents[overlay_id] = {**overlay_data, '_id': overlay_id}
+                overlay_ids.append(overlay_id)
+        logging.info(f"Created {len(overlay_ids)} overlays in memory")
+        return overlay_ids
+
+    def iter_overlays(self, stream_id=None, after=None, limit=None, fields=None):
+        # ObjectId hex strings have a fixed width, so they sort as strings in creation order
+        with self._lock:
+            overlay_ids = sorted(self._documents)
+        count = 0
+        for overlay_id in overlay_ids:
+            if after is not None and overlay_id <= after:
+                continue
+            overlay = self._documents.get(overlay_id)
+            if overlay is None or not _in_stream(overlay, stream_id):
+                continue
+            if limit and count >= limit:
+                break
+            count += 1
+            yield _project(dict(overlay), fields)
+
+    def get_by_id(self, overlay_id):
+        overlay = self._documents.get(overlay_id)
+        return dict(overlay) if overlay is not None else None
+
+    def get_stream_ids(self, overlay_ids):
+        with self._lock:
+            return {
+                overlay_id: self._documents[overlay_id].get('stream_id', Config.DEFAULT_STREAM_ID)
+                for overlay_id in overlay_ids if overlay_id in self._documents
+            }
+
+    def update(self, overlay_id, fields, expected_rev=None):
+        with self._lock:
+            overlay = self._documents.get(overlay_id)
+            if overlay is None:
+                return None
+            if expected_rev is not None and overlay.get('rev', 0) != expected_rev:
+                raise RevisionMismatch(dict(overlay))
+            apply_fields(overlay, fields)
+            overlay['rev'] = overlay.get('rev', 0) + 1
+            logging.info(f"Updated overlay in memory: {overlay_id}")
+            return dict(overlay)
+
+    def bulk_update(self, updates, bump_rev=True):
+        modified = 0
+        with self._lock:
+            for overlay_id, fields in updates.items():
+                overlay = self._documents.get(overlay_id)
+                if overlay is not None:
+                    apply_fields(overlay, fields)
+                    if bump_rev:
+                        overlay['rev'] = overlay.get('rev', 0) + 1
+                    modified += 1
+        return modified
+
+    def delete(self, overlay_id, expected_rev=None):
+        with self._lock:
+            overlay = self._documents.get(overlay_id)
+            if overlay is None:
+                return None
+            if expected_rev is not None and overlay.get('rev', 0) != expected_rev:
+                raise RevisionMismatch(dict(overlay))
+            del self._documents[overlay_id]
+        logging.info(f"Deleted overlay from memory: {overlay_id}")
+        return overlay
+
+    def delete_many(self, overlay_ids):
+        deleted = 0
+        with self._lock:
+            for overlay_id in overlay_ids:
+                if self._documents.pop(overlay_id, None) is not None:
+                    deleted += 1
+        logging.info(f"Deleted {deleted} overlays from memory")
+        return deleted
+
+    def snapshot(self):
+        """Deep copy of all overlays, keyed by ID"""
+        with self._lock:
+            return copy.deepcopy(self._documents)
+
+    def drain(self):
+        """Take all overlays out of the store"""
+        with self._lock:
+            documents = self._documents
+            self._documents = {}
+        return documents
+
+class MongoStore(OverlayStore):
+    """MongoDB collection"""
+    name = 'mongodb'
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index('stream_id')
+
+    def _stream_query(self, stream_id):
+        """Build the MongoDB filter for overlays of a stream"""
+        if stream_id is None:
+            return {}
+        if stream_id == Config.DEFAULT_STREAM_ID:
+            # Overlays created before stream scoping belong to the default stream
+            return {'stream_id': {'$in': [stream_id, None]}}
+        return {'stream_id': stream_id}
+
+    def _rev_query(self, expected_rev):
+        """Filter matching an overlay at the expected revision (legacy documents are revision 0)"""
+        if expected_rev is None:
+            return {}
+        if expected_rev == 0:
+            return {'rev': {'$in': [0, None]}}
+        return {'rev': expected_rev}
+
+    def create(self, overlay_data):
+        result = self.collection.insert_one(overlay_data)
+        return str(result.inserted_id)
+
+    def create_many(self, overlays):
+        result = self.collection.insert_many(overlays)
+        return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+    def iter_overlays(self, stream_id=None, after=None, limit=None, fields=None):
+        # Documents are pulled from the cursor in batches
+        query = self._stream_query(stream_id)
+        if after is not None:
+            query['_id'] = {'$gt': ObjectId(after)}
+        projection = {field: 1 for field in fields} if fields else None
+        cursor = self.collection.find(query, projection).sort('_id', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        for overlay in cursor:
+            overlay['_id'] = str(overlay['_id'])
+            yield overlay
+
+    def get_all(self, stream_id=None):
+        overlays = list(self.collection.find(self._stream_query(stream_id)))
+        for overlay in overlays:
+            overlay['_id'] = str(overlay['_id'])
+        return overlays
+
+    def get_by_id(self, overlay_id):
+        overlay = self.collection.find_one({'_id': ObjectId(overlay_id)})
+        if overlay:
+            overlay['_id'] = str(overlay['_id'])
+        return overlay
+
+    def get_stream_ids(self, overlay_ids):
+        object_ids = [ObjectId(overlay_id) for overlay_id in overlay_ids]
+        cursor = self.collection.find({'_id': {'$in': object_ids}}, {'stream_id': 1})
+        return {
+            str(overlay['_id']): overlay.get('stream_id', Config.DEFAULT_STREAM_ID)
+            for overlay in cursor
+        }
+
+    def update(self, overlay_id, fields, expected_rev=None):
+        overlay = self.collection.find_one_and_update(
+            {'_id': ObjectId(overlay_id), **self._rev_query(expected_rev)},
+            {'$set': fields, '$inc': {'rev': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if overlay is None:
+            # Tell a stale revision apart from a missing overlay (failure path only)
+            current = self.get_by_id(overlay_id) if expected_rev is not None else None
+            if current is not None:
+                raise RevisionMismatch(current)
+            return None
+        overlay['_id'] = str(overlay['_id'])
+        return overlay
+
+    def bulk_update(self, updates, bump_rev=True):
+        # A single bulk_write for the whole batch
+        increment = {'$inc': {'rev': 1}} if bump_rev else {}
+        operations = [
+            UpdateOne({'_id': ObjectId(overlay_id)}, {'$set': fields, **increment})
+            for overlay_id, fields in updates.items()
+            if ObjectId.is_valid(overlay_id) and fields
+        ]
+        if not operations:
+            return 0
+        result = self.collection.bulk_write(operations, ordered=False)
+        return result.modified_count
+
+    def delete(self, overlay_id, expected_rev=None):
+        overlay = self.collection.find_one_and_delete(
+            {'_id': ObjectId(overlay_id), **self._rev_query(expected_rev)}
+        )
+        if overlay is None:
+            current = self.get_by_id(overlay_id) if expected_rev is not None else None
+            if current is not None:
+                raise RevisionMismatch(current)
+            return None
+        overlay['_id'] = str(overlay['_id'])
+        return overlay
+
+    def delete_many(self, overlay_ids):
+        object_ids = [ObjectId(overlay_id) for overlay_id in overlay_ids]
+        result = self.collection.delete_many({'_id': {'$in': object_ids}})
+        return result.deleted_count
+
+    def import_overlays(self, overlays, already_synced=None):
+        """
+        Copy overlays from another store, keeping their IDs and never overwriting other writes
+
+        New overlays are inserted (an ID that already exists is left alone); overlays from
+        already_synced are only replaced or deleted while MongoDB still holds the revision
+        that was imported
+
+        Args:
+            overlays: Overlays keyed by ID
+            already_synced: Overlays imported by an earlier pass; unchanged ones are
+                skipped and ones missing from overlays are deleted
+
+        Returns:
+            int: Number of overlays skipped because MongoDB holds a conflicting document
+        """
+        already_synced = already_synced or {}
+        operations = []
+        for overlay_id, overlay in overlays.items():
+            document = {**overlay, '_id': ObjectId(overlay_id)}
+            synced = already_synced.get(overlay_id)
+            if synced is None:
+                operations.append(InsertOne(document))
+            elif synced != overlay:
+                operations.append(ReplaceOne(
+                    {'_id': document['_id'], **self._rev_query(synced.get('rev', 0))}, document
+                ))
+        operations += [
+            DeleteOne({'_id': ObjectId(overlay_id), **self._rev_query(synced.get('rev', 0))})
+            for overlay_id, synced in already_synced.items() if overlay_id not in overlays
+        ]
+        if not operations:
+            return 0
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            applied = result.inserted_count + result.matched_count + result.deleted_count
+        except BulkWriteError as e:
+            # Duplicate IDs are conflicts to skip; anything else is a real failure
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            applied = e.details['nInserted'] + e.details['nMatched'] + e.details['nRemoved']
+        return len(operations) - applied
+
+class SQLiteStore(OverlayStore):
+    """
+    Embedded durable store: one SQLite file in WAL mode, so readers never block
+    writers and the data survives restarts without a MongoDB server
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS overlays ('
+                'id TEXT PRIMARY KEY, stream_id TEXT, rev INTEGER NOT NULL DEFAULT 0, doc TEXT NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS overlays_stream_id ON overlays (stream_id, id)')
+        logging.info(f"Using SQLite overlay storage: {path}")
+
+    def _connection(self):
+        """One connection per thread; SQLite connections must not be shared"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; takes the write lock up front so read-modify-write is atomic"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _stream_clause(self, stream_id):
+        """SQL condition and parameters for overlays of a stream"""
+        if stream_id is None:
+            return '1', []
+        if stream_id == Config.DEFAULT_STREAM_ID:
+            # Overlays created before stream scoping belong to the default stream
+            return '(stream_id = ? OR stream_id IS NULL)', [stream_id]
+        return 'stream_id = ?', [stream_id]
+
+    def _decode(self, overlay_id, doc):
+        overlay = json.loads(doc)
+        overlay['_id'] = overlay_id
+        return overlay
+
+    def _insert(self, conn, overlay_data):
+        overlay_id = str(ObjectId())
+        overlay = {key: value for key, value in overlay_data.items() if key != '_id'}
+        conn.execute(
+            'INSERT INTO overlays (id, stream_id, rev, doc) VALUES (?, ?, ?, ?)',
+            (overlay_id, overlay.get('stream_id'), overlay.get('rev', 0), json.dumps(overlay))
+        )
+        return overlay_id
+
+    def _write(self, conn, overlay_id, overlay):
+        overlay = {key: value for key, value in overlay.items() if key != '_id'}
+        conn.execute(
+            'UPDATE overlays SET stream_id = ?, rev = ?, doc = ? WHERE id = ?',
+            (overlay.get('stream_id'), overlay.get('rev', 0), json.dumps(overlay), overlay_id)
+        )
+
+    def create(self, overlay_data):
+        with self._transaction() as conn:
+            return self._insert(conn, overlay_data)
+
+    def create_many(self, overlays):
+        with self._transaction() as conn:
+            return [self._insert(conn, overlay_data) for overlay_data in overlays]
+
+    def iter_overlays(self, stream_id=None, after=None, limit=None, fields=None):
+        # Read in keyset batches that are fetched whole, so no cursor is held between yields
+        # and the generator may be resumed on another thread (each uses its own connection)
+        clause, params = self._stream_clause(stream_id)
+        remaining = limit or None
+        while remaining is None or remaining > 0:
+            batch = SQLITE_BATCH_SIZE if remaining is None else min(SQLITE_BATCH_SIZE, remaining)
+            sql = f'SELECT id, doc FROM overlays WHERE {clause}'
+            batch_params = list(params)
+            if after is not None:
+                sql += ' AND id > ?'
+                batch_params.append(after)
+            rows = self._connection().execute(f'{sql} ORDER BY id LIMIT ?', [*batch_params, batch]).fetchall()
+            for overlay_id, doc in rows:
+                yield _project(self._decode(overlay_id, doc), fields)
+            if len(rows) < batch:
+                return
+            after = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def get_by_id(self, overlay_id):
+        row = self._connection().execute('SELECT doc FROM overlays WHERE id = ?', (overlay_id,)).fetchone()
+        return self._decode(overlay_id, row[0]) if row else None
+
+    def get_stream_ids(self, overlay_ids):
+        if not overlay_ids:
+            return {}
+        placeholders = ', '.join('?' for _ in overlay_ids)
+        rows = self._connection().execute(
+            f'SELECT id, stream_id FROM overlays WHERE id IN ({placeholders})', list(overlay_ids)
+        )
+        return {overlay_id: stream_id or Config.DEFAULT_STREAM_ID for overlay_id, stream_id in rows}
+
+    def update(self, overlay_id, fields, expected_rev=None):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT doc FROM overlays WHERE id = ?', (overlay_id,)).fetchone()
+            if row is None:
+                return None
+            overlay = self._decode(overlay_id, row[0])
+            if expected_rev is not None and overlay.get('rev', 0) != expected_rev:
+                raise RevisionMismatch(overlay)
+            apply_fields(overlay, fields)
+            overlay['rev'] = overlay.get('rev', 0) + 1
+            self._write(conn, overlay_id, overlay)
+            return overlay
+
+    def bulk_update(self, updates, bump_rev=True):
+        modified = 0
+        with self._transaction() as conn:
+            for overlay_id, fields in updates.items():
+                row = conn.execute('SELECT doc FROM overlays WHERE id = ?', (overlay_id,)).fetchone()
+                if row is None:
+                    continue
+                overlay = self._decode(overlay_id, row[0])
+                apply_fields(overlay, fields)
+                if bump_rev:
+                    overlay['rev'] = overlay.get('rev', 0) + 1
+                self._write(conn, overlay_id, overlay)
+                modified += 1
+        return modified
+
+    def delete(self, overlay_id, expected_rev=None):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT doc FROM overlays WHERE id = ?', (overlay_id,)).fetchone()
+            if row is None:
+                return None
+            overlay = self._decode(overlay_id, row[0])
+            if expected_rev is not None and overlay.get('rev', 0) != expected_rev:
+                raise RevisionMismatch(overlay)
+            conn.execute('DELETE FROM overlays WHERE id = ?', (overlay_id,))
+            return overlay
+
+    def delete_many(self, overlay_ids):
+        if not overlay_ids:
+            return 0
+        placeholders = ', '.join('?' for _ in overlay_ids)
+        with self._transaction() as conn:
+            cursor = conn.execute(f'DELETE FROM overlays WHERE id IN ({placeholders})', list(overlay_ids))
+            return cursor.rowcount
@@ -4,90 +4,899 @@ Handles FFmpeg processes for converting RTSP streams to HLS
 """
 
 import subprocess
+import json
+import re
 import os
 import logging
 import signal
+import threading
+import time
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+from stream_telemetry import StreamTelemetry
+import hls_playlist
+from stream_supervisor import StreamSupervisor
+from stream_scheduler import StreamScheduler
+from stream_registry import StreamRegistry, AdoptedProcess, registry_entry, restore_entry
+from shared_state import shared_state
+from dvr import DvrRecorder
+from overlay_burnin import OverlayCompositor
+from blocking_pool import blocking_pool
+from config import Config
+
+# How often (seconds) a starting stream's output is checked for its first playlist
+READY_POLL_INTERVAL = 0.1
+
+# Codecs HLS players accept as-is, so they can be copied instead of re-encoded
+HLS_VIDEO_CODECS = {'h264'}
+HLS_AUDIO_CODECS = {'aac', 'mp3'}
+CODEC_MODES = ('auto', 'copy', 'transcode')
+
+# HLS latency profiles; encoder settings only apply when video is re-encoded
+LATENCY_PROFILES = {
+    'standard': {
+        'hls_time': 2,
+        'hls_list_size': 5,
+        'segment_type': 'mpegts',
+        'input_args': [],
+        'encoder_args': [],
+    },
+    'low': {
+        'hls_time': 1,
+        'hls_list_size': 6,
+        'segment_type': 'fmp4',
+        'input_args': ['-fflags', 'nobuffer', '-flags', 'low_delay'],
+        'encoder_args': [
+            '-preset', 'veryfast',
+            '-tune', 'zerolatency',
+            # One keyframe per segment so segments can be cut at exactly hls_time
+            '-force_key_frames', 'expr:gte(t,n_forced*1)',
+            '-sc_threshold', '0',
+        ],
+    },
+}
+
+def probe_input(rtsp_url, timeout=10):
+    """
+    Probe the codecs of an input with ffprobe
+    
+    Returns:
+        dict: {'video': codec name or None, 'audio': codec name or None,
+            'height': video height or None}, or None if probing failed
+    """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,height',
+        '-of', 'json',
+        rtsp_url
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout, check=True)
+        streams = json.loads(result.stdout).get('streams', [])
+    except FileNotFoundError:
+        logging.warning("ffprobe not found, streams will be transcoded")
+        return None
+    except Exception as e:
+        logging.warning(f"Failed to probe {rtsp_url}: {e}")
+        return None
+    
+    codecs = {'video': None, 'audio': None, 'height': None}
+    for stream in streams:
+        codec_type = stream.get('codec_type')
+        if codec_type in ('video', 'audio') and codecs[codec_type] is None:
+            codecs[codec_type] = stream.get('codec_name')
+            if codec_type == 'video':
+                codecs['height'] = stream.get('height')
+    return codecs
+
+def normalize_rtsp_url(rtsp_url):
+    """
+    Canonical form of an RTSP URL, so different spellings of the same camera
+    address share one FFmpeg process
+    
+    Scheme and host are case-insensitive, 554 is the default port and a
+    trailing slash doesn't change the resource
+    """
+    parts = urlsplit(rtsp_url.strip())
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        host = f"[{host}]"  # IPv6 literal
+    if parts.port and parts.port != 554:
+        host = f"{host}:{parts.port}"
+    if parts.username is not None:
+        userinfo = parts.username + (f":{parts.password}" if parts.password is not None else '')
+        host = f"{userinfo}@{host}"
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip('/'), parts.query, ''))
+
+def parse_ladder(spec):
+    """
+    Parse an ABR ladder such as '1080:5000,720:2800,360:800'
+    
+    Returns:
+        list: [{'height': 1080, 'bitrate_kbps': 5000}, ...], tallest first
+    """
+    ladder = []
+    for rung in spec.split(','):
+        height, _, bitrate = rung.strip().partition(':')
+        if not height.isdigit() or not bitrate.isdigit():
+            raise ValueError(f"Invalid ABR ladder rung '{rung}', expected height:kbps")
+        ladder.append({'height': int(height), 'bitrate_kbps': int(bitrate)})
+    if not ladder:
+        raise ValueError("ABR ladder is empty")
+    return sorted(ladder, key=lambda rung: rung['height'], reverse=True)
 
 class StreamManager:
     def __init__(self, hls_output_dir='hls'):
         self.hls_output_dir = hls_output_dir
         self.active_streams = {}
+        # Running sources keyed by (normalized RTSP URL, codec mode, latency profile, ABR);
+        # every stream ID in a source's 'stream_ids' maps to the same dict in active_streams
+        self._sources = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+        self.supervisor = StreamSupervisor(self)
+        self.scheduler = StreamScheduler(self)
+        self.recorder = DvrRecorder(self, Config.DVR_DIR)
+        self.compositor = OverlayCompositor(self, Config.OVERLAY_BURNIN_INTERVAL)
+        # With adoption enabled, sources are persisted and FFmpeg outlives the backend process
+        self.registry = None
+        if Config.STREAM_ADOPT:
+            self.registry = StreamRegistry(os.path.join(Config.STREAM_STATE_DIR, 'streams.json'))
+        # In multi-worker mode sources are owned by one worker and visible to all of them
+        self.shared = shared_state
+        if self._detached_outputs:
+            Path(Config.STREAM_STATE_DIR).mkdir(parents=True, exist_ok=True)
         self._ensure_hls_directory()
     
+    @property
+    def _detached_outputs(self):
+        """Whether FFmpeg may outlive this process (adoption or takeover by another worker)"""
+        return self.registry is not None or self.shared is not None
+    
     def _ensure_hls_directory(self):
         """Create HLS output directory if it doesn't exist"""
         Path(self.hls_output_dir).mkdir(parents=True, exist_ok=True)
         logging.info(f"HLS output directory: {os.path.abspath(self.hls_output_dir)}")
     
-    def start_stream(self, stream_id, rtsp_url):
+    def _select_codecs(self, codec_mode, input_codecs):
         """
-        Start converting an RTSP stream to HLS
-        
-        Args:
-            stream_id: Unique identifier for the stream
-            rtsp_url: RTSP URL to convert
+        Decide whether to copy or re-encode each track
         
         Returns:
-            dict: Stream information including HLS URL
+            tuple: (mode name, FFmpeg codec arguments)
         """
-        if stream_id in self.active_streams:
-            logging.warning(f"Stream {stream_id} is already running")
-            return self.get_stream_info(stream_id)
+        if codec_mode == 'copy':
+            video_copy = audio_copy = True
+        elif codec_mode == 'transcode' or input_codecs is None:
+            video_copy = audio_copy = False
+        else:
+            video_copy = input_codecs['video'] in HLS_VIDEO_CODECS
+            audio_copy = input_codecs['audio'] is None or input_codecs['audio'] in HLS_AUDIO_CODECS
         
-        output_path = os.path.join(self.hls_output_dir, f"{stream_id}.m3u8")
+        codec_args = [
+            '-c:v', 'copy' if video_copy else 'libx264',
+            '-c:a', 'copy' if audio_copy else 'aac',
+        ]
+        if video_copy and audio_copy:
+            mode = 'passthrough'
+        elif video_copy:
+            mode = 'video_passthrough'
+        else:
+            mode = 'transcode'
+        return mode, codec_args
+    
+    def _build_ffmpeg_cmd(self, stream_id, rtsp_url, codec_args, profile, output_path, burn_in=None):
+        """
+        Build the FFmpeg command for RTSP to HLS conversion
+        
+        With a burn_in layout (see OverlayCompositor.layout) a second output,
+        {stream_id}_overlay.m3u8, gets the overlays drawn in
+        """
+        settings = LATENCY_PROFILES[profile]
+        video_transcoded = codec_args[codec_args.index('-c:v') + 1] != 'copy'
         
-        # FFmpeg command for RTSP to HLS conversion
         ffmpeg_cmd = [
             'ffmpeg',
+            '-nostats',                  # Progress is reported on stdout instead
+            '-progress', 'pipe:1',       # Machine-readable progress (fps, bitrate, speed)
+            *settings['input_args'],
             '-i', rtsp_url,
-            '-c:v', 'libx264',           # Video codec
-            '-c:a', 'aac',               # Audio codec
+        ]
+        if burn_in:
+            # A filter graph output is mapped explicitly, so map the tracks FFmpeg picks on its own too
+            ffmpeg_cmd += ['-map', '0:v:0', '-map', '0:a:0?']
+        ffmpeg_cmd += [
+            *codec_args,                 # Copy or re-encode, see _select_codecs
+            *(settings['encoder_args'] if video_transcoded else []),
+            *self._hls_output_args(stream_id, profile, output_path),
+        ]
+        if burn_in:
+            graph, label = self.compositor.filter_graph(stream_id, burn_in)
+            ffmpeg_cmd += [
+                '-filter_complex', graph,
+                '-map', f"[{label}]",
+                '-map', '0:a:0?',
+                '-c:v', 'libx264',
+                '-c:a', codec_args[codec_args.index('-c:a') + 1],
+                *(settings['encoder_args'] or [
+                    '-preset', 'veryfast',
+                    '-force_key_frames', f"expr:gte(t,n_forced*{settings['hls_time']})",
+                    '-sc_threshold', '0',
+                ]),
+                *self._hls_output_args(
+                    f"{stream_id}_overlay", profile,
+                    os.path.join(os.path.dirname(output_path), f"{stream_id}_overlay.m3u8")
+                ),
+            ]
+        return ffmpeg_cmd
+    
+    def _hls_output_args(self, name, profile, output_path):
+        """HLS muxer options and the output playlist of one FFmpeg output"""
+        settings = LATENCY_PROFILES[profile]
+        hls_args = [
             '-f', 'hls',                 # Output format
-            '-hls_time', '2',            # Segment duration (seconds)
-            '-hls_list_size', '5',       # Number of segments in playlist
-            '-hls_flags', 'delete_segments',  # Delete old segments
+            '-hls_time', str(settings['hls_time']),            # Segment duration (seconds)
+            '-hls_list_size', str(settings['hls_list_size']),  # Number of segments in playlist
+            # Delete old segments; wall-clock segment times let the DVR recorder file them by time
+            '-hls_flags', 'delete_segments+program_date_time',
             '-hls_allow_cache', '0',     # Disable caching
-            '-start_number', '0',        # Start segment numbering at 0
+            # Number segments from the current epoch second so names are never reused after a
+            # restart and segments can be cached as immutable
+            '-hls_start_number_source', 'epoch',
+        ]
+        if settings['segment_type'] == 'fmp4':
+            hls_args += [
+                '-hls_segment_type', 'fmp4',
+                '-hls_fmp4_init_filename', f"{name}_init.mp4",  # Default name is shared by all streams
+            ]
+        hls_args += [
             '-y',                        # Overwrite output files
             output_path
         ]
+        return hls_args
+    
+    def _select_ladder(self, input_codecs):
+        """ABR renditions for an input, skipping rungs taller than the source"""
+        ladder = parse_ladder(Config.STREAM_ABR_LADDER)
+        source_height = (input_codecs or {}).get('height')
+        if source_height:
+            # Upscaling only costs CPU and bandwidth; keep at least the smallest rendition
+            ladder = [rung for rung in ladder if rung['height'] <= source_height] or ladder[-1:]
+        return ladder
+    
+    def _build_abr_cmd(self, stream_id, rtsp_url, ladder, audio_codec, profile, output_path):
+        """
+        Build an FFmpeg command that decodes the input once and encodes every
+        rendition of the ladder from a single filter graph
         
-        try:
-            # Start FFmpeg process
-            process = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                preexec_fn=os.setsid  # Create new process group
-            )
+        output_path becomes the master playlist; variants are written next to it
+        as {stream_id}_{index}.m3u8
+        """
+        settings = LATENCY_PROFILES[profile]
+        output_dir = os.path.dirname(output_path)
+        count = len(ladder)
+        
+        filters = [f"[0:v]split={count}" + ''.join(f"[v{i}]" for i in range(count))]
+        filters += [f"[v{i}]scale=-2:{rung['height']}[v{i}out]" for i, rung in enumerate(ladder)]
+        
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-nostats',
+            '-progress', 'pipe:1',
+            *settings['input_args'],
+            '-i', rtsp_url,
+            '-filter_complex', ';'.join(filters),
+        ]
+        for i, rung in enumerate(ladder):
+            bitrate = rung['bitrate_kbps']
+            ffmpeg_cmd += [
+                '-map', f"[v{i}out]",
+                f'-c:v:{i}', 'libx264',
+                f'-b:v:{i}', f"{bitrate}k",
+                f'-maxrate:v:{i}', f"{int(bitrate * 1.07)}k",
+                f'-bufsize:v:{i}', f"{bitrate * 2}k",
+            ]
+            if audio_codec:
+                ffmpeg_cmd += ['-map', '0:a:0']
+        if audio_codec:
+            ffmpeg_cmd += ['-c:a', audio_codec]
+        
+        # Renditions must have keyframes at the same instants or players can't switch between them
+        ffmpeg_cmd += settings['encoder_args'] or [
+            '-preset', 'veryfast',
+            '-force_key_frames', f"expr:gte(t,n_forced*{settings['hls_time']})",
+            '-sc_threshold', '0',
+        ]
+        
+        segment_ext = 'm4s' if settings['segment_type'] == 'fmp4' else 'ts'
+        ffmpeg_cmd += [
+            '-f', 'hls',
+            '-hls_time', str(settings['hls_time']),
+            '-hls_list_size', str(settings['hls_list_size']),
+            '-hls_flags', 'delete_segments+program_date_time',
+            '-hls_allow_cache', '0',
+            '-hls_start_number_source', 'epoch',
+            '-var_stream_map', ' '.join(
+                f"v:{i},a:{i}" if audio_codec else f"v:{i}" for i in range(count)
+            ),
+            '-master_pl_name', os.path.basename(output_path),
+            '-hls_segment_filename', os.path.join(output_dir, f"{stream_id}_%v_%d.{segment_ext}"),
+        ]
+        if settings['segment_type'] == 'fmp4':
+            ffmpeg_cmd += [
+                '-hls_segment_type', 'fmp4',
+                '-hls_fmp4_init_filename', f"{stream_id}_%v_init.mp4",
+            ]
+        ffmpeg_cmd += [
+            '-y',
+            os.path.join(output_dir, f"{stream_id}_%v.m3u8")
+        ]
+        return ffmpeg_cmd
+    
+    @blocking_pool.offload
+    def start_stream(self, stream_id, rtsp_url, codec_mode=None, latency_profile=None, abr=None,
+                     priority=None, record=None, burn_in=None):
+        """
+        Start converting an RTSP stream to HLS
+        
+        Returns right away with status 'starting'; the input is probed and FFmpeg
+        launched in the background, and on_event listeners receive 'stream_ready'
+        once the first playlist with a segment exists (or 'stream_failed')
+        
+        Args:
+            stream_id: Unique identifier for the stream
+            rtsp_url: RTSP URL to convert
+            codec_mode: 'auto' probes the input and copies HLS-compatible codecs,
+                'copy' always copies, 'transcode' always re-encodes (default from Config)
+            latency_profile: Name of a LATENCY_PROFILES entry (default from Config)
+            abr: Encode the STREAM_ABR_LADDER renditions behind a master playlist (default from Config)
+            priority: 'high', 'normal' or 'low'; sets queue order, nice level and CPU affinity
+            record: Keep the stream's segments for DVR playback (default from Config);
+                only MPEG-TS segments can be recorded, so it is ignored for fMP4 profiles
+            burn_in: Also write a rendition with the stream's overlays drawn in (default
+                from Config); not available with ABR
+        
+        Returns:
+            dict: Stream information including HLS URL; status is 'queued' if the
+                resource budget is full
+        
+        Raises:
+            AdmissionRejected: The budget is full and STREAM_ADMISSION is 'reject'
+        """
+        codec_mode = codec_mode or Config.STREAM_CODEC_MODE
+        abr = Config.STREAM_ABR if abr is None else abr
+        latency_profile = latency_profile or Config.STREAM_LATENCY_PROFILE
+        priority = priority or Config.STREAM_PRIORITY
+        record = Config.DVR_RECORD if record is None else record
+        if record and LATENCY_PROFILES[latency_profile]['segment_type'] != 'mpegts':
+            logging.warning(f"Stream {stream_id} uses fMP4 segments, which can't be recorded")
+            record = False
+        burn_in = Config.STREAM_BURN_IN if burn_in is None else burn_in
+        if burn_in and abr:
+            logging.warning(f"Stream {stream_id} uses ABR, overlays can't be burned in")
+            burn_in = False
+        
+        # Streams reading the same camera with the same encoding share one FFmpeg process;
+        # a burned-in rendition shows one stream's overlays, so such sources aren't shared
+        source_key = (normalize_rtsp_url(rtsp_url), codec_mode, latency_profile, abr, stream_id if burn_in else None)
+        
+        with self._lock:
+            if stream_id in self.active_streams:
+                logging.warning(f"Stream {stream_id} is already running")
+                return self.get_stream_info(stream_id)
+            if self.shared is not None:
+                remote_info = self._start_shared(stream_id, source_key)
+                if remote_info is not None:
+                    return remote_info
+            if self._attach_to_source(stream_id, source_key):
+                # Recording just files the shared output's segments, so any stream ID can turn it on
+                if record:
+                    self._sources[source_key]['record'] = True
+                    self.recorder.start()
+                return self.get_stream_info(stream_id)
             
-            self.active_streams[stream_id] = {
-                'process': process,
+            output_name = self._output_name(stream_id)
+            if self.shared is not None and not self.shared.claim(stream_id, output_name):
+                # Another worker started the same ID in the meantime
+                return self._shared_stream_info(stream_id)
+            output_path = os.path.join(self.hls_output_dir, f"{output_name}.m3u8")
+            stream = {
+                'process': None,
+                'telemetry': None,
+                'ffmpeg_cmd': None,
                 'rtsp_url': rtsp_url,
+                'source_key': source_key,
+                'output_name': output_name,
+                'stream_ids': {stream_id},
                 'output_path': output_path,
-                'hls_url': f'/hls/{stream_id}.m3u8'
+                # An ABR master playlist is written once; freshness is judged on the first variant
+                'watch_path': os.path.join(self.hls_output_dir, f"{output_name}_0.m3u8") if abr else output_path,
+                'hls_url': f'/hls/{output_name}.m3u8',
+                'codec_mode': None,
+                'input_codecs': None,
+                'latency_profile': latency_profile,
+                'abr': abr,
+                'renditions': None,
+                'priority': priority,
+                'record': record,
+                # Overlay layout of the burned-in rendition, filled in when the command is built
+                'burn_in': {'stream_id': stream_id} if burn_in else None,
+                'resources': None,
+                'state': 'starting',
+                'requested_at': time.time(),
+                'started_at': None,
+                'startup_time_s': None,
+                'restarts': 0,
+                'consecutive_failures': 0,
+                'last_failure': None,
+                'next_restart_at': None
             }
+            admitted = self.scheduler.admit(stream)
+            self.active_streams[stream_id] = stream
+            self._sources[source_key] = stream
+            self._save_registry()
+        
+        if admitted:
+            self._begin(stream)
+        if record:
+            self.recorder.start()
+        if burn_in:
+            self.compositor.start()
+        self.supervisor.start()
+        return self.get_stream_info(stream_id)
+    
+    def _begin(self, stream):
+        """Probe and launch an admitted source in the background"""
+        threading.Thread(
+            target=self._prepare, args=(stream,), name=f"stream-start-{stream['output_name']}", daemon=True
+        ).start()
+    
+    def schedule(self):
+        """Measure FFmpeg resource use and start queued streams the budget now has room for"""
+        with self._lock:
+            self.scheduler.sample()
+            admitted = self.scheduler.admit_queued()
+            for stream in admitted:
+                # Startup time doesn't include the wait in the queue
+                stream['requested_at'] = time.time()
+        for stream in admitted:
+            logging.info(f"Stream {stream['output_name']} admitted from the queue")
+            self._begin(stream)
+    
+    def _prepare(self, stream):
+        """Probe the input, build the FFmpeg command and launch it"""
+        rtsp_url = stream['rtsp_url']
+        output_name = stream['output_name']
+        output_path = stream['output_path']
+        _, codec_mode, latency_profile, abr = stream['source_key'][:4]
+        try:
+            if abr:
+                # Probe regardless of codec_mode: the ladder depends on the source height and audio track
+                input_codecs = probe_input(rtsp_url, Config.FFPROBE_TIMEOUT)
+                if input_codecs is None:
+                    logging.warning(f"Could not probe {rtsp_url}, ABR renditions will be video-only")
+                _, codec_args = self._select_codecs(codec_mode, input_codecs)
+                audio_codec = codec_args[3] if input_codecs and input_codecs['audio'] else None
+                ladder = self._select_ladder(input_codecs)
+                ffmpeg_cmd = self._build_abr_cmd(
+                    output_name, rtsp_url, ladder, audio_codec, latency_profile, output_path
+                )
+                mode = 'transcode'
+                renditions = [
+                    dict(rung, hls_url=f'/hls/{output_name}_{i}.m3u8') for i, rung in enumerate(ladder)
+                ]
+            else:
+                input_codecs = probe_input(rtsp_url, Config.FFPROBE_TIMEOUT) if codec_mode == 'auto' else None
+                mode, codec_args = self._select_codecs(codec_mode, input_codecs)
+                if stream['burn_in']:
+                    burn_in = self.compositor.layout(stream['burn_in']['stream_id'])
+                    with self._lock:
+                        stream['burn_in'] = burn_in
+                ffmpeg_cmd = self._build_ffmpeg_cmd(
+                    output_name, rtsp_url, codec_args, latency_profile, output_path, stream['burn_in']
+                )
+                renditions = None
             
-            logging.info(f"Started stream {stream_id}: {rtsp_url} -> {output_path}")
-            return self.get_stream_info(stream_id)
-            
-        except FileNotFoundError:
-            logging.error("FFmpeg not found. Please install FFmpeg.")
-            raise Exception("FFmpeg is not installed. Install it with: sudo apt-get install ffmpeg")
+            with self._lock:
+                stream.update(
+                    ffmpeg_cmd=ffmpeg_cmd, codec_mode=mode, input_codecs=input_codecs, renditions=renditions
+                )
+            if self._launch(stream):
+                logging.info(f"Started stream {output_name} ({mode}{', ABR' if abr else ''}): {rtsp_url} -> {output_path}")
         except Exception as e:
-            logging.error(f"Failed to start stream {stream_id}: {e}")
-            raise
+            with self._lock:
+                stream['state'] = 'failed'
+                stream['last_failure'] = {'reason': str(e), 'at': time.time()}
+                self._retire_source(stream)
+                self._save_registry()
+            self._notify('stream_failed', stream)
     
-    def stop_stream(self, stream_id):
-        """Stop a running stream"""
-        if stream_id not in self.active_streams:
-            logging.warning(f"Stream {stream_id} is not running")
+    def set_burn_in_layout(self, stream, layout):
+        """Record the overlay layout a source's composited rendition shows and rebuild its command to match (caller holds the lock)"""
+        stream['burn_in'] = layout
+        _, codec_args = self._select_codecs(stream['source_key'][1], stream['input_codecs'])
+        stream['ffmpeg_cmd'] = self._build_ffmpeg_cmd(
+            stream['output_name'], stream['rtsp_url'], codec_args, stream['latency_profile'],
+            stream['output_path'], layout
+        )
+        self._save_registry()
+    
+    def relaunch(self, stream, reason):
+        """Restart a source's FFmpeg process right away with its current command"""
+        with self._lock:
+            process = stream['process']
+            if process is None or not any(s is stream for s in self.active_streams.values()):
+                return False
+            stream['process'] = None
+        logging.info(f"Relaunching stream {stream['output_name']}: {reason}")
+        self._terminate(stream['output_name'], process)
+        try:
+            return self._launch(stream)
+        except Exception as e:
+            # Left to the supervisor's restart policy
+            with self._lock:
+                stream['state'] = 'restarting'
+                stream['last_failure'] = {'reason': f"Relaunch failed: {e}", 'at': time.time()}
+                stream['next_restart_at'] = time.time() + Config.STREAM_RESTART_BACKOFF
+                self._save_registry()
             return False
+    
+    def _start_shared(self, stream_id, source_key):
+        """
+        Resolve a start request against the streams of all workers (caller holds the lock)
         
-        stream_info = self.active_streams[stream_id]
-        process = stream_info['process']
+        Returns:
+            dict: Stream info if the ID already exists on another worker or was mapped onto
+                another worker's source; None to continue with a local source
+        """
+        if self.shared.lookup(stream_id) is not None:
+            logging.warning(f"Stream {stream_id} is already running on another worker")
+            return self._shared_stream_info(stream_id)
+        local = self._sources.get(source_key)
+        if local is not None:
+            if self.shared.claim(stream_id, local['output_name']):
+                return None
+            return self._shared_stream_info(stream_id)
+        output_name = self.shared.find_source(source_key)
+        if output_name is None:
+            return None
+        if self.shared.claim(stream_id, output_name):
+            logging.info(f"Stream {stream_id} shares the FFmpeg process of {output_name} on another worker")
+        return self._shared_stream_info(stream_id)
+    
+    def _attach_to_source(self, stream_id, source_key):
+        """Map a stream ID onto an already running source, if there is one"""
+        with self._lock:
+            stream = self._sources.get(source_key)
+            if stream is None:
+                return False
+            stream['stream_ids'].add(stream_id)
+            self.active_streams[stream_id] = stream
+        logging.info(
+            f"Stream {stream_id} shares the FFmpeg process of {stream['output_name']} "
+            f"({len(stream['stream_ids'])} streams)"
+        )
+        return True
+    
+    def _retire_source(self, stream):
+        """Stop handing a failed source to new start requests; its stream IDs stay listed"""
+        if self._sources.get(stream['source_key']) is stream:
+            del self._sources[stream['source_key']]
+    
+    def _output_name(self, stream_id):
+        """
+        HLS file name for a new source, normally the stream ID
         
+        A shared source keeps writing under the ID that started it after that ID
+        is stopped, so a new source reusing the ID gets a suffixed name instead
+        """
+        in_use = {stream['output_name'] for stream in self.active_streams.values()}
+        if self.shared is not None:
+            in_use |= self.shared.output_names()
+        name, suffix = stream_id, 1
+        while name in in_use:
+            suffix += 1
+            name = f"{stream_id}-{suffix}"
+        return name
+    
+    def on_event(self, listener):
+        """Register listener(event, data) for 'stream_ready' and 'stream_failed'"""
+        self._listeners.append(listener)
+    
+    def _notify(self, event, stream):
+        """Call the event listeners once per stream ID of a source"""
+        with self._lock:
+            stream_ids = sorted(stream['stream_ids'])
+            data = {
+                'hls_url': stream['hls_url'],
+                'state': stream['state'],
+                'restarts': stream['restarts'],
+            }
+            if event == 'stream_ready':
+                data['startup_time_s'] = stream['startup_time_s']
+            else:
+                data['reason'] = (stream['last_failure'] or {}).get('reason')
+                if stream['state'] == 'restarting':
+                    data['retry_in_s'] = round(max(stream['next_restart_at'] - time.time(), 0), 1)
+        for stream_id in stream_ids:
+            for listener in self._listeners:
+                try:
+                    listener(event, dict(data, stream_id=stream_id))
+                except Exception as e:
+                    logging.error(f"Error in {event} listener: {e}")
+    
+    def _launch(self, stream):
+        """
+        Start (or restart) the FFmpeg process of a registered source
+        
+        Returns:
+            bool: False if the source was stopped in the meantime
+        """
+        with self._lock:
+            if not any(s is stream for s in self.active_streams.values()):
+                return False
+            try:
+                if self._detached_outputs:
+                    # Pipes would break when this backend exits, so FFmpeg writes to files it can keep
+                    progress_path, log_path = self._output_files(stream)
+                    stdout, stderr = self._open_output_file(progress_path), self._open_output_file(log_path)
+                else:
+                    progress_path = log_path = None
+                    stdout = stderr = subprocess.PIPE
+                # Start FFmpeg process
+                try:
+                    process = subprocess.Popen(
+                        stream['ffmpeg_cmd'],
+                        stdout=stdout,
+                        stderr=stderr,
+                        # New process group, plus the priority class's nice level and CPU affinity
+                        preexec_fn=self.scheduler.preexec_fn(stream['priority'])
+                    )
+                finally:
+                    if progress_path is not None:
+                        stdout.close()
+                        stderr.close()
+            except FileNotFoundError:
+                logging.error("FFmpeg not found. Please install FFmpeg.")
+                raise Exception("FFmpeg is not installed. Install it with: sudo apt-get install ffmpeg")
+            except Exception as e:
+                logging.error(f"Failed to start stream {stream['output_name']}: {e}")
+                raise
+            
+            # Both outputs must be drained or FFmpeg blocks once the pipes fill up
+            stream['telemetry'] = StreamTelemetry(
+                stream['output_name'], process, progress_path=progress_path, log_path=log_path
+            ).start()
+            stream['process'] = process
+            stream['state'] = 'starting'
+            stream['started_at'] = time.time()
+            stream['next_restart_at'] = None
+            self._save_registry()
+        
+        threading.Thread(
+            target=self._watch_startup, args=(stream, process),
+            name=f"stream-ready-{stream['output_name']}", daemon=True
+        ).start()
+        return True
+    
+    def _output_files(self, stream):
+        """Files FFmpeg's progress and log output go to when it may outlive the backend"""
+        base = os.path.join(Config.STREAM_STATE_DIR, stream['output_name'])
+        return f"{base}.progress", f"{base}.log"
+    
+    def _open_output_file(self, path):
+        """Empty an output file and open it append-only, so the telemetry reader can truncate it"""
+        f = open(path, 'ab')
+        f.truncate(0)
+        return f
+    
+    def _save_registry(self):
+        """Persist all sources that may need adopting, and publish them to the other workers (caller holds the lock)"""
+        sources = {id(stream): stream for stream in self.active_streams.values()}.values()
+        try:
+            if self.registry is not None:
+                self.registry.save([stream for stream in sources if stream['state'] != 'failed'])
+            if self.shared is not None:
+                # Failed sources stay listed, as they do locally
+                self.shared.save([dict(registry_entry(stream), info=self._source_info(stream)) for stream in sources])
+        except Exception as e:
+            logging.error(f"Error saving stream registry: {e}")
+    
+    def adopt_streams(self):
+        """
+        Take over the streams recorded by a previous backend process
+        
+        FFmpeg processes that are still running and writing fresh output are adopted
+        as they are; the rest are relaunched (or queued/probed again if they never started)
+        
+        Returns:
+            dict: Number of sources adopted, relaunched and requeued
+        """
+        counts = {'adopted': 0, 'relaunched': 0, 'requeued': 0}
+        if self.shared is not None:
+            # The shared state also lists this host's streams; the supervisor keeps syncing it
+            self.sync_shared(counts)
+            self.supervisor.start()
+        elif self.registry is not None:
+            for entry in self.registry.load():
+                counts[self._adopt_entry(entry)] += 1
+            with self._lock:
+                self._save_registry()
+            if self.active_streams:
+                self.supervisor.start()
+        else:
+            return counts
+        logging.info(
+            f"Stream registry: {counts['adopted']} adopted, {counts['relaunched']} relaunched, "
+            f"{counts['requeued']} requeued"
+        )
+        return counts
+    
+    def _adopt_entry(self, entry):
+        """
+        Register a persisted source, adopting its FFmpeg process if it still runs and writes fresh output
+        
+        Returns:
+            str: 'adopted', 'relaunched' or 'requeued'
+        """
+        pid = entry.pop('pid')
+        stream = dict(
+            entry, process=None, telemetry=None, resources=None,
+            consecutive_failures=0, next_restart_at=None
+        )
+        process = AdoptedProcess.find(pid, stream['ffmpeg_cmd']) if stream['ffmpeg_cmd'] else None
+        healthy = process is not None and self._output_fresh(stream)
+        
+        with self._lock:
+            for stream_id in stream['stream_ids']:
+                self.active_streams[stream_id] = stream
+            self._sources[stream['source_key']] = stream
+            if healthy:
+                progress_path, log_path = self._output_files(stream)
+                stream['process'] = process
+                stream['telemetry'] = StreamTelemetry(
+                    stream['output_name'], process, progress_path=progress_path, log_path=log_path
+                ).start()
+                stream['state'] = 'running'
+            elif stream['state'] == 'queued':
+                self.scheduler.queue.append(stream)
+        
+        if stream['record']:
+            self.recorder.start()
+        if stream['burn_in']:
+            self.compositor.start()
+        if healthy:
+            logging.info(f"Adopted running FFmpeg process {pid} of stream {stream['output_name']}")
+            return 'adopted'
+        if stream['state'] == 'queued':
+            return 'requeued'
+        
+        if process is not None:
+            logging.warning(f"FFmpeg process {pid} of stream {stream['output_name']} is stalled, restarting it")
+            self._terminate(stream['output_name'], process)
+        stream['requested_at'] = time.time()
+        if stream['ffmpeg_cmd']:
+            try:
+                self._launch(stream)
+            except Exception as e:
+                with self._lock:
+                    stream['state'] = 'failed'
+                    stream['last_failure'] = {'reason': str(e), 'at': time.time()}
+                    self._retire_source(stream)
+        else:
+            self._begin(stream)
+        return 'relaunched'
+    
+    def sync_shared(self, counts=None):
+        """
+        Multi-worker mode: heartbeat, take over the sources of workers that stopped
+        heartbeating, apply stream IDs started or stopped through other workers and
+        publish a fresh status snapshot
+        
+        Args:
+            counts: Optional dict counting taken-over sources by adoption outcome
+        """
+        if self.shared is None:
+            return
+        self.shared.heartbeat()
+        live = self.shared.live_workers()
+        with self._lock:
+            local_names = {stream['output_name'] for stream in self.active_streams.values()}
+            sources = self.shared.sources()
+        for source in sources:
+            owner = source['owner']
+            if owner == self.shared.worker_id:
+                if source['output_name'] in local_names:
+                    continue
+                # Left over from a previous process with the same WORKER_ID
+            elif owner in live or not self.shared.take_over(source['output_name'], owner):
+                continue
+            entry = restore_entry(source['entry'])
+            entry['stream_ids'] = source['stream_ids']
+            if not entry['stream_ids']:
+                # Every ID was stopped while the owner was gone
+                process = AdoptedProcess.find(entry['pid'], entry['ffmpeg_cmd']) if entry['ffmpeg_cmd'] else None
+                self._terminate(entry['output_name'], process)
+                self._cleanup_hls_files(entry)
+                continue
+            outcome = self._adopt_entry(entry)
+            if counts is not None:
+                counts[outcome] += 1
+            logging.warning(f"Took over stream {source['output_name']} from worker {owner} ({outcome})")
+        
+        released = []
+        with self._lock:
+            sources = {id(stream): stream for stream in self.active_streams.values()}.values()
+            claimed = self.shared.stream_ids([stream['output_name'] for stream in sources])
+            for stream in sources:
+                stream_ids = claimed[stream['output_name']]
+                for stream_id in stream_ids - stream['stream_ids']:
+                    if stream_id not in self.active_streams:
+                        stream['stream_ids'].add(stream_id)
+                        self.active_streams[stream_id] = stream
+                        logging.info(f"Stream {stream_id} shares the FFmpeg process of {stream['output_name']}")
+                released.extend(stream['stream_ids'] - stream_ids)
+        for stream_id in released:
+            logging.info(f"Stream {stream_id} was stopped through another worker")
+            self.stop_stream(stream_id)
+        with self._lock:
+            self._save_registry()
+    
+    def leave_shared(self):
+        """Hand this worker's FFmpeg processes to the other workers at shutdown"""
+        if self.shared is not None:
+            self.shared.leave()
+    
+    def _output_fresh(self, stream):
+        """Whether a source's playlist was updated within the stall timeout"""
+        try:
+            return time.time() - os.path.getmtime(stream['watch_path']) < Config.STREAM_STALL_TIMEOUT
+        except OSError:
+            return False
+    
+    def _watch_startup(self, stream, process):
+        """
+        Poll the output of a launch until the first playlist with a segment appears
+        
+        Ends without an event if FFmpeg exits first; the supervisor reports that failure
+        """
+        while process.poll() is None:
+            with self._lock:
+                if stream['process'] is not process:
+                    return  # Stopped or restarted
+                started_at = stream['started_at']
+            if self._output_ready(stream, started_at):
+                with self._lock:
+                    if stream['process'] is not process:
+                        return
+                    now = time.time()
+                    # The first launch counts from the API request (probing included), restarts from the relaunch
+                    since = stream['requested_at'] if stream['restarts'] == 0 else started_at
+                    stream['state'] = 'running'
+                    stream['startup_time_s'] = round(now - since, 2)
+                    self._save_registry()
+                logging.info(f"Stream {stream['output_name']} ready after {stream['startup_time_s']}s")
+                self._notify('stream_ready', stream)
+                return
+            time.sleep(READY_POLL_INTERVAL)
+    
+    def _output_ready(self, stream, started_at):
+        """Whether this launch has written a playlist that lists at least one segment"""
+        try:
+            if os.path.getmtime(stream['watch_path']) < started_at:
+                return False  # Left over from a previous launch
+        except OSError:
+            return False
+        text = hls_playlist.read_playlist(stream['watch_path'])
+        if not text or hls_playlist.parse_playlist(text)[1] == 0:
+            return False
+        return os.path.exists(stream['output_path'])
+    
+    def _terminate(self, stream_id, process):
+        """Stop an FFmpeg process group, forcefully if it doesn't exit in time"""
+        if process is None or process.poll() is not None:
+            return
         try:
             # Send SIGTERM to process group
             os.killpg(os.getpgid(process.pid), signal.SIGTERM)
@@ -99,60 +908,241 @@ class StreamManager:
             logging.warning(f"Force killed stream {stream_id}")
         except Exception as e:
             logging.error(f"Error stopping stream {stream_id}: {e}")
+    
+    @blocking_pool.offload
+    def stop_stream(self, stream_id):
+        """Stop a running stream; a shared FFmpeg process keeps running for the other stream IDs"""
+        with self._lock:
+            stream_info = self.active_streams.pop(stream_id, None)
+            if self.shared is not None and self.shared.release(stream_id) and stream_info is None:
+                # The owning worker stops FFmpeg within a supervisor tick if no other ID uses it
+                logging.info(f"Stream {stream_id} stopped through another worker")
+                return True
+            if stream_info is None:
+                logging.warning(f"Stream {stream_id} is not running")
+                return False
+            stream_info['stream_ids'].discard(stream_id)
+            if stream_info['stream_ids']:
+                self._save_registry()
+                logging.info(
+                    f"Stream {stream_id} stopped, FFmpeg process kept for {', '.join(sorted(stream_info['stream_ids']))}"
+                )
+                return True
+            self._retire_source(stream_info)
+            self.scheduler.dequeue(stream_info)
+            process = stream_info['process']
+            # Marks the source as stopped for the startup watcher and a pending launch
+            stream_info['process'] = None
+            self._save_registry()
         
-        # Clean up
-        del self.active_streams[stream_id]
+        self._terminate(stream_id, process)
         
         # Remove HLS files
-        self._cleanup_hls_files(stream_id)
+        self._cleanup_hls_files(stream_info)
+        if self._detached_outputs:
+            for path in self._output_files(stream_info):
+                if os.path.exists(path):
+                    os.remove(path)
         
         return True
     
-    def _cleanup_hls_files(self, stream_id):
-        """Remove HLS files for a stream"""
+    def _hls_file_pattern(self, stream):
+        """
+        Regex matching exactly the HLS files a source writes, and nothing of a source whose
+        name merely starts with the same characters (e.g. 'cam' must not match 'cam2')
+        """
+        name = re.escape(stream['output_name'])
+        # Segments are numbered from the epoch second, so their numbers have 10 digits
+        files = r'(\.m3u8|\d{10}\.(ts|m4s)|_init\.mp4)'
+        if stream.get('abr'):
+            # Master playlist, then per rendition {name}_{index}.m3u8, {name}_{index}_{n}.ts/.m4s
+            return re.compile(rf'{name}\.m3u8|{name}_\d+(\.m3u8|_\d{{10}}\.(ts|m4s)|_init\.mp4)')
+        if stream.get('burn_in'):
+            return re.compile(rf'{name}(_overlay)?{files}')
+        return re.compile(rf'{name}{files}')
+    
+    def _cleanup_hls_files(self, stream):
+        """Remove a source's HLS files"""
         try:
-            import glob
-            pattern = os.path.join(self.hls_output_dir, f"{stream_id}*")
-            for file in glob.glob(pattern):
-                os.remove(file)
-                logging.debug(f"Removed {file}")
+            pattern = self._hls_file_pattern(stream)
+            for filename in os.listdir(self.hls_output_dir):
+                if pattern.fullmatch(filename):
+                    os.remove(os.path.join(self.hls_output_dir, filename))
+                    logging.debug(f"Removed {filename}")
         except Exception as e:
             logging.error(f"Error cleaning up HLS files: {e}")
     
-    def get_stream_info(self, stream_id):
-        """Get information about a stream"""
-        if stream_id not in self.active_streams:
-            return None
+    @blocking_pool.offload
+    def get_stream_info(self, stream_id, include_log=False):
+        """
+        Get information about a stream
         
-        stream = self.active_streams[stream_id]
+        Args:
+            stream_id: Stream identifier
+            include_log: Also return the last lines of FFmpeg's stderr
+        """
+        with self._lock:
+            stream = self.active_streams.get(stream_id)
+            if stream is None:
+                return self._shared_stream_info(stream_id) if self.shared is not None else None
+            info = {
+                'stream_id': stream_id,
+                **self._source_info(stream),
+                'shared_with': sorted(stream['stream_ids'] - {stream_id})
+            }
+            telemetry = stream['telemetry']
+        if include_log and telemetry:
+            info['log'] = telemetry.recent_log()
+        return info
+    
+    def _source_info(self, stream):
+        """Status of a source, without the fields that depend on the stream ID (caller holds the lock)"""
         process = stream['process']
+        if stream['state'] in ('queued', 'starting', 'restarting', 'failed'):
+            status = stream['state']
+        else:
+            status = 'running' if process is not None and process.poll() is None else 'stopped'
         
-        return {
-            'stream_id': stream_id,
+        info = {
             'rtsp_url': stream['rtsp_url'],
             'hls_url': stream['hls_url'],
-            'status': 'running' if process.poll() is None else 'stopped',
-            'pid': process.pid
+            'status': status,
+            'pid': process.pid if process is not None else None,
+            'codec_mode': stream['codec_mode'],
+            'input_codecs': stream['input_codecs'],
+            'latency_profile': stream['latency_profile'],
+            'renditions': stream['renditions'],
+            'startup_time_s': stream['startup_time_s'],
+            'priority': stream['priority'],
+            'record': stream['record'],
+            'overlay_hls_url': f"/hls/{stream['output_name']}_overlay.m3u8" if stream['burn_in'] else None,
+            'resources': stream['resources'],
+            'restarts': stream['restarts'],
+            'last_failure': stream['last_failure'],
+            'telemetry': stream['telemetry'].snapshot() if stream['telemetry'] else None
         }
+        queue_position = self.scheduler.queue_position(stream)
+        if queue_position is not None:
+            info['queue_position'] = queue_position
+        if self.shared is not None:
+            info['worker'] = self.shared.worker_id
+        return info
+    
+    def _shared_stream_infos(self):
+        """
+        Multi-worker mode: stream info of every stream ID, from the snapshots the owning
+        workers publish (refreshed every supervisor tick and on every state change)
+        """
+        infos = []
+        for source in self.shared.sources():
+            if source['info'] is None:
+                continue
+            for stream_id in source['stream_ids']:
+                infos.append({
+                    'stream_id': stream_id,
+                    **source['info'],
+                    'shared_with': sorted(source['stream_ids'] - {stream_id}),
+                    'worker': source['owner']
+                })
+        return infos
+    
+    def _shared_stream_info(self, stream_id):
+        """Snapshot info of a stream ID owned by another worker, or None if no worker has it"""
+        for info in self._shared_stream_infos():
+            if info['stream_id'] == stream_id:
+                return info
+        if any(stream_id in stream_ids for stream_ids in self.shared.stream_ids().values()):
+            # Claimed by a worker that hasn't published the source yet
+            return {'stream_id': stream_id, 'status': 'starting'}
+        return None
     
+    @blocking_pool.offload
     def list_streams(self):
         """List all active streams"""
-        return [self.get_stream_info(sid) for sid in self.active_streams.keys()]
+        with self._lock:
+            stream_ids = list(self.active_streams.keys())
+        streams = [self.get_stream_info(sid) for sid in stream_ids]
+        streams = [stream for stream in streams if stream is not None]
+        if self.shared is not None:
+            local_ids = set(stream_ids)
+            streams.extend(info for info in self._shared_stream_infos() if info['stream_id'] not in local_ids)
+        return streams
     
+    @blocking_pool.offload
     def stop_all_streams(self):
         """Stop all running streams"""
-        stream_ids = list(self.active_streams.keys())
+        with self._lock:
+            stream_ids = list(self.active_streams.keys())
         for stream_id in stream_ids:
             self.stop_stream(stream_id)
         logging.info("Stopped all streams")
     
+    @blocking_pool.offload
+    def recording_name(self, stream_id):
+        """Name a stream's recordings are filed under (its HLS output name while it runs)"""
+        with self._lock:
+            stream = self.active_streams.get(stream_id)
+        if stream is not None:
+            return stream['output_name']
+        remote = self.shared.lookup(stream_id) if self.shared is not None else None
+        return remote[0] if remote else stream_id
+    
+    @blocking_pool.offload
+    def remote_sources(self):
+        """Multi-worker mode: sources owned by the other workers, as published in the shared state"""
+        if self.shared is None:
+            return []
+        return [source for source in self.shared.sources() if source['owner'] != self.shared.worker_id]
+    
+    @blocking_pool.offload
+    def get_worker_stats(self):
+        """This worker's ID and the number of live workers, or None with a single worker"""
+        if self.shared is None:
+            return None
+        return {'worker_id': self.shared.worker_id, 'live_workers': len(self.shared.live_workers())}
+    
+    @blocking_pool.offload
+    def get_scheduler_stats(self):
+        """Resource budget, committed usage and admission queue depth"""
+        with self._lock:
+            return self.scheduler.get_stats()
+    
+    @blocking_pool.offload
+    def resolve_playlist(self, filename):
+        """
+        Find the stream an HLS playlist file belongs to
+        
+        Returns:
+            tuple: (latency profile, True if it is an ABR master playlist),
+                or (None, False) if no running stream writes it
+        """
+        with self._lock:
+            for stream in self.active_streams.values():
+                if filename == os.path.basename(stream['output_path']):
+                    return stream['latency_profile'], stream['renditions'] is not None
+                if any(rendition['hls_url'] == f'/hls/{filename}' for rendition in stream['renditions'] or []):
+                    return stream['latency_profile'], False
+                if stream['burn_in'] and filename == f"{stream['output_name']}_overlay.m3u8":
+                    return stream['latency_profile'], False
+        if self.shared is not None:
+            hls_url = f'/hls/{filename}'
+            for source in self.shared.sources():
+                info = source['info'] or {}
+                if info.get('hls_url') == hls_url:
+                    return info['latency_profile'], info['renditions'] is not None
+                if any(rendition['hls_url'] == hls_url for rendition in info.get('renditions') or []):
+                    return info['latency_profile'], False
+                if info.get('overlay_hls_url') == hls_url:
+                    return info['latency_profile'], False
+        return None, False
+    
     def is_stream_running(self, stream_id):
         """Check if a stream is running"""
-        if stream_id not in self.active_streams:
+        with self._lock:
+            stream = self.active_streams.get(stream_id)
+        if stream is None or stream['process'] is None:
             return False
-        
-        process = self.active_streams[stream_id]['process']
-        return process.poll() is None
+        return stream['process'].poll() is None
 
 # Global stream manager instance
-stream_manager = StreamManager()
+stream_manager = StreamManager(Config.HLS_OUTPUT_DIR)
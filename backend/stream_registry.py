@@ -0,0 +1,124 @@
+"""
+Persisted stream registry
+Records every stream source (FFmpeg command, PID, output paths, settings) in a
+JSON file so a restarted backend can take over FFmpeg processes that are still
+running instead of tearing every camera down
+"""
+
+import subprocess
+import logging
+import json
+import time
+import os
+
+# Stream fields that describe a source; runtime objects (process, telemetry) are rebuilt
+PERSISTED_FIELDS = (
+    'ffmpeg_cmd', 'rtsp_url', 'source_key', 'output_name', 'stream_ids', 'output_path',
+    'watch_path', 'hls_url', 'codec_mode', 'input_codecs', 'latency_profile', 'abr',
+    'renditions', 'priority', 'record', 'burn_in', 'state', 'requested_at', 'started_at', 'startup_time_s',
+    'restarts', 'last_failure'
+)
+
+def registry_entry(stream):
+    """JSON-serializable record of a source, with the PID of its FFmpeg process"""
+    entry = {field: stream[field] for field in PERSISTED_FIELDS}
+    entry['source_key'] = list(stream['source_key'])
+    entry['stream_ids'] = sorted(stream['stream_ids'])
+    entry['pid'] = stream['process'].pid if stream['process'] is not None else None
+    return entry
+
+def restore_entry(entry):
+    """Turn a record back into stream fields (plus 'pid')"""
+    # Registries written before a field existed
+    for field in PERSISTED_FIELDS:
+        entry.setdefault(field, None)
+    entry['source_key'] = tuple(entry['source_key'])
+    entry['stream_ids'] = set(entry['stream_ids'] or ())
+    return entry
+
+class StreamRegistry:
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, sources):
+        """Write all sources atomically, so a crash never leaves a truncated registry"""
+        entries = [registry_entry(stream) for stream in sources]
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'streams': entries}, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        """
+        Read the registry
+
+        Returns:
+            list: Stream dicts with the persisted fields plus 'pid'
+        """
+        try:
+            with open(self.path) as f:
+                entries = json.load(f).get('streams', [])
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read stream registry {self.path}: {e}")
+            return []
+        return [restore_entry(entry) for entry in entries]
+
+def _process_alive(pid):
+    """Whether a PID belongs to a live (not zombie) process"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+class AdoptedProcess:
+    """
+    FFmpeg process started by a previous backend process
+
+    Offers the parts of subprocess.Popen the stream manager uses. It isn't our
+    child, so its exit status can't be collected and is reported as -1
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    @classmethod
+    def find(cls, pid, cmd):
+        """Adopt a PID only if it still runs the same command (PIDs get reused)"""
+        if not pid:
+            return None
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                running_cmd = f.read().rstrip(b'\0').split(b'\0')
+        except OSError:
+            return None
+        running_cmd = [arg.decode('utf-8', 'replace') for arg in running_cmd]
+        # Compare arguments only: the executable may show up resolved or behind an interpreter
+        if len(running_cmd) < len(cmd) or running_cmd[len(running_cmd) - len(cmd) + 1:] != cmd[1:]:
+            return None
+        process = cls(pid)
+        return process if process.poll() is None else None
+
+    def poll(self):
+        if self.returncode is None and not _process_alive(self.pid):
+            self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.poll() is None:
+            if deadline is not None and time.time() > deadline:
+                raise subprocess.TimeoutExpired('ffmpeg', timeout)
+            time.sleep(0.1)
+        return self.returncode
@@ -2,11 +2,17 @@
 API routes for RTSP stream management
 """
 
-from flask import Blueprint, request, jsonify
-from stream_manager import stream_manager
+from flask import Blueprint, Response, request, jsonify
+from datetime import datetime, timezone
+from stream_manager import stream_manager, CODEC_MODES, LATENCY_PROFILES
+from stream_scheduler import AdmissionRejected, PRIORITY_CLASSES
+from config import Config
+import metrics
 import logging
+import time
 
 stream_api = Blueprint('stream_api', __name__)
+metrics.instrument_blueprint(stream_api)
 
 @stream_api.route('/streams', methods=['POST'])
 def start_stream():
@@ -24,8 +30,55 @@ def start_stream():
         if not rtsp_url.startswith('rtsp://'):
             return jsonify({'error': 'Invalid RTSP URL. Must start with rtsp://'}), 400
         
+        codec_mode = data.get('codec_mode')
+        if codec_mode is not None and codec_mode not in CODEC_MODES:
+            return jsonify({'error': f"codec_mode must be one of: {', '.join(CODEC_MODES)}"}), 400
+        
+        latency_profile = data.get('latency_profile')
+        if latency_profile is not None and latency_profile not in LATENCY_PROFILES:
+            return jsonify({'error': f"latency_profile must be one of: {', '.join(LATENCY_PROFILES)}"}), 400
+        
+        abr = data.get('abr')
+        if abr is not None and not isinstance(abr, bool):
+            return jsonify({'error': 'abr must be a boolean'}), 400
+        
+        priority = data.get('priority')
+        if priority is not None and priority not in PRIORITY_CLASSES:
+            return jsonify({'error': f"priority must be one of: {', '.join(PRIORITY_CLASSES)}"}), 400
+        
+        record = data.get('record')
+        if record is not None and not isinstance(record, bool):
+            return jsonify({'error': 'record must be a boolean'}), 400
+        if record and LATENCY_PROFILES[latency_profile or Config.STREAM_LATENCY_PROFILE]['segment_type'] != 'mpegts':
+            return jsonify({'error': 'record requires a latency profile with MPEG-TS segments'}), 400
+        
+        burn_in = data.get('burn_in')
+        if burn_in is not None and not isinstance(burn_in, bool):
+            return jsonify({'error': 'burn_in must be a boolean'}), 400
+        if burn_in and (Config.STREAM_ABR if abr is None else abr):
+            return jsonify({'error': 'burn_in is not available with abr'}), 400
+        
         # Start the stream
-        stream_info = stream_manager.start_stream(stream_id, rtsp_url)
+        try:
+            stream_info = stream_manager.start_stream(
+                stream_id, rtsp_url, codec_mode=codec_mode, latency_profile=latency_profile,
+                abr=abr, priority=priority, record=record, burn_in=burn_in
+            )
+        except AdmissionRejected as e:
+            return jsonify({'error': str(e), 'scheduler': stream_manager.get_scheduler_stats()}), 503
+        
+        if stream_info['status'] == 'queued':
+            return jsonify({
+                'message': 'Stream queued until resources are available',
+                'stream': stream_info
+            }), 202
+        
+        # FFmpeg starts in the background; clients are told through stream_ready / stream_failed
+        if stream_info['status'] == 'starting':
+            return jsonify({
+                'message': 'Stream starting',
+                'stream': stream_info
+            }), 202
         
         return jsonify({
             'message': 'Stream started successfully',
@@ -41,7 +94,7 @@ def list_streams():
     """List all active streams"""
     try:
         streams = stream_manager.list_streams()
-        return jsonify({'streams': streams}), 200
+        return jsonify({'streams': streams, 'scheduler': stream_manager.get_scheduler_stats()}), 200
     except Exception as e:
         logging.error(f"Error listing streams: {e}")
         return jsonify({'error': str(e)}), 500
@@ -50,7 +103,7 @@ def list_streams():
 def get_stream(stream_id):
     """Get information about a specific stream"""
     try:
-        stream_info = stream_manager.get_stream_info(stream_id)
+        stream_info = stream_manager.get_stream_info(stream_id, include_log=True)
         
         if not stream_info:
             return jsonify({'error': 'Stream not found'}), 404
@@ -74,6 +127,49 @@ def stop_stream(stream_id):
         logging.error(f"Error stopping stream: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _parse_time(value):
+    """Parse epoch seconds or an ISO 8601 time (UTC unless it has an offset)"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+@stream_api.route('/streams/<stream_id>/recordings', methods=['GET'])
+def get_recordings(stream_id):
+    """List the recorded time ranges of a stream"""
+    try:
+        name = stream_manager.recording_name(stream_id)
+        return jsonify({'stream_id': stream_id, **stream_manager.recorder.get_recordings(name)}), 200
+    except Exception as e:
+        logging.error(f"Error listing recordings: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@stream_api.route('/streams/<stream_id>/recording.m3u8', methods=['GET'])
+def get_recording_playlist(stream_id):
+    """VOD playlist of a stream's recording between start and end (default: now)"""
+    try:
+        if 'start' not in request.args:
+            return jsonify({'error': 'start is required'}), 400
+        try:
+            start = _parse_time(request.args['start'])
+            end = _parse_time(request.args['end']) if 'end' in request.args else time.time()
+        except ValueError:
+            return jsonify({'error': 'start and end must be epoch seconds or ISO 8601 times'}), 400
+        if end <= start:
+            return jsonify({'error': 'end must be after start'}), 400
+        
+        playlist = stream_manager.recorder.vod_playlist(stream_manager.recording_name(stream_id), start, end)
+        if playlist is None:
+            return jsonify({'error': 'Nothing recorded in this time range'}), 404
+        return Response(playlist, mimetype='application/vnd.apple.mpegurl')
+    except Exception as e:
+        logging.error(f"Error building recording playlist: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @stream_api.route('/streams/stop-all', methods=['POST'])
 def stop_all_streams():
     """Stop all running streams"""
@@ -0,0 +1,263 @@
+"""
+FFmpeg resource scheduler
+Measures each stream's CPU and memory from /proc, admits new streams only while
+the host budget has room (queueing or rejecting the rest), and applies nice
+levels and CPU affinity per priority class
+"""
+
+import logging
+import time
+import os
+from config import Config
+
+PRIORITY_CLASSES = ('high', 'normal', 'low')
+
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+class AdmissionRejected(Exception):
+    """A stream doesn't fit the resource budget and the policy is to reject"""
+
+def parse_priority_map(spec, parse_value):
+    """Parse 'high=...;low=...' into {priority class: value}"""
+    result = {}
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        name, sep, value = entry.partition('=')
+        name = name.strip().lower()
+        if not sep or name not in PRIORITY_CLASSES:
+            raise ValueError(f"Invalid priority setting '{entry}', expected <{'|'.join(PRIORITY_CLASSES)}>=<value>")
+        result[name] = parse_value(value.strip())
+    return result
+
+def parse_cpu_list(spec):
+    """Parse a CPU list such as '0-3,6' into a set of CPU numbers"""
+    cpus = set()
+    for part in filter(None, spec.split(',')):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _encoding(source_key):
+    """Settings that decide a source's cost: codec mode, latency profile, ABR and overlay burn-in"""
+    return (*source_key[1:4], len(source_key) > 4 and source_key[4] is not None)
+
+def read_process_usage(pid):
+    """
+    CPU time and resident memory of a process from /proc
+
+    Returns:
+        tuple: (CPU seconds used, RSS in bytes), or None if unavailable
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu_seconds, resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+class StreamScheduler:
+    """
+    Admission control for StreamManager; all state is guarded by the manager's lock
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.queue = []
+        self._samples = {}
+        self.cpu_count = os.cpu_count() or 1
+        self.nice_levels = parse_priority_map(Config.STREAM_NICE_LEVELS, int)
+        self.affinity = self._available_affinity(parse_priority_map(Config.STREAM_CPU_AFFINITY, parse_cpu_list))
+
+    def _available_affinity(self, affinity):
+        """Drop CPUs this process may not run on, so a bad setting can't make every launch fail"""
+        if not hasattr(os, 'sched_getaffinity'):
+            return {}
+        allowed = os.sched_getaffinity(0)
+        result = {}
+        for name, cpus in affinity.items():
+            usable = cpus & allowed
+            if usable != cpus:
+                logging.warning(f"CPU affinity for {name} streams limited to available CPUs {sorted(usable)}")
+            if usable:
+                result[name] = usable
+        return result
+
+    @property
+    def cpu_budget(self):
+        """CPU the streams may use together, in percent of one core (0 = unlimited)"""
+        return Config.STREAM_CPU_BUDGET * self.cpu_count
+
+    @property
+    def rss_budget(self):
+        """Memory the streams may use together, in MB (0 = unlimited)"""
+        return Config.STREAM_RSS_BUDGET_MB
+
+    def preexec_fn(self, priority):
+        """Child setup for an FFmpeg launch: own process group, nice level and CPU affinity"""
+        nice = self.nice_levels.get(priority, 0)
+        cpus = self.affinity.get(priority)
+
+        def setup():
+            os.setsid()  # Create new process group
+            if nice:
+                os.nice(nice)
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+        return setup
+
+    def _sources(self):
+        """Distinct stream sources (stream IDs sharing a process map to one dict)"""
+        return list({id(stream): stream for stream in self.manager.active_streams.values()}.values())
+
+    def sample(self):
+        """Measure CPU and RSS of every running FFmpeg process"""
+        now = time.time()
+        seen = set()
+        for stream in self._sources():
+            process = stream['process']
+            if process is None or process.poll() is not None:
+                stream['resources'] = None
+                continue
+            usage = read_process_usage(process.pid)
+            if usage is None:
+                continue
+            cpu_seconds, rss = usage
+            seen.add(process.pid)
+            previous = self._samples.get(process.pid)
+            self._samples[process.pid] = (cpu_seconds, now)
+            cpu_percent = None
+            if previous is not None and now > previous[1]:
+                cpu_percent = round((cpu_seconds - previous[0]) / (now - previous[1]) * 100, 1)
+            elif stream['resources']:
+                cpu_percent = stream['resources']['cpu_percent']
+            stream['resources'] = {'cpu_percent': cpu_percent, 'rss_mb': round(rss / (1024 * 1024), 1)}
+        for pid in set(self._samples) - seen:
+            del self._samples[pid]
+
+    def estimate(self, source_key):
+        """
+        Expected (CPU percent of one core, RSS MB) of a stream: the average of measured
+        streams with the same encoding settings, or the configured defaults
+        """
+        measured = [
+            stream['resources'] for stream in self._sources()
+            if _encoding(stream['source_key']) == _encoding(source_key)
+            and stream['resources'] and stream['resources']['cpu_percent'] is not None
+        ]
+        if not measured:
+            return Config.STREAM_CPU_ESTIMATE, Config.STREAM_RSS_ESTIMATE_MB
+        return (
+            sum(usage['cpu_percent'] for usage in measured) / len(measured),
+            sum(usage['rss_mb'] for usage in measured) / len(measured),
+        )
+
+    def committed(self):
+        """Resources held by admitted streams: measured where possible, estimated otherwise"""
+        cpu = rss = 0.0
+        for stream in self._sources():
+            if stream['state'] in ('queued', 'failed'):
+                continue
+            usage = stream['resources']
+            if usage and usage['cpu_percent'] is not None:
+                cpu += usage['cpu_percent']
+                rss += usage['rss_mb']
+            else:
+                estimated_cpu, estimated_rss = self.estimate(stream['source_key'])
+                cpu += estimated_cpu
+                rss += estimated_rss
+        # Other workers on the host draw from the same budget
+        for source in self.manager.remote_sources():
+            info = source['info'] or {}
+            if info.get('status') in (None, 'queued', 'failed'):
+                continue
+            usage = info.get('resources')
+            if usage and usage['cpu_percent'] is not None:
+                cpu += usage['cpu_percent']
+                rss += usage['rss_mb']
+            else:
+                estimated_cpu, estimated_rss = self.estimate(tuple(source['entry']['source_key']))
+                cpu += estimated_cpu
+                rss += estimated_rss
+        return cpu, rss
+
+    def fits(self, source_key):
+        """Whether one more stream with these settings stays within the budget"""
+        cpu, rss = self.committed()
+        estimated_cpu, estimated_rss = self.estimate(source_key)
+        if self.cpu_budget and cpu + estimated_cpu > self.cpu_budget:
+            return False
+        if self.rss_budget and rss + estimated_rss > self.rss_budget:
+            return False
+        return True
+
+    def admit(self, stream):
+        """
+        Decide whether a new source can start now
+
+        Returns:
+            bool: True to start it, False if it has been queued
+
+        Raises:
+            AdmissionRejected: The budget is full and STREAM_ADMISSION is 'reject'
+        """
+        # Streams already waiting go first, so a small stream can't keep overtaking them
+        if not self.queue and self.fits(stream['source_key']):
+            return True
+        if Config.STREAM_ADMISSION == 'reject':
+            cpu, rss = self.committed()
+            cpu_budget = f"{self.cpu_budget:.0f}%" if self.cpu_budget else 'unlimited'
+            raise AdmissionRejected(
+                f"Stream resource budget exhausted (CPU {cpu:.0f}% of {cpu_budget}, "
+                f"memory {rss:.0f} of {self.rss_budget or 'unlimited'} MB)"
+            )
+        stream['state'] = 'queued'
+        self.queue.append(stream)
+        self.queue.sort(key=lambda queued: (PRIORITY_CLASSES.index(queued['priority']), queued['requested_at']))
+        logging.warning(f"Stream {stream['output_name']} queued, resource budget is full ({len(self.queue)} waiting)")
+        return False
+
+    def admit_queued(self):
+        """Start queued streams, highest priority first, while the budget has room"""
+        admitted = []
+        while self.queue:
+            stream = self.queue[0]
+            if not any(s is stream for s in self.manager.active_streams.values()):
+                self.queue.pop(0)  # Stopped while waiting
+                continue
+            if not self.fits(stream['source_key']):
+                break
+            self.queue.pop(0)
+            admitted.append(stream)
+            # Committed from now on, so the next queued stream is measured against it
+            stream['state'] = 'starting'
+        return admitted
+
+    def dequeue(self, stream):
+        """Remove a stream that was stopped while waiting"""
+        self.queue = [queued for queued in self.queue if queued is not stream]
+
+    def queue_position(self, stream):
+        """1-based position of a queued stream, or None"""
+        for position, queued in enumerate(self.queue, 1):
+            if queued is stream:
+                return position
+        return None
+
+    def get_stats(self):
+        """Budget, current use and queue depth"""
+        cpu, rss = self.committed()
+        return {
+            'admission': Config.STREAM_ADMISSION,
+            'queue_depth': len(self.queue),
+            'cpu_count': self.cpu_count,
+            'cpu_budget_percent': self.cpu_budget or None,
+            'cpu_committed_percent': round(cpu, 1),
+            'rss_budget_mb': self.rss_budget or None,
+            'rss_committed_mb': round(rss, 1)
+        }
@@ -0,0 +1,139 @@
+"""
+Stream supervisor
+Watches each stream's FFmpeg process and HLS output freshness, and restarts
+dead or stalled streams with capped exponential backoff and jitter
+"""
+
+import threading
+import logging
+import random
+import time
+import os
+from config import Config
+
+# A stream that has been healthy this long starts its backoff from scratch again
+HEALTHY_RESET_SECONDS = 60
+
+class StreamSupervisor:
+    def __init__(self, manager):
+        self.manager = manager
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the supervision thread (idempotent)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='stream-supervisor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Supervision loop"""
+        while True:
+            time.sleep(Config.STREAM_SUPERVISOR_INTERVAL)
+            # Separate steps, so a failing one can't stop the others (sync_shared heartbeats
+            # this worker; skipping it would get its streams taken over)
+            for step in (self.check_streams, self.manager.schedule, self.manager.sync_shared):
+                try:
+                    step()
+                except Exception as e:
+                    logging.error(f"Error supervising streams ({step.__name__}): {e}")
+
+    def check_streams(self):
+        """Check every stream once, restarting the ones that need it"""
+        with self.manager._lock:
+            # Stream IDs sharing an FFmpeg process map to the same dict; check each process once
+            stream_ids = list({
+                id(stream): stream_id for stream_id, stream in self.manager.active_streams.items()
+            }.values())
+        for stream_id in stream_ids:
+            try:
+                self._check_stream(stream_id, time.time())
+            except Exception as e:
+                logging.error(f"Error checking stream {stream_id}: {e}")
+
+    def _check_stream(self, stream_id, now):
+        with self.manager._lock:
+            stream = self.manager.active_streams.get(stream_id)
+            if stream is None or stream['state'] == 'failed':
+                return
+            if stream['state'] == 'restarting':
+                if now < stream['next_restart_at']:
+                    return
+                try:
+                    launched = self.manager._launch(stream)
+                    reason = "Restart failed: FFmpeg was not launched"
+                except Exception as e:
+                    launched = False
+                    reason = f"Restart failed: {e}"
+                if launched:
+                    logging.info(f"Restarted stream {stream_id} (restart #{stream['restarts']})")
+                    return
+                if self.manager.active_streams.get(stream_id) is not stream:
+                    return  # Stopped in the meantime
+                self._record_failure(stream_id, stream, reason, now)
+                process = None
+            else:
+                reason = self._failure_reason(stream, now)
+                if reason is None:
+                    if stream['consecutive_failures'] and now - stream['started_at'] > HEALTHY_RESET_SECONDS:
+                        stream['consecutive_failures'] = 0
+                    return
+                process = stream['process']
+                stream['process'] = None
+
+        if process is not None:
+            # Terminating may wait for FFmpeg to exit, so don't hold the manager lock
+            self.manager._terminate(stream_id, process)
+            with self.manager._lock:
+                if self.manager.active_streams.get(stream_id) is not stream:
+                    return
+                self._record_failure(stream_id, stream, reason, now)
+        with self.manager._lock:
+            self.manager._save_registry()
+        self.manager._notify('stream_failed', stream)
+
+    def _failure_reason(self, stream, now):
+        """Why a running stream needs a restart, or None if it's healthy"""
+        process = stream['process']
+        if process is None:
+            return None
+        return_code = process.poll()
+        if return_code is not None:
+            last_line = (stream['telemetry'].recent_log(1) or [''])[0] if stream['telemetry'] else ''
+            return f"FFmpeg exited with code {return_code}" + (f": {last_line}" if last_line else '')
+
+        try:
+            last_output = os.path.getmtime(stream['watch_path'])
+        except OSError:
+            last_output = None
+        if last_output is not None and last_output >= stream['started_at']:
+            age = now - last_output
+            if age > Config.STREAM_STALL_TIMEOUT:
+                return f"No new HLS output for {age:.0f}s"
+        elif now - stream['started_at'] > Config.STREAM_STARTUP_TIMEOUT:
+            return f"No HLS output {Config.STREAM_STARTUP_TIMEOUT:.0f}s after start"
+        return None
+
+    def _record_failure(self, stream_id, stream, reason, now):
+        """Schedule a restart with backoff, or give up after too many failures in a row"""
+        stream['last_failure'] = {'reason': reason, 'at': now}
+        stream['consecutive_failures'] += 1
+
+        if stream['consecutive_failures'] > Config.STREAM_MAX_RESTARTS:
+            stream['state'] = 'failed'
+            self.manager._retire_source(stream)
+            logging.error(f"Stream {stream_id} failed {stream['consecutive_failures']} times in a row, giving up: {reason}")
+            return
+
+        backoff = min(
+            Config.STREAM_RESTART_BACKOFF * 2 ** (stream['consecutive_failures'] - 1),
+            Config.STREAM_RESTART_BACKOFF_MAX
+        )
+        # Jitter keeps cameras behind the same failed link from restarting in lockstep
+        delay = backoff * random.uniform(0.8, 1.2)
+        stream['state'] = 'restarting'
+        stream['restarts'] += 1
+        stream['next_restart_at'] = now + delay
+        logging.warning(f"Stream {stream_id} unhealthy ({reason}), restarting in {delay:.1f}s")
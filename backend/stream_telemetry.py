@@ -0,0 +1,138 @@
+"""
+FFmpeg output draining and transcode telemetry
+Reads `-progress` key=value blocks from stdout and keeps the tail of stderr,
+so neither pipe can fill up and stall FFmpeg
+
+FFmpeg processes that must outlive the backend write both streams to files
+instead, which are tailed (and truncated once large) the same way
+"""
+
+import threading
+import logging
+import time
+import os
+from collections import deque
+
+# Encoding below this fraction of real time means the stream is falling behind
+REALTIME_SPEED_THRESHOLD = 0.95
+# Output files are truncated once they grow past this; FFmpeg opens them with O_APPEND
+MAX_OUTPUT_FILE_BYTES = 1024 * 1024
+TAIL_POLL_INTERVAL = 0.5
+
+def tail_lines(path, process):
+    """
+    Yield complete lines appended to a file until the process has exited
+
+    Starts near the end of the file, so adopting a long-running process doesn't
+    replay its whole history
+    """
+    with open(path, 'rb') as f:
+        f.seek(max(os.path.getsize(path) - 64 * 1024, 0))
+        partial = b''
+        while True:
+            chunk = f.readline()
+            if chunk:
+                partial += chunk
+                if partial.endswith(b'\n'):
+                    yield partial
+                    partial = b''
+                continue
+            if process.poll() is not None:
+                return
+            if f.tell() > MAX_OUTPUT_FILE_BYTES:
+                # Writers append at the end of file, so they carry on at offset 0
+                os.truncate(path, 0)
+                f.seek(0)
+            time.sleep(TAIL_POLL_INTERVAL)
+
+class StreamTelemetry:
+    def __init__(self, stream_id, process, log_lines=200, progress_path=None, log_path=None):
+        self.stream_id = stream_id
+        self.process = process
+        self.progress_path = progress_path
+        self.log_path = log_path
+        self._log = deque(maxlen=log_lines)
+        self._progress = {}
+        self._updated_at = None
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start one reader thread per pipe"""
+        for target, name in ((self._read_progress, 'progress'), (self._read_log, 'log')):
+            thread = threading.Thread(
+                target=target, name=f"ffmpeg-{name}-{self.stream_id}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _lines(self, pipe_name, path):
+        """Lines of one FFmpeg output, from its pipe or the file it writes to"""
+        if path is not None:
+            return tail_lines(path, self.process)
+        return iter(getattr(self.process, pipe_name).readline, b'')
+
+    def _read_progress(self):
+        """Parse `-progress pipe:1` output; each block ends with a progress= line"""
+        block = {}
+        try:
+            for raw in self._lines('stdout', self.progress_path):
+                key, sep, value = raw.decode('utf-8', 'replace').strip().partition('=')
+                if not sep:
+                    continue
+                block[key] = value
+                if key == 'progress':
+                    with self._lock:
+                        self._progress = block
+                        self._updated_at = time.time()
+                    block = {}
+        except Exception as e:
+            logging.debug(f"Progress reader for {self.stream_id} stopped: {e}")
+
+    def _read_log(self):
+        """Keep the most recent stderr lines in a bounded ring buffer"""
+        try:
+            for raw in self._lines('stderr', self.log_path):
+                line = raw.decode('utf-8', 'replace').rstrip()
+                if line:
+                    with self._lock:
+                        self._log.append(line)
+        except Exception as e:
+            logging.debug(f"Log reader for {self.stream_id} stopped: {e}")
+
+    def recent_log(self, lines=20):
+        """Last lines of FFmpeg's stderr"""
+        with self._lock:
+            return list(self._log)[-lines:]
+
+    def snapshot(self):
+        """Latest transcode figures"""
+        with self._lock:
+            progress = dict(self._progress)
+            updated_at = self._updated_at
+
+        speed = _parse_number(progress.get('speed', '').rstrip('x'))
+        out_time_us = _parse_number(progress.get('out_time_us'))
+        return {
+            'frame': _parse_int(progress.get('frame')),
+            'fps': _parse_number(progress.get('fps')),
+            'bitrate_kbps': _parse_number(progress.get('bitrate', '').replace('kbits/s', '')),
+            'speed': speed,
+            'out_time_s': round(out_time_us / 1_000_000, 3) if out_time_us is not None else None,
+            'dropped_frames': _parse_int(progress.get('drop_frames')),
+            'duplicated_frames': _parse_int(progress.get('dup_frames')),
+            'falling_behind': speed is not None and speed < REALTIME_SPEED_THRESHOLD,
+            'last_update_age_s': round(time.time() - updated_at, 1) if updated_at else None,
+        }
+
+def _parse_number(value):
+    """Parse an FFmpeg progress value; 'N/A' and missing values become None"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _parse_int(value):
+    number = _parse_number(value)
+    return int(number) if number is not None else None
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Backend modules are imported flat, as app.py does
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Config is read at import time: keep the app off MongoDB and out of the working tree
+TEST_DATA_DIR = tempfile.mkdtemp(prefix='rtsp-overlay-tests-')
+os.environ.update({
+    'OVERLAY_STORAGE': 'memory',
+    'HEALTH_PROBE_INTERVAL': '300',
+    'HLS_OUTPUT_DIR': os.path.join(TEST_DATA_DIR, 'hls'),
+    'STREAM_STATE_DIR': os.path.join(TEST_DATA_DIR, 'stream_state'),
+    'DVR_DIR': os.path.join(TEST_DATA_DIR, 'recordings'),
+    'OVERLAY_IMAGE_CACHE_DIR': os.path.join(TEST_DATA_DIR, 'overlay_images'),
+})
+
+
+@pytest.fixture(scope='session')
+def app():
+    """The Flask app; module singletons (stores, socketio) make it one per session"""
+    from app import create_app
+    return create_app()
+
+
+@pytest.fixture
+def client(app):
+    """Test client over an empty in-memory overlay store"""
+    import routes
+    from storage import MemoryStore
+    routes.overlay_model.store = MemoryStore()
+    routes._overlay_list_cache.clear()
+    return app.test_client()
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    """Socket.IO events emitted by the server, as (event, data, kwargs)"""
+    from socketio_manager import socketio
+    events = []
+    monkeypatch.setattr(socketio, 'emit', lambda event, data=None, **kwargs: events.append((event, data, kwargs)))
+    return events
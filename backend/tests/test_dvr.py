@@ -0,0 +1,113 @@
+"""
+DVR: filing live segments, retention by age and disk budget, VOD playlists for a time range
+"""
+
+import os
+import threading
+import time
+import types
+
+import pytest
+
+from config import Config
+from dvr import DvrRecorder
+
+# The top of an hour (UTC)
+HOUR = 1700002800
+
+
+@pytest.fixture
+def recorder(tmp_path):
+    return DvrRecorder(None, str(tmp_path / 'recordings'))
+
+
+def record(recorder, name, start, duration=2.0, size=100):
+    """File a recorded segment of `size` bytes starting at `start`"""
+    source = os.path.join(recorder.root, f'.{name}-{start}.ts')
+    os.makedirs(recorder.root, exist_ok=True)
+    with open(source, 'wb') as f:
+        f.write(b'\0' * size)
+    assert recorder._file_segment(name, source, {'start': start, 'duration': duration})
+    os.remove(source)
+
+
+def recorded(recorder, name):
+    return [start for start, _, _ in recorder._iter_segments(name)]
+
+
+def test_files_new_segments_of_the_live_playlist(tmp_path):
+    hls_dir = tmp_path / 'hls'
+    hls_dir.mkdir()
+    for sequence in (1, 2):
+        (hls_dir / f'cam{sequence}.ts').write_bytes(b'segment')
+    playlist = hls_dir / 'cam.m3u8'
+    playlist.write_text(
+        '#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:1\n'
+        '#EXT-X-PROGRAM-DATE-TIME:2023-11-14T23:00:00.000+0000\n'
+        '#EXTINF:2.000,\ncam1.ts\n#EXTINF:2.000,\ncam2.ts\n'
+    )
+    stream = {'output_name': 'cam', 'record': True, 'process': object(), 'watch_path': str(playlist)}
+    manager = types.SimpleNamespace(_lock=threading.RLock(), active_streams={'cam': stream, 'lobby': stream})
+    recorder = DvrRecorder(manager, str(tmp_path / 'recordings'))
+
+    recorder.record_segments()
+    assert recorded(recorder, 'cam') == [HOUR, HOUR + 2]
+    assert os.path.exists(tmp_path / 'recordings' / 'cam' / '20231114' / '23' / f'{HOUR * 1000}_2000.ts')
+    # Hard links, not copies
+    assert os.path.samefile(hls_dir / 'cam1.ts', tmp_path / 'recordings' / 'cam' / '20231114' / '23' / f'{HOUR * 1000}_2000.ts')
+
+
+def test_retention_by_age_then_disk_budget(recorder, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(Config, 'DVR_RETENTION_HOURS', 1)
+    # Room for two of the four segments that are young enough to keep
+    monkeypatch.setattr(Config, 'DVR_MAX_DISK_MB', 1000 / (1024 * 1024))
+    for start in (now - 7200, now - 100, now - 96, now - 94):
+        record(recorder, 'cam', start, size=400)
+    record(recorder, 'lobby', now - 98, size=400)
+
+    recorder.enforce_retention()
+    # The expired segment goes first, then the oldest ones across all streams
+    assert recorded(recorder, 'cam') == [pytest.approx(now - 96, abs=0.001), pytest.approx(now - 94, abs=0.001)]
+    assert recorded(recorder, 'lobby') == []
+    # Emptied hour, day and stream directories are removed too
+    assert os.listdir(recorder.root) == ['cam']
+    assert len(os.listdir(os.path.join(recorder.root, 'cam'))) == 1
+
+
+def test_no_limits(recorder, monkeypatch):
+    monkeypatch.setattr(Config, 'DVR_RETENTION_HOURS', 0)
+    monkeypatch.setattr(Config, 'DVR_MAX_DISK_MB', 0)
+    record(recorder, 'cam', HOUR)
+    recorder.enforce_retention()
+    assert recorded(recorder, 'cam') == [HOUR]
+
+
+def test_vod_playlist_marks_gaps(recorder):
+    # Two segments in the previous hour, then a gap after an FFmpeg restart
+    for start in (HOUR - 4, HOUR - 2, HOUR, HOUR + 2, HOUR + 10, HOUR + 12, HOUR + 14):
+        record(recorder, 'cam', start)
+
+    lines = recorder.vod_playlist('cam', HOUR - 1, HOUR + 13).splitlines()
+    assert lines[:5] == [
+        '#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    assert lines[5:] == [
+        # The segment filed under the previous hour runs into the range
+        '#EXT-X-PROGRAM-DATE-TIME:2023-11-14T22:59:58.000+00:00',
+        '#EXTINF:2.000,', f'/recordings/cam/20231114/22/{(HOUR - 2) * 1000}_2000.ts',
+        '#EXTINF:2.000,', f'/recordings/cam/20231114/23/{HOUR * 1000}_2000.ts',
+        '#EXTINF:2.000,', f'/recordings/cam/20231114/23/{(HOUR + 2) * 1000}_2000.ts',
+        '#EXT-X-DISCONTINUITY',
+        '#EXT-X-PROGRAM-DATE-TIME:2023-11-14T23:00:10.000+00:00',
+        '#EXTINF:2.000,', f'/recordings/cam/20231114/23/{(HOUR + 10) * 1000}_2000.ts',
+        '#EXTINF:2.000,', f'/recordings/cam/20231114/23/{(HOUR + 12) * 1000}_2000.ts',
+        '#EXT-X-ENDLIST',
+    ]
+
+
+def test_vod_playlist_of_an_empty_range(recorder):
+    record(recorder, 'cam', HOUR)
+    assert recorder.vod_playlist('cam', HOUR + 60, HOUR + 120) is None
+    assert recorder.vod_playlist('lobby', HOUR, HOUR + 60) is None
+    assert recorder.vod_playlist('..', HOUR, HOUR + 60) is None
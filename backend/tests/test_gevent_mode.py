@@ -0,0 +1,127 @@
+"""
+ASYNC_MODE=gevent runs in a subprocess: Config is read at import time and the
+event loop hub must not leak into other tests
+"""
+
+import subprocess
+import textwrap
+import sys
+import os
+from conftest import BACKEND_DIR
+
+SCRIPT = textwrap.dedent('''
+    import socket
+    import threading
+    import time
+    import gevent
+    from gevent import monkey
+    from app import create_app
+    from blocking_pool import blocking_pool
+    from message_queue import socketio_options
+
+    assert not monkey.is_module_patched('socket'), 'sockets must stay usable from any OS thread'
+    app = create_app()
+    client = app.test_client()
+
+    ticks = []
+    def tick():
+        while True:
+            ticks.append(time.monotonic())
+            gevent.sleep(0.01)
+    gevent.spawn(tick)
+
+    # A socket created on the loop and waited on by pool threads, like PyMongo's pooled
+    # connections (a gevent socket raises "Cannot switch to a different thread" here)
+    left, right = socket.socketpair()
+    threads = set()
+    def receive():
+        threads.add(threading.get_ident())
+        return right.recv(1)
+    def send():
+        threads.add(threading.get_ident())
+        time.sleep(0.1)
+        left.sendall(b'x')
+    jobs = [gevent.spawn(blocking_pool.run, receive), gevent.spawn(blocking_pool.run, send)]
+    gevent.joinall(jobs, raise_error=True)
+    assert jobs[0].value == b'x'
+    assert len(threads) == 2 and threading.get_ident() not in threads, threads
+
+    # Blocking calls on the pool don't stall the loop
+    ticks.clear()
+    blocking_pool.run(time.sleep, 0.3)
+    assert len(ticks) >= 10, len(ticks)
+
+    # Overlay calls, including the streamed page's cursor, go through the pool
+    for i in range(5):
+        response = client.post('/api/overlays', json={
+            'type': 'text', 'content': f'overlay {i}',
+            'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+        })
+        assert response.status_code == 201, response.data
+    page = client.get('/api/overlays?limit=3').get_json()
+    assert len(page['overlays']) == 3 and page['next_after'], page
+    assert client.get('/health').get_json()['server']['async_mode'] == 'gevent'
+
+    # The Socket.IO queue listens on the pool while the loop keeps running
+    manager = socketio_options('sqlite:///queue.db')['client_manager']
+    assert type(manager).__name__ == 'OffloadedSQLiteQueueManager'
+    messages = manager._listen()
+    receiver = gevent.spawn(next, messages)
+    gevent.sleep(0.1)
+    ticks.clear()
+    manager._publish({'method': 'emit', 'event': 'ping'})
+    assert receiver.get(timeout=5) is not None
+    print('ok')
+''')
+
+# Pages larger than one worker pool batch (models.ITER_BATCH_SIZE) from a store whose
+# connections belong to the thread that opened them
+SQLITE_PAGING_SCRIPT = textwrap.dedent('''
+    import gevent
+    from app import create_app
+    from models import ITER_BATCH_SIZE
+
+    client = create_app().test_client()
+    count = ITER_BATCH_SIZE * 2 + 50
+    response = client.post('/api/overlays/bulk', json={'overlays': [{
+        'type': 'text', 'content': f'overlay {i}',
+        'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+    } for i in range(count)]})
+    assert response.status_code == 201, response.data
+
+    # Concurrent listings, so successive batches of one listing run on different pool threads
+    def list_all():
+        return client.get('/api/overlays?limit=1000').get_json()
+    listings = [gevent.spawn(list_all) for _ in range(8)]
+    gevent.joinall(listings, raise_error=True)
+    for page in (listing.value for listing in listings):
+        assert 'error' not in page and len(page['overlays']) == count, (len(page['overlays']), page.get('error'))
+
+    seen, after = [], ''
+    while True:
+        page = client.get(f'/api/overlays?limit={ITER_BATCH_SIZE + 20}&after={after}&fields=content').get_json()
+        assert 'error' not in page, page['error']
+        seen += [overlay['_id'] for overlay in page['overlays']]
+        if not page['next_after']:
+            break
+        after = page['next_after']
+    assert seen == sorted(set(seen)) and len(seen) == count
+    print('ok')
+''')
+
+def _run_gevent(tmp_path, script, **overrides):
+    env = dict(
+        os.environ, PYTHONPATH=BACKEND_DIR, ASYNC_MODE='gevent', OVERLAY_STORAGE='memory',
+        HEALTH_PROBE_INTERVAL='300', HLS_OUTPUT_DIR=str(tmp_path / 'hls')
+    )
+    env.update(overrides)
+    result = subprocess.run(
+        [sys.executable, '-c', script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0 and result.stdout.strip().endswith('ok'), result.stderr[-3000:]
+
+def test_gevent_mode(tmp_path):
+    _run_gevent(tmp_path, SCRIPT)
+
+def test_gevent_mode_pages_sqlite_past_one_batch(tmp_path):
+    _run_gevent(tmp_path, SQLITE_PAGING_SCRIPT, OVERLAY_STORAGE='sqlite', SQLITE_PATH=str(tmp_path / 'overlays.db'))
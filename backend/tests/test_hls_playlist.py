@@ -0,0 +1,89 @@
+"""
+Blocking playlist reload and low-latency playlist tags
+"""
+
+import os
+import types
+
+import pytest
+
+import hls_playlist
+from hls_playlist import SERVER_CONTROL_TAG, add_server_control, wait_for_segment
+
+
+def playlist(first, count, target_duration=2):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target_duration}', f'#EXT-X-MEDIA-SEQUENCE:{first}']
+    for sequence in range(first, first + count):
+        lines += ['#EXTINF:2.000000,', f'cam{sequence}.ts']
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'cam.m3u8'
+    path.write_text(playlist(1700000000, 3))
+    return str(path)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake wall clock for the deadline; sleeping advances it"""
+    clock = types.SimpleNamespace(now=1000.0, sleeps=0)
+    monkeypatch.setattr(hls_playlist, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def fake_sleep(clock, on_sleep=None):
+    def sleep(seconds):
+        clock.now += seconds
+        clock.sleeps += 1
+        if on_sleep:
+            on_sleep(clock.sleeps)
+    return sleep
+
+
+def test_segment_already_in_the_playlist(path, clock):
+    status, text = wait_for_segment(path, 1700000001, sleep=fake_sleep(clock))
+    assert status == 200
+    assert 'cam1700000002.ts' in text
+    assert clock.sleeps == 0
+
+
+def test_waits_until_the_segment_appears(path, clock):
+    def publish(sleeps):
+        if sleeps == 3:
+            with open(path, 'w') as f:
+                f.write(playlist(1700000001, 3))
+            # A new mtime, however coarse the filesystem's timestamps
+            os.utime(path, (2000, 2000))
+    status, text = wait_for_segment(path, 1700000003, sleep=fake_sleep(clock, publish))
+    assert status == 200
+    assert text.splitlines()[-1] == 'cam1700000003.ts'
+    assert clock.sleeps == 3
+
+
+def test_times_out_after_three_target_durations(path, clock):
+    status, text = wait_for_segment(path, 1700000003, poll_interval=0.5, sleep=fake_sleep(clock))
+    # The current playlist, once three target durations (2s) have passed
+    assert status == 200
+    assert text == playlist(1700000000, 3)
+    assert clock.now == pytest.approx(1006.0)
+    assert clock.sleeps == 12
+
+
+def test_too_far_ahead_is_a_400(path, clock):
+    assert wait_for_segment(path, 1700000005, sleep=fake_sleep(clock)) == (400, None)
+    assert clock.sleeps == 0
+
+
+def test_missing_playlist_is_a_404(tmp_path, clock):
+    assert wait_for_segment(str(tmp_path / 'nope.m3u8'), 1, sleep=fake_sleep(clock)) == (404, None)
+
+
+def test_add_server_control():
+    text = add_server_control(playlist(5, 1))
+    lines = text.splitlines()
+    assert lines[:2] == ['#EXTM3U', SERVER_CONTROL_TAG]
+    assert lines[2:] == playlist(5, 1).splitlines()[1:]
+    # Already advertised: unchanged
+    assert add_server_control(text) == text
@@ -0,0 +1,133 @@
+"""
+Prometheus metrics: the /metrics exposition format and per-operation storage timings
+"""
+
+import re
+
+import pytest
+
+import metrics
+import routes
+from metrics import MetricsRegistry
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+
+def parse_exposition(text):
+    """
+    Parse the Prometheus text format strictly enough to catch malformed output
+
+    Returns:
+        dict: {family: {'type', 'help', 'samples': [(name, labels, value)]}}
+    """
+    assert text.endswith('\n')
+    families = {}
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            name, _, documentation = line[7:].partition(' ')
+            assert name not in families, f'{name} is described twice'
+            families[name] = {'help': documentation, 'type': None, 'samples': []}
+        elif line.startswith('# TYPE '):
+            name, kind = line[7:].split(' ')
+            assert families[name]['type'] is None and not families[name]['samples']
+            assert kind in ('counter', 'gauge', 'histogram')
+            families[name]['type'] = kind
+        else:
+            match = SAMPLE.match(line)
+            assert match, f'Malformed sample line: {line!r}'
+            name, label_text, value = match.groups()
+            labels = dict(LABEL.findall(label_text or ''))
+            assert ''.join(f'{k}="{v}",' for k, v in labels.items()).rstrip(',') == (label_text or '')
+            float(value.replace('+Inf', 'inf'))
+            family = name
+            if name not in families:
+                family = re.sub(r'_(bucket|sum|count)$', '', name)
+                assert families[family]['type'] == 'histogram', f'{name} has no HELP/TYPE'
+            families[family]['samples'].append((name, labels, value))
+    return families
+
+
+def check_histogram(family, samples):
+    """Cumulative buckets ending in +Inf, then _sum and _count, for every label set"""
+    series = {}
+    for name, labels, value in samples:
+        key = tuple(sorted((k, v) for k, v in labels.items() if k != 'le'))
+        series.setdefault(key, []).append((name, labels.get('le'), value))
+    for entries in series.values():
+        buckets = [(le, int(value)) for name, le, value in entries if name == f'{family}_bucket']
+        assert buckets[-1][0] == '+Inf'
+        bounds = [float(le) for le, _ in buckets[:-1]]
+        assert bounds == sorted(bounds)
+        counts = [count for _, count in buckets]
+        assert counts == sorted(counts)
+        assert [name for name, _, _ in entries[len(buckets):]] == [f'{family}_sum', f'{family}_count']
+        assert int(entries[-1][2]) == counts[-1]
+
+
+def test_metrics_endpoint_is_valid_exposition(client):
+    client.get('/api/overlays')
+    # Not a valid overlay ID
+    assert client.get('/api/overlays/missing').status_code == 400
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type == metrics.CONTENT_TYPE
+
+    families = parse_exposition(response.get_data(as_text=True))
+    for name, family in families.items():
+        assert family['type'] is not None, f'{name} has no TYPE'
+        if family['type'] == 'histogram':
+            check_histogram(name, family['samples'])
+
+    requests = families['http_request_duration_seconds']['samples']
+    assert any(
+        labels.get('route') == '/api/overlays/<overlay_id>' and labels.get('status') == '400'
+        for _, labels, _ in requests
+    )
+    assert families['overlay_store_operation_duration_seconds']['samples']
+    assert families['ffmpeg_available']['type'] == 'gauge'
+
+
+def test_histogram_and_counter_rendering():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0))
+    counter = registry.counter('errors_total', 'Errors', ('reason',))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, route='/a')
+    counter.inc(reason='quote " and \\ and\nnewline')
+
+    assert registry.render().splitlines() == [
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1.0"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 4.25',
+        'latency_seconds_count{route="/a"} 4',
+        '# HELP errors_total Errors',
+        '# TYPE errors_total counter',
+        'errors_total{reason="quote \\" and \\\\ and\\nnewline"} 1',
+    ]
+    parse_exposition(registry.render())
+
+
+def test_timed_operation_records_errors_per_operation(client, monkeypatch):
+    def errors(operation):
+        return metrics.overlay_operation_errors._values.get((operation, 'memory'), 0)
+
+    def calls(operation):
+        series = metrics.overlay_operation_duration._series.get((operation, 'memory'))
+        return series[2] if series else 0
+
+    before = {operation: (errors(operation), calls(operation)) for operation in ('get_by_id', 'get_all')}
+
+    def broken(overlay_id):
+        raise RuntimeError('storage unavailable')
+    monkeypatch.setattr(routes.overlay_model.store, 'get_by_id', broken)
+    with pytest.raises(RuntimeError):
+        routes.overlay_model.get_by_id('abc')
+    routes.overlay_model.get_all()
+
+    # The failed call is timed as well as counted, and only under its own operation
+    assert (errors('get_by_id'), calls('get_by_id')) == (before['get_by_id'][0] + 1, before['get_by_id'][1] + 1)
+    assert (errors('get_all'), calls('get_all')) == (before['get_all'][0], before['get_all'][1] + 1)
@@ -0,0 +1,116 @@
+"""
+Bulk overlay endpoints: per-item results, multi-status and one event per stream room
+"""
+
+import pytest
+
+
+def overlay(content, stream_id='a'):
+    return {
+        'type': 'text', 'content': content, 'stream_id': stream_id,
+        'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+    }
+
+
+def bulk_events(emitted):
+    return {kwargs['to']: data for event, data, kwargs in emitted if event == 'overlays_bulk'}
+
+
+@pytest.fixture
+def created(client, emitted):
+    response = client.post('/api/overlays/bulk', json={'overlays': [
+        overlay('a1'), overlay('b1', 'b'), overlay('a2')
+    ]})
+    assert response.status_code == 201
+    emitted.clear()
+    return [result['id'] for result in response.get_json()['results']]
+
+
+def test_bulk_create_mixed(client, emitted):
+    response = client.post('/api/overlays/bulk', json={'overlays': [
+        overlay('a1'), {'type': 'video', 'content': 'bad'}, overlay('b1', 'b'), 'not an object', overlay('a2')
+    ]})
+    assert response.status_code == 207
+    body = response.get_json()
+    assert body['created'] == 3
+    results = body['results']
+    assert [result['index'] for result in results] == [0, 1, 2, 3, 4]
+    assert all('id' in results[i] and 'errors' not in results[i] for i in (0, 2, 4))
+    assert "Type must be 'text' or 'image'" in results[1]['errors']
+    assert results[3]['errors'] == ['Overlay must be an object']
+
+    events = bulk_events(emitted)
+    assert set(events) == {'stream:a', 'stream:b'}
+    assert events['stream:a']['action'] == 'created'
+    assert [item['_id'] for item in events['stream:a']['overlays']] == [results[0]['id'], results[4]['id']]
+    assert [item['content'] for item in events['stream:b']['overlays']] == ['b1']
+
+
+def test_bulk_update_mixed(client, emitted, created):
+    a1, b1, a2 = created
+    response = client.put('/api/overlays/bulk', json={'overlays': [
+        {'id': a1, 'content': 'a1 edited'},
+        {'id': 'nope', 'content': 'x'},
+        {'id': b1, 'size': {'width': -1, 'height': 5}},
+        {'id': '0' * 24, 'content': 'missing'},
+        {'id': a2, 'stream_id': 'b'},
+        {'id': a1, 'rev': 7},
+    ]})
+    assert response.status_code == 207
+    body = response.get_json()
+    assert body['updated'] == 2
+    results = body['results']
+    assert 'error' not in results[0] and 'errors' not in results[0]
+    assert results[1]['error'] == 'Invalid overlay ID format'
+    assert results[2]['errors'] == ['Size dimensions must be positive numbers']
+    assert results[3]['error'] == 'Overlay not found'
+    assert 'error' not in results[4]
+    assert results[5]['errors'] == ['No fields to update']
+
+    # A moved overlay is announced in the room it moved to
+    events = bulk_events(emitted)
+    assert events == {
+        'stream:a': {'action': 'updated', 'overlays': [{'id': a1, 'content': 'a1 edited'}]},
+        'stream:b': {'action': 'updated', 'overlays': [{'id': a2, 'stream_id': 'b'}]},
+    }
+    assert client.get(f'/api/overlays/{a1}').get_json()['overlay']['rev'] == 2
+    assert client.get(f'/api/overlays/{b1}').get_json()['overlay']['rev'] == 1
+
+
+def test_bulk_delete_mixed(client, emitted, created):
+    a1, b1, a2 = created
+    response = client.delete('/api/overlays/bulk', json={'ids': [a1, 'nope', b1, '0' * 24, 42]})
+    assert response.status_code == 207
+    body = response.get_json()
+    assert body['deleted'] == 2
+    assert [result.get('error') for result in body['results']] == [
+        None, 'Invalid overlay ID format', None, 'Overlay not found', 'Invalid overlay ID format'
+    ]
+
+    assert bulk_events(emitted) == {
+        'stream:a': {'action': 'deleted', 'overlays': [{'id': a1}]},
+        'stream:b': {'action': 'deleted', 'overlays': [{'id': b1}]},
+    }
+    remaining = client.get('/api/overlays').get_json()['overlays']
+    assert [overlay['_id'] for overlay in remaining] == [a2]
+
+
+@pytest.mark.parametrize('method, body', [
+    ('POST', {'overlays': []}),
+    ('POST', {}),
+    ('PUT', {'overlays': 'a'}),
+    ('DELETE', {'ids': []}),
+    ('POST', {'overlays': [{}] * 501}),
+])
+def test_bulk_rejects_bad_envelopes(client, emitted, method, body):
+    response = client.open('/api/overlays/bulk', method=method, json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    assert emitted == []
+
+
+def test_bulk_all_invalid_is_a_400(client, emitted):
+    response = client.post('/api/overlays/bulk', json={'overlays': [{'type': 'text'}]})
+    assert response.status_code == 400
+    assert response.get_json()['created'] == 0
+    assert bulk_events(emitted) == {}
@@ -0,0 +1,203 @@
+"""
+Overlay burn-in: filter graph and live command building, and the decoded image files
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import overlay_burnin
+from config import Config
+from overlay_burnin import OverlayCompositor, _place_texts, fetch_image, image_path, prune_images
+
+
+def text(overlay_id, content='hello', x=10, y=10):
+    return {'id': overlay_id, 'type': 'text', 'content': content, 'x': x, 'y': y, 'fontsize': 26}
+
+
+def image(overlay_id, file, x=0, y=0, width=100, height=50):
+    return {'id': overlay_id, 'type': 'image', 'content': f'https://example.com/{overlay_id}.png',
+            'x': x, 'y': y, 'width': width, 'height': height, 'file': file}
+
+
+def layout(texts, images=(), live=True):
+    return {'stream_id': 'default', 'live': live, 'texts': list(texts), 'images': list(images)}
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_STATE_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def compositor():
+    return OverlayCompositor(manager=None, interval=60)
+
+
+def test_texts_keep_their_slots(monkeypatch):
+    slots = [text('a'), None, text('c'), None]
+    # b is new, a was deleted: c stays put and b takes the first free slot
+    placed = _place_texts(slots, [text('b'), text('c')])
+    assert [spec and spec['id'] for spec in placed] == ['b', None, 'c', None]
+
+    # More texts than slots: the extra ones are appended
+    placed = _place_texts([text('a')], [text('a'), text('b'), text('c')])
+    assert [spec['id'] for spec in placed] == ['a', 'b', 'c']
+
+
+def test_filter_graph_reserves_disabled_text_slots(compositor, state_dir):
+    graph, label = compositor.filter_graph('cam', layout(
+        [text('a', "it's: [live]"), None], [image('i', '/tmp/i.png', x=4, y=6)]
+    ))
+    chains = graph.split(';')
+    assert len(chains) == 3
+    assert 'zmq=bind_address=' in chains[0] and str(state_dir) in chains[0]
+    assert 'drawtext@text0=' in chains[0] and 'drawtext@text1=' in chains[0]
+    assert chains[0].count(':enable=0') == 1
+    # The graph unescapes values twice
+    assert r"text=it\\\'s\\: \[live\]" in chains[0]
+    assert chains[1].startswith('movie=filename=/tmp/i.png:loop=0,')
+    assert 'scale@size0=w=100:h=50[image0]' in chains[1]
+    assert chains[2] == '[base0][image0]overlay@position0=x=4:y=6[base1]'
+    assert label == 'base1'
+
+    graph, label = compositor.filter_graph('cam', layout([None], live=False))
+    assert 'zmq' not in graph
+    assert label == 'base0'
+
+
+def test_text_edits_become_commands_in_their_slots(compositor):
+    previous = layout([text('a'), text('b'), None])
+    new = layout([text('a', x=50), None, text('c', 'new')])
+    assert compositor._commands(previous, new) == [
+        'drawtext@text0 reinit text=hello:x=50:y=10:fontsize=26',
+        'drawtext@text1 enable 0',
+        'drawtext@text2 reinit text=new:x=10:y=10:fontsize=26',
+        'drawtext@text2 enable 1',
+    ]
+    # A freed slot is reused without touching the others
+    assert compositor._commands(new, layout([text('a', x=50), text('d', "a:b"), text('c', 'new')])) == [
+        'drawtext@text1 reinit text=a\\:b:x=10:y=10:fontsize=26',
+        'drawtext@text1 enable 1',
+    ]
+    assert compositor._commands(new, new) == []
+
+
+def test_image_moves_and_resizes_become_commands(compositor):
+    previous = layout([None], [image('i', '/tmp/i.png')])
+    new = layout([None], [image('i', '/tmp/i.png', x=5, width=80)])
+    assert compositor._commands(previous, new) == ['scale@size0 w 80', 'overlay@position0 x 5']
+
+
+@pytest.mark.parametrize('previous, new', [
+    # More text overlays than slots
+    (layout([text('a')]), layout([text('a'), text('b')])),
+    # A new image, a removed one, a changed source
+    (layout([None]), layout([None], [image('i', '/tmp/i.png')])),
+    (layout([None], [image('i', '/tmp/i.png')]), layout([None])),
+    (layout([None], [image('i', '/tmp/i.png')]), layout([None], [image('i', '/tmp/j.png')])),
+    # Persisted by a version that didn't record files
+    (layout([None], [{key: value for key, value in image('i', None).items() if key != 'file'}]),
+     layout([None], [image('i', '/tmp/i.png')])),
+    # FFmpeg without zmq
+    (layout([text('a')], live=False), layout([text('a', x=1)], live=False)),
+])
+def test_changes_without_room_need_a_relaunch(compositor, previous, new):
+    assert compositor._commands(previous, new) is None
+
+
+class FakeManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.relaunched = []
+
+    def set_burn_in_layout(self, stream, layout):
+        stream['burn_in'] = layout
+
+    def relaunch(self, stream, reason):
+        self.relaunched.append((stream['output_name'], reason))
+
+
+def test_running_out_of_slots_relaunches_with_spare_ones(monkeypatch):
+    monkeypatch.setattr(Config, 'OVERLAY_BURNIN_TEXT_SLOTS', 2)
+    manager = FakeManager()
+    compositor = OverlayCompositor(manager, interval=60)
+    stream = {'output_name': 'cam', 'ffmpeg_cmd': ['ffmpeg'], 'process': object(), 'burn_in': layout([text('a'), text('b')])}
+    # A third text overlay was added
+    monkeypatch.setattr(compositor, 'layout', lambda stream_id, previous: layout(
+        _place_texts(previous['texts'], [text('a'), text('b'), text('c')])
+    ))
+
+    compositor.sync(stream, 'v1')
+    assert manager.relaunched == [('cam', 'applying overlay changes')]
+    assert [spec and spec['id'] for spec in stream['burn_in']['texts']] == ['a', 'b', 'c', None, None]
+
+    # Relaunches are rate limited
+    compositor.sync(stream, 'v2')
+    assert len(manager.relaunched) == 1
+
+
+def test_fetch_image_writes_once_and_marks_use(monkeypatch):
+    fetched = []
+    def fit(url, width, height):
+        fetched.append(url)
+        return b'\x89PNG fake', 'image/png'
+    monkeypatch.setattr(overlay_burnin.overlay_images, 'fit', fit)
+    monkeypatch.setattr(overlay_burnin.overlay_images, 'available', lambda: True)
+
+    url = 'https://example.com/logo.png'
+    path = fetch_image(url)
+    assert path == image_path(url)
+    with open(path, 'rb') as f:
+        assert f.read() == b'\x89PNG fake'
+    os.utime(path, (0, 0))
+
+    assert fetch_image(url) == path
+    assert fetched == [url]
+    assert os.path.getmtime(path) > time.time() - 60
+
+    assert fetch_image('file:///etc/passwd') is None
+    assert fetched == [url]
+
+
+def write(path, size, age):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_prune_removes_unused_images_by_age(monkeypatch):
+    monkeypatch.setattr(Config, 'OVERLAY_BURNIN_IMAGE_MAX_AGE', 3600)
+    old = write(image_path('old'), 10, 7200)
+    in_use = write(image_path('in use'), 10, 7200)
+    recent = write(image_path('recent'), 10, 60)
+    stale_temp = write(f"{image_path('crashed')}.123.tmp", 10, 7200)
+    fresh_temp = write(f"{image_path('writing')}.456.tmp", 10, 0)
+
+    assert prune_images({in_use}) == 2
+    assert not os.path.exists(old) and not os.path.exists(stale_temp)
+    assert all(os.path.exists(path) for path in (in_use, recent, fresh_temp))
+    # In use counts as used now
+    assert os.path.getmtime(in_use) > time.time() - 60
+
+
+def test_prune_removes_least_recently_used_over_budget(monkeypatch):
+    monkeypatch.setattr(Config, 'OVERLAY_BURNIN_IMAGE_CACHE_MB', 2.5 / 1024)
+    oldest = write(image_path('oldest'), 1024, 300)
+    in_use = write(image_path('in use'), 1024, 200)
+    older = write(image_path('older'), 1024, 100)
+    newest = write(image_path('newest'), 1024, 0)
+
+    assert prune_images({in_use}) == 2
+    assert [os.path.exists(path) for path in (oldest, in_use, older, newest)] == [False, True, False, True]
+    assert prune_images(set()) == 0
+
+
+def test_prune_without_directory():
+    assert prune_images(set()) == 0
@@ -0,0 +1,74 @@
+"""
+GET /api/overlays validators: the collection version only moves on writes that changed something
+"""
+
+import routes
+
+
+def overlay(content):
+    return {'type': 'text', 'content': content, 'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}}
+
+
+def list_etag(client):
+    response = client.get('/api/overlays')
+    assert response.status_code == 200
+    return response.headers['ETag']
+
+
+def test_matching_if_none_match_is_a_304(client):
+    client.post('/api/overlays', json=overlay('cached'))
+    response = client.get('/api/overlays')
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    cached = client.get('/api/overlays', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+    assert cached.get_data() == b''
+
+    client.post('/api/overlays', json=overlay('another'))
+    changed = client.get('/api/overlays', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert len(changed.get_json()['overlays']) == 2
+
+
+def test_failed_write_keeps_version(client, monkeypatch):
+    overlay_id = client.post('/api/overlays', json=overlay('before')).get_json()['id']
+    etag = list_etag(client)
+
+    def failing(*args, **kwargs):
+        raise RuntimeError('write failed')
+    monkeypatch.setattr(routes.overlay_model.store, 'update', failing)
+    monkeypatch.setattr(routes.overlay_model.store, 'delete', failing)
+
+    assert client.put(f'/api/overlays/{overlay_id}', json={'content': 'after'}).status_code == 500
+    assert client.delete(f'/api/overlays/{overlay_id}').status_code == 500
+    assert list_etag(client) == etag
+
+
+def test_stale_write_keeps_version(client):
+    overlay_id = client.post('/api/overlays', json=overlay('before')).get_json()['id']
+    client.put(f'/api/overlays/{overlay_id}', json={'content': 'edited'})
+    etag = list_etag(client)
+
+    response = client.put(f'/api/overlays/{overlay_id}', json={'content': 'stale'}, headers={'If-Match': '"1"'})
+    assert response.status_code == 412
+    assert client.delete(f'/api/overlays/{overlay_id}', headers={'If-Match': '"1"'}).status_code == 412
+    assert list_etag(client) == etag
+
+
+def test_no_op_writes_keep_version(client):
+    overlay_id = client.post('/api/overlays', json=overlay('kept')).get_json()['id']
+    etag = list_etag(client)
+    missing = '0' * 24
+
+    assert client.put(f'/api/overlays/{missing}', json={'content': 'nothing'}).status_code == 404
+    assert client.delete(f'/api/overlays/{missing}').status_code == 404
+    assert client.delete('/api/overlays/bulk', json={'ids': [missing]}).status_code == 400
+    assert client.put('/api/overlays/bulk', json={'overlays': [{'id': missing, 'content': 'nothing'}]}).status_code == 400
+    routes.overlay_model.bulk_update({missing: {'position': {'x': 1, 'y': 1}}})
+    assert list_etag(client) == etag
+
+    # A real write still moves it
+    client.put(f'/api/overlays/{overlay_id}', json={'content': 'changed'})
+    assert list_etag(client) != etag
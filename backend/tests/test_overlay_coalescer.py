@@ -0,0 +1,83 @@
+"""
+OverlayCoalescer: merging drag events and keeping each sender's origin
+"""
+
+import pytest
+
+from overlay_coalescer import OverlayCoalescer
+
+
+class RecordingSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, **kwargs):
+        self.emitted.append((event, data, kwargs))
+
+
+@pytest.fixture
+def socketio():
+    return RecordingSocketIO()
+
+
+@pytest.fixture
+def coalescer(socketio):
+    coalescer = OverlayCoalescer(tick_hz=30)
+    coalescer._socketio = socketio
+    return coalescer
+
+
+def test_single_sender_frame_skips_the_sender(coalescer, socketio):
+    for x in range(5):
+        coalescer.submit('overlay_moved', {'id': 'a', 'position': {'x': x, 'y': 0}}, origin='sid-1', room='stream:a')
+    coalescer.submit('overlay_resized', {'id': 'a', 'size': {'width': 20, 'height': 10}}, origin='sid-1', room='stream:a')
+
+    assert coalescer.flush() == 1
+    assert socketio.emitted == [('overlay_batch', {'seq': 1, 'overlays': [
+        {'id': 'a', 'origin': 'sid-1', 'position': {'x': 4, 'y': 0}, 'size': {'width': 20, 'height': 10}}
+    ]}, {'to': 'stream:a', 'skip_sid': 'sid-1'})]
+    assert coalescer.get_stats()['events_merged'] == 5
+
+    # Nothing pending: no frame
+    assert coalescer.flush() == 0
+    assert len(socketio.emitted) == 1
+
+
+def test_two_senders_keep_their_origins(coalescer, socketio):
+    coalescer.submit('overlay_moved', {'id': 'a', 'position': {'x': 1, 'y': 1}}, origin='sid-1', room='stream:a')
+    coalescer.submit('overlay_resized', {'id': 'a', 'size': {'width': 30, 'height': 30}}, origin='sid-2', room='stream:a')
+    coalescer.submit('overlay_moved', {'id': 'b', 'position': {'x': 2, 'y': 2}}, origin='sid-2', room='stream:a')
+    coalescer.submit('overlay_moved', {'id': 'c', 'position': {'x': 3, 'y': 3}}, origin='sid-1', room='stream:b')
+
+    assert coalescer.flush() == 3
+    frames = {kwargs['to']: (data, kwargs['skip_sid']) for _, data, kwargs in socketio.emitted}
+    assert set(frames) == {'stream:a', 'stream:b'}
+
+    # Mixed senders: everyone gets the frame and skips the entries marked with its own origin
+    data, skip_sid = frames['stream:a']
+    assert skip_sid is None
+    assert data['overlays'] == [
+        {'id': 'a', 'origin': 'sid-1', 'position': {'x': 1, 'y': 1}},
+        {'id': 'a', 'origin': 'sid-2', 'size': {'width': 30, 'height': 30}},
+        {'id': 'b', 'origin': 'sid-2', 'position': {'x': 2, 'y': 2}},
+    ]
+
+    data, skip_sid = frames['stream:b']
+    assert skip_sid == 'sid-1'
+    assert data['overlays'] == [{'id': 'c', 'origin': 'sid-1', 'position': {'x': 3, 'y': 3}}]
+    assert {data['seq'] for data, _ in frames.values()} == {1}
+
+
+def test_later_sender_takes_over_a_field(coalescer, socketio):
+    coalescer.submit('overlay_moved', {'id': 'a', 'position': {'x': 1, 'y': 1}}, origin='sid-1')
+    coalescer.submit('overlay_moved', {'id': 'a', 'position': {'x': 9, 'y': 9}}, origin='sid-2')
+    coalescer.flush()
+    assert socketio.emitted == [('overlay_batch', {'seq': 1, 'overlays': [
+        {'id': 'a', 'origin': 'sid-2', 'position': {'x': 9, 'y': 9}}
+    ]}, {'to': None, 'skip_sid': 'sid-2'})]
+
+
+def test_events_without_id_or_field_are_ignored(coalescer):
+    coalescer.submit('overlay_moved', {'position': {'x': 1, 'y': 1}}, origin='sid-1')
+    coalescer.submit('overlay_resized', {'id': 'a', 'position': {'x': 1, 'y': 1}}, origin='sid-1')
+    assert coalescer.flush() == 0
@@ -0,0 +1,126 @@
+"""
+Overlay image proxy: only public hosts are fetched, only images are served
+"""
+
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import overlay_images
+import routes
+from overlay_images import ImageCache, ImageFetchError, OverlayImageProxy
+
+PIL = pytest.importorskip('PIL')
+
+# Stands in for a public host; really served by the loopback test server
+PUBLIC_HOST = 'images.example.com'
+
+
+def png_bytes():
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', (40, 20), 'red').save(output, 'PNG')
+    return output.getvalue()
+
+
+class ImageServer(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', f'http://127.0.0.1:{self.server.server_port}/secret.png')
+            self.end_headers()
+            return
+        body, content_type = (b'<html>not an image</html>', 'text/html') if self.path == '/page.png' else (png_bytes(), 'image/png')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageServer)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    public_address = overlay_images._public_address
+    def resolve(host, port):
+        return '127.0.0.1' if host == PUBLIC_HOST else public_address(host, port)
+    monkeypatch.setattr(overlay_images, '_public_address', resolve)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def proxy():
+    return OverlayImageProxy(ImageCache(1024 * 1024), 1024 * 1024)
+
+
+def image_overlay(url, width=20, height=10):
+    return {'_id': 'a' * 24, 'type': 'image', 'content': url, 'size': {'width': width, 'height': height}}
+
+
+def test_public_image_is_fetched_and_fitted(server, proxy):
+    data, content_type, _ = proxy.get(image_overlay(f'http://{PUBLIC_HOST}:{server.server_port}/logo.png'))
+    assert content_type == 'image/png'
+    from PIL import Image
+    assert Image.open(io.BytesIO(data)).size == (20, 10)
+    assert server.requests == ['/logo.png']
+
+
+@pytest.mark.parametrize('host', ['127.0.0.1', 'localhost', '[::1]'])
+def test_loopback_url_is_refused(server, proxy, host):
+    with pytest.raises(ImageFetchError):
+        proxy.get(image_overlay(f'http://{host}:{server.server_port}/logo.png'))
+    assert server.requests == []
+
+
+def test_redirect_to_loopback_is_refused(server, proxy):
+    with pytest.raises(ImageFetchError, match='public address'):
+        proxy.get(image_overlay(f'http://{PUBLIC_HOST}:{server.server_port}/redirect'))
+    # The public host was asked; the loopback target never was
+    assert server.requests == ['/redirect']
+
+
+def test_non_image_body_is_refused(server, proxy):
+    with pytest.raises(ImageFetchError, match='Not a decodable image'):
+        proxy.get(image_overlay(f'http://{PUBLIC_HOST}:{server.server_port}/page.png'))
+
+
+@pytest.mark.parametrize('url', ['file:///etc/passwd', 'ftp://example.com/a.png', 'gopher://example.com/'])
+def test_other_schemes_are_refused(proxy, url):
+    with pytest.raises(ImageFetchError, match='scheme'):
+        proxy.get(image_overlay(url))
+
+
+def test_route_answers_502_for_refused_sources(client, server):
+    response = client.post('/api/overlays', json={
+        'type': 'image', 'content': f'http://127.0.0.1:{server.server_port}/logo.png',
+        'position': {'x': 0, 'y': 0}, 'size': {'width': 20, 'height': 10}
+    })
+    response = client.get(f"/api/overlay-images/{response.get_json()['id']}")
+    assert response.status_code == 502
+    assert response.get_json() == {'error': 'Could not fetch overlay image'}
+    assert server.requests == []
+
+
+def test_route_answers_404_for_non_image_overlays(client):
+    text_id = client.post('/api/overlays', json={
+        'type': 'text', 'content': 'hello', 'position': {'x': 0, 'y': 0}, 'size': {'width': 20, 'height': 10}
+    }).get_json()['id']
+    # Created before overlays had a type
+    legacy_id = routes.overlay_model.store.create({'content': 'hello', 'size': {'width': 20, 'height': 10}, 'rev': 1})
+
+    for overlay_id in (text_id, legacy_id):
+        response = client.get(f'/api/overlay-images/{overlay_id}')
+        assert response.status_code == 404
+        assert response.get_json() == {'error': 'Overlay is not an image'}
@@ -0,0 +1,98 @@
+"""
+Paged GET /api/overlays: keyset cursor, projection and streamed failures
+"""
+
+import json
+
+import pytest
+
+import routes
+from models import ITER_BATCH_SIZE
+
+
+def overlay(content, stream_id='default'):
+    return {
+        'type': 'text', 'content': content, 'stream_id': stream_id,
+        'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+    }
+
+
+def create_overlays(client, count, stream_id='default'):
+    response = client.post('/api/overlays/bulk', json={'overlays': [
+        overlay(f'overlay {i}', stream_id) for i in range(count)
+    ]})
+    assert response.status_code == 201
+    return [result['id'] for result in response.get_json()['results']]
+
+
+def test_keyset_pages_cover_every_overlay_once(client):
+    ids = create_overlays(client, 25)
+
+    seen, after, pages = [], '', 0
+    while True:
+        page = client.get(f'/api/overlays?limit=7&after={after}').get_json()
+        seen += [overlay['_id'] for overlay in page['overlays']]
+        pages += 1
+        if page['next_after'] is None:
+            break
+        assert page['next_after'] == page['overlays'][-1]['_id']
+        after = page['next_after']
+    assert pages == 4
+    assert seen == ids
+
+
+def test_pages_span_several_store_batches(client):
+    ids = create_overlays(client, ITER_BATCH_SIZE * 2 + 5)
+    first = client.get(f'/api/overlays?limit={ITER_BATCH_SIZE + 3}').get_json()
+    second = client.get(f"/api/overlays?limit=1000&after={first['next_after']}").get_json()
+    assert [o['_id'] for o in first['overlays'] + second['overlays']] == ids
+    assert second['next_after'] is None
+
+
+def test_fields_projection_keeps_id(client):
+    create_overlays(client, 3, stream_id='lobby')
+    page = client.get('/api/overlays?fields=content,stream_id&stream_id=lobby').get_json()
+    assert [set(overlay) for overlay in page['overlays']] == [{'_id', 'content', 'stream_id'}] * 3
+
+    page = client.get('/api/overlays?fields=position').get_json()
+    assert all(set(overlay) == {'_id', 'position'} for overlay in page['overlays'])
+
+
+@pytest.mark.parametrize('query', [
+    'after=not-an-id', 'limit=abc', 'limit=0', 'limit=1001', 'fields=content,secret'
+])
+def test_invalid_page_arguments(client, query):
+    response = client.get(f'/api/overlays?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_failure_before_first_overlay_is_a_500(client, monkeypatch):
+    create_overlays(client, 3)
+    def failing(*args, **kwargs):
+        raise RuntimeError('cursor died')
+        yield
+    monkeypatch.setattr(routes.overlay_model.store, 'iter_overlays', failing)
+
+    response = client.get('/api/overlays?limit=10')
+    assert response.status_code == 500
+    assert response.get_json() == {'error': 'Internal server error'}
+
+
+def test_failure_partway_ends_with_valid_json(client, monkeypatch):
+    ids = create_overlays(client, ITER_BATCH_SIZE + 10)
+    store = routes.overlay_model.store
+    iter_overlays = store.iter_overlays
+    # The first batch is served, the query for the second one fails
+    def failing(stream_id=None, after=None, limit=None, fields=None):
+        if after is not None:
+            raise RuntimeError('cursor died')
+        yield from iter_overlays(stream_id=stream_id, after=after, limit=limit, fields=fields)
+    monkeypatch.setattr(store, 'iter_overlays', failing)
+
+    response = client.get('/api/overlays?limit=500')
+    assert response.status_code == 200
+    page = json.loads(response.get_data(as_text=True))
+    assert page['error'] == 'Internal server error'
+    assert [overlay['_id'] for overlay in page['overlays']] == ids[:ITER_BATCH_SIZE]
+    assert page['next_after'] == ids[ITER_BATCH_SIZE - 1]
@@ -0,0 +1,71 @@
+"""
+Optimistic concurrency on PUT/PATCH/DELETE /api/overlays/<id>
+"""
+
+import pytest
+
+
+@pytest.fixture
+def overlay_id(client):
+    response = client.post('/api/overlays', json={
+        'type': 'text', 'content': 'original', 'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+    })
+    assert response.get_json()['rev'] == 1
+    return response.get_json()['id']
+
+
+@pytest.mark.parametrize('method', ['PUT', 'PATCH'])
+@pytest.mark.parametrize('if_match', ['"1"', 'W/"1"', '1', '*', None])
+def test_matching_if_match_updates(client, overlay_id, method, if_match):
+    headers = {'If-Match': if_match} if if_match else {}
+    response = client.open(f'/api/overlays/{overlay_id}', method=method, json={'content': 'edited'}, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['overlay']['rev'] == 2
+    assert response.headers['ETag'] == '"2"'
+
+
+@pytest.mark.parametrize('method', ['PUT', 'PATCH', 'DELETE'])
+def test_stale_if_match_is_a_412(client, overlay_id, method):
+    client.put(f'/api/overlays/{overlay_id}', json={'content': 'edited'})
+
+    response = client.open(f'/api/overlays/{overlay_id}', method=method, json={'content': 'stale'}, headers={'If-Match': '"1"'})
+    assert response.status_code == 412
+    body = response.get_json()
+    assert body['overlay']['content'] == 'edited'
+    assert body['overlay']['rev'] == 2
+    assert response.headers['ETag'] == '"2"'
+    assert client.get(f'/api/overlays/{overlay_id}').get_json()['overlay']['content'] == 'edited'
+
+
+@pytest.mark.parametrize('method', ['PUT', 'PATCH', 'DELETE'])
+def test_malformed_if_match_is_a_400(client, overlay_id, method):
+    response = client.open(f'/api/overlays/{overlay_id}', method=method, json={'content': 'edited'}, headers={'If-Match': '"abc"'})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'If-Match must be an overlay revision'}
+
+
+@pytest.mark.parametrize('method', ['PUT', 'PATCH'])
+def test_rev_in_body_is_not_a_precondition_or_a_value(client, overlay_id, method):
+    # rev is maintained by the server: a stale one in the body neither conflicts nor sticks
+    response = client.open(f'/api/overlays/{overlay_id}', method=method, json={'content': 'edited', 'rev': 99, '_id': 'x'})
+    assert response.status_code == 200
+    overlay = response.get_json()['overlay']
+    assert overlay['rev'] == 2
+    assert overlay['_id'] == overlay_id
+
+
+@pytest.mark.parametrize('method', ['PUT', 'PATCH'])
+@pytest.mark.parametrize('body', [{'rev': 1}, {'_id': 'x'}, {'rev': 1, '_id': 'x'}])
+def test_rev_only_body_is_a_400(client, overlay_id, method, body):
+    response = client.open(f'/api/overlays/{overlay_id}', method=method, json=body)
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'No fields to update'}
+    assert client.get(f'/api/overlays/{overlay_id}').get_json()['overlay']['rev'] == 1
+
+
+def test_patch_merges_nested_fields(client, overlay_id):
+    response = client.patch(f'/api/overlays/{overlay_id}', json={'position': {'x': 5}}, headers={'If-Match': '"1"'})
+    assert response.get_json()['overlay']['position'] == {'x': 5, 'y': 0}
+
+    response = client.put(f'/api/overlays/{overlay_id}', json={'position': {'x': 5}}, headers={'If-Match': '"2"'})
+    assert response.status_code == 400
@@ -0,0 +1,119 @@
+"""
+OverlayWriteBehind: live drag values written without touching revisions,
+and the collection version bumped once the drag has settled
+"""
+
+import time
+
+import pytest
+
+import routes
+from config import Config
+from models import Overlay
+from overlay_writer import OverlayWriteBehind
+
+
+@pytest.fixture
+def overlay_model(monkeypatch):
+    monkeypatch.setattr(Config, 'OVERLAY_STORAGE', 'memory')
+    return Overlay()
+
+
+@pytest.fixture
+def overlay_id(overlay_model):
+    return overlay_model.create({
+        'type': 'text', 'content': 'drag me', 'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+    })
+
+
+def make_writer(overlay_model, **kwargs):
+    # The flush loop starts on first use; a long interval leaves flushing to the test
+    kwargs.setdefault('flush_interval', 60)
+    return OverlayWriteBehind(overlay_model, **kwargs)
+
+
+def test_flushes_during_a_drag_keep_rev_and_version(overlay_model, overlay_id):
+    writer = make_writer(overlay_model)
+    version = overlay_model.version
+    try:
+        for x in range(1, 4):
+            writer.record(overlay_id, {'position': {'x': x, 'y': x}})
+            writer.record(overlay_id, {'size': {'width': 10 + x, 'height': 10}})
+            assert writer.flush() == 1
+
+            overlay = overlay_model.get_by_id(overlay_id)
+            assert overlay['position'] == {'x': x, 'y': x}
+            assert overlay['rev'] == 1
+            assert overlay_model.version == version
+
+        # Settled: one bump for the whole drag
+        writer.publish()
+        settled = overlay_model.version
+        assert settled != version
+        writer.publish()
+        assert overlay_model.version == settled
+        assert writer.get_stats()['flushes'] == 3
+    finally:
+        writer.stop()
+
+
+def test_flush_loop_bumps_version_once_after_settling(overlay_model, overlay_id):
+    writer = make_writer(overlay_model, flush_interval=0.02)
+    version = overlay_model.version
+    try:
+        writer.record(overlay_id, {'position': {'x': 5, 'y': 5}})
+        deadline = time.monotonic() + 5
+        while overlay_model.version == version and time.monotonic() < deadline:
+            time.sleep(0.01)
+        settled = overlay_model.version
+        assert settled != version
+        assert overlay_model.get_by_id(overlay_id)['position'] == {'x': 5, 'y': 5}
+
+        # Idle intervals don't bump it again
+        time.sleep(0.2)
+        assert overlay_model.version == settled
+    finally:
+        writer.stop()
+
+
+def test_discard_drops_pending_values(overlay_model, overlay_id):
+    writer = make_writer(overlay_model)
+    try:
+        writer.record(overlay_id, {'position': {'x': 1, 'y': 1}, 'size': {'width': 50, 'height': 50}})
+        writer.discard(overlay_id, ['position'])
+        assert writer.flush() == 1
+        overlay = overlay_model.get_by_id(overlay_id)
+        assert overlay['position'] == {'x': 0, 'y': 0}
+        assert overlay['size'] == {'width': 50, 'height': 50}
+
+        writer.record(overlay_id, {'position': {'x': 2, 'y': 2}})
+        writer.discard(overlay_id)
+        assert writer.get_stats()['pending'] == 0
+        assert writer.flush() == 0
+    finally:
+        writer.stop()
+
+
+def test_rest_update_supersedes_live_values(client):
+    response = client.post('/api/overlays', json={
+        'type': 'text', 'content': 'drag me', 'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}
+    })
+    overlay_id = response.get_json()['id']
+
+    routes.overlay_writer.record(overlay_id, {'position': {'x': 1, 'y': 1}})
+    response = client.patch(f'/api/overlays/{overlay_id}', json={'position': {'x': 7}})
+    assert response.status_code == 200
+    assert routes.overlay_writer.get_stats()['pending'] == 0
+
+    routes.overlay_writer.flush()
+    assert routes.overlay_model.get_by_id(overlay_id)['position']['x'] == 7
+
+
+def test_stop_flushes_pending_values(overlay_model, overlay_id):
+    writer = make_writer(overlay_model)
+    version = overlay_model.version
+    writer.record(overlay_id, {'position': {'x': 3, 'y': 4}})
+    writer.stop()
+    assert overlay_model.get_by_id(overlay_id)['position'] == {'x': 3, 'y': 4}
+    assert overlay_model.get_by_id(overlay_id)['rev'] == 1
+    assert overlay_model.version != version
@@ -0,0 +1,88 @@
+"""
+/hls route: cache headers, conditional and range requests, blocking playlist reload
+"""
+
+import os
+
+import pytest
+
+import app as app_module
+import hls_cache
+from hls_playlist import SERVER_CONTROL_TAG
+from stream_manager import stream_manager
+
+SEGMENT = bytes(range(256)) * 8
+PLAYLIST = '#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:1700000000\n#EXTINF:2.0,\ncam1700000000.ts\n'
+
+
+@pytest.fixture(params=['disk', 'segment cache'])
+def hls_files(client, request, monkeypatch):
+    """HLS files of a stream 'cam', served from disk or through the segment cache"""
+    if request.param == 'segment cache':
+        monkeypatch.setattr(app_module, 'segment_cache', hls_cache.SegmentCache(1024 * 1024))
+    hls_dir = stream_manager.hls_output_dir
+    files = {'cam.m3u8': PLAYLIST.encode(), 'cam1700000000.ts': SEGMENT, 'cam_init.mp4': b'init'}
+    for name, data in files.items():
+        with open(os.path.join(hls_dir, name), 'wb') as f:
+            f.write(data)
+    yield client
+    for name in files:
+        os.remove(os.path.join(hls_dir, name))
+
+
+def test_cache_control(hls_files):
+    segment = hls_files.get('/hls/cam1700000000.ts')
+    assert segment.status_code == 200
+    assert segment.data == SEGMENT
+    assert segment.mimetype == 'video/mp2t'
+    assert segment.headers['Cache-Control'] == 'public, max-age=86400, immutable'
+    assert segment.headers['Access-Control-Allow-Origin'] == '*'
+
+    playlist = hls_files.get('/hls/cam.m3u8')
+    assert playlist.mimetype == 'application/vnd.apple.mpegurl'
+    assert playlist.headers['Cache-Control'] == 'public, max-age=1'
+
+    # Init segments keep their name across FFmpeg restarts
+    init = hls_files.get('/hls/cam_init.mp4')
+    assert init.data == b'init'
+    assert init.headers['Cache-Control'] == 'no-cache'
+
+
+def test_range_request_is_a_206(hls_files):
+    response = hls_files.get('/hls/cam1700000000.ts', headers={'Range': 'bytes=100-299'})
+    assert response.status_code == 206
+    assert response.data == SEGMENT[100:300]
+    assert response.headers['Content-Range'] == f'bytes 100-299/{len(SEGMENT)}'
+
+
+@pytest.mark.parametrize('filename', ['cam1700000000.ts', 'cam.m3u8'])
+def test_matching_etag_is_a_304(hls_files, filename):
+    first = hls_files.get(f'/hls/{filename}')
+    etag = first.headers['ETag']
+    cached = hls_files.get(f'/hls/{filename}', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+
+
+def test_missing_files_are_404s(hls_files):
+    assert hls_files.get('/hls/cam1699999999.ts').status_code == 404
+    assert hls_files.get('/hls/../config.py').status_code == 404
+
+
+def test_blocking_reload(hls_files, monkeypatch):
+    response = hls_files.get('/hls/cam.m3u8?_HLS_msn=1700000000')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == PLAYLIST
+    assert response.headers['Cache-Control'] == 'public, max-age=1'
+
+    assert hls_files.get('/hls/cam.m3u8?_HLS_msn=soon').status_code == 400
+    assert hls_files.get('/hls/cam.m3u8?_HLS_msn=1700000009').status_code == 400
+    assert hls_files.get('/hls/other.m3u8?_HLS_msn=1').status_code == 404
+
+    # Low-latency streams advertise blocking reload
+    monkeypatch.setitem(stream_manager.active_streams, 'cam', {
+        'output_path': os.path.join(stream_manager.hls_output_dir, 'cam.m3u8'), 'output_name': 'cam',
+        'latency_profile': 'low', 'renditions': None, 'burn_in': None,
+    })
+    response = hls_files.get('/hls/cam.m3u8')
+    assert response.get_data(as_text=True).splitlines()[1] == SERVER_CONTROL_TAG
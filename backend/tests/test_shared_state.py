@@ -0,0 +1,168 @@
+"""
+Multi-worker mode: two workers sharing one state file, and the SQLite Socket.IO message queue
+"""
+
+import json
+import threading
+import time
+import types
+
+import pytest
+
+import message_queue
+import models
+import routes
+import shared_state as shared_state_module
+import stream_manager as stream_manager_module
+from config import Config
+from message_queue import SQLiteQueueManager, socketio_options
+from shared_state import SharedState
+from stream_manager import StreamManager
+
+RTSP_URL = 'rtsp://camera.local/stream'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake clock for heartbeats, so a worker can fall silent without waiting"""
+    clock = types.SimpleNamespace(now=time.time())
+    monkeypatch.setattr(shared_state_module, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch, clock):
+    """Two workers' stream managers on one state file and HLS directory"""
+    monkeypatch.setattr(Config, 'STREAM_STATE_DIR', str(tmp_path / 'state'))
+    managers = []
+    for worker_id in ('a', 'b'):
+        state = SharedState(str(tmp_path / 'shared.db'), worker_id)
+        monkeypatch.setattr(stream_manager_module, 'shared_state', state)
+        manager = StreamManager(str(tmp_path / 'hls'))
+        manager.begun = []
+        # Sources are registered but never probed or launched
+        monkeypatch.setattr(manager, '_begin', manager.begun.append)
+        monkeypatch.setattr(manager.supervisor, 'start', lambda: None)
+        manager.sync_shared()
+        managers.append(manager)
+    return managers
+
+
+def test_one_ffmpeg_per_source(workers):
+    a, b = workers
+    assert a.start_stream('cam', RTSP_URL, codec_mode='copy')['status'] == 'starting'
+    # The same camera and settings through the other worker maps onto a's source
+    info = b.start_stream('lobby', RTSP_URL, codec_mode='copy')
+    assert info['worker'] == 'a'
+    assert info['shared_with'] == ['cam']
+    assert b.active_streams == {} and b.begun == []
+    # Either worker knows both IDs are running
+    assert b.start_stream('cam', RTSP_URL, codec_mode='copy')['worker'] == 'a'
+    assert {info['stream_id'] for info in b.list_streams()} == {'cam', 'lobby'}
+
+    a.sync_shared()
+    assert a.active_streams['lobby'] is a.active_streams['cam']
+    assert len(a.begun) == 1
+
+    # Different settings are a separate source
+    assert b.start_stream('yard', RTSP_URL, codec_mode='transcode')['status'] == 'starting'
+    assert len(b.begun) == 1
+
+
+def test_stop_through_the_other_worker(workers):
+    a, b = workers
+    a.start_stream('cam', RTSP_URL, codec_mode='copy')
+    b.start_stream('lobby', RTSP_URL, codec_mode='copy')
+    a.sync_shared()
+
+    assert b.stop_stream('lobby') is True
+    a.sync_shared()
+    assert set(a.active_streams) == {'cam'}
+    assert a.active_streams['cam']['stream_ids'] == {'cam'}
+
+
+def test_takeover_after_worker_timeout(workers, clock):
+    a, b = workers
+    a.start_stream('cam', RTSP_URL, codec_mode='copy')
+
+    # Still heartbeating: nothing to take over
+    clock.now += Config.WORKER_TIMEOUT / 2
+    b.sync_shared()
+    assert b.active_streams == {}
+
+    # a falls silent; b takes its source over and starts it again
+    clock.now += Config.WORKER_TIMEOUT
+    counts = {'adopted': 0, 'relaunched': 0, 'requeued': 0}
+    b.sync_shared(counts)
+    assert counts == {'adopted': 0, 'relaunched': 1, 'requeued': 0}
+    assert b.begun == [b.active_streams['cam']]
+    assert b.shared.lookup('cam') == ('cam', 'b')
+    assert b.shared.live_workers() == {'b'}
+
+
+def test_leaving_hands_sources_over_right_away(workers):
+    a, b = workers
+    a.start_stream('cam', RTSP_URL, codec_mode='copy')
+    a.leave_shared()
+    b.sync_shared()
+    assert b.shared.lookup('cam') == ('cam', 'b')
+
+
+def test_shared_overlay_version(workers, client, monkeypatch):
+    a, b = (manager.shared for manager in workers)
+    assert a.epoch == b.epoch
+    monkeypatch.setattr(models, 'shared_state', a)
+    model = routes.overlay_model
+    before = model.version
+
+    # A write through the other worker invalidates this worker's cached reads
+    b.increment('overlays')
+    assert model.version != before
+    assert model.version == f"{b.epoch:x}-{b.counter('overlays')}"
+
+    model.create({'type': 'text', 'content': 'hi', 'position': {'x': 0, 'y': 0}, 'size': {'width': 1, 'height': 1}})
+    assert b.counter('overlays') == 2
+
+
+def test_sqlite_queue_round_trip(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'queue' / 'socketio.db'}"
+    publisher = SQLiteQueueManager(url)
+    listener = SQLiteQueueManager(url)
+    other_channel = SQLiteQueueManager(url, channel='other')
+    publisher._publish({'method': 'emit', 'event': 'before'})
+
+    # Publish once the listener has noted where the queue stands
+    polled = threading.Event()
+    sleep = time.sleep
+
+    def poll_sleep(seconds):
+        polled.set()
+        sleep(seconds)
+    monkeypatch.setattr(message_queue, 'time', types.SimpleNamespace(time=time.time, sleep=poll_sleep))
+
+    received = []
+
+    def listen():
+        for payload in listener._listen():
+            received.append(json.loads(payload))
+            if len(received) == 2:
+                return
+    thread = threading.Thread(target=listen, daemon=True)
+    thread.start()
+    assert polled.wait(5)
+    other_channel._publish({'method': 'emit', 'event': 'elsewhere'})
+    publisher._publish({'method': 'emit', 'event': 'overlay_created', 'room': 'stream:a'})
+    publisher._publish({'method': 'emit', 'event': 'overlay_deleted', 'room': 'stream:a'})
+    thread.join(5)
+
+    assert received == [
+        {'method': 'emit', 'event': 'overlay_created', 'room': 'stream:a'},
+        {'method': 'emit', 'event': 'overlay_deleted', 'room': 'stream:a'},
+    ]
+
+
+def test_message_queue_options(tmp_path):
+    assert socketio_options('') == {}
+    options = socketio_options(f"sqlite:///{tmp_path / 'socketio.db'}")
+    assert isinstance(options['client_manager'], SQLiteQueueManager)
+    assert socketio_options('redis://localhost:6379/0') == {'message_queue': 'redis://localhost:6379/0'}
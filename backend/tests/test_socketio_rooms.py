@@ -0,0 +1,96 @@
+"""
+Socket.IO stream rooms: overlay events only reach viewers of their stream
+"""
+
+import pytest
+
+from config import Config
+from overlay_coalescer import overlay_coalescer
+from socketio_manager import socketio
+
+
+@pytest.fixture
+def connect(app, client):
+    clients = []
+
+    def connect(stream_id=None, **kwargs):
+        sio = socketio.test_client(app, auth={'stream_id': stream_id} if stream_id else None, **kwargs)
+        assert sio.is_connected()
+        clients.append(sio)
+        return sio
+    yield connect
+    for sio in clients:
+        if sio.is_connected():
+            sio.disconnect()
+
+
+def events(sio, name):
+    return [message['args'][0] for message in sio.get_received() if message['name'] == name]
+
+
+def test_overlay_events_stay_in_their_stream(connect):
+    editor, viewer_a, viewer_b = connect('a'), connect('a'), connect('b')
+    for sio in (editor, viewer_a, viewer_b):
+        sio.get_received()
+
+    editor.emit('overlay_created', {'id': '1', 'stream_id': 'a'})
+    editor.emit('overlay_updated', {'id': '2', 'stream_id': 'b'})
+
+    assert events(viewer_a, 'overlay_created') == [{'id': '1', 'stream_id': 'a'}]
+    assert events(viewer_a, 'overlay_updated') == []
+    assert [event['id'] for event in events(viewer_b, 'overlay_updated')] == ['2']
+    assert viewer_b.get_received() == []
+    # The sender already applied its own change
+    assert editor.get_received() == []
+
+
+def test_deleted_reaches_only_the_senders_stream(connect):
+    editor, viewer_a, viewer_b = connect('a'), connect('a'), connect('b')
+    for sio in (editor, viewer_a, viewer_b):
+        sio.get_received()
+    # Without a stream_id, the sender's stream
+    editor.emit('overlay_deleted', {'id': '3'})
+    assert events(viewer_a, 'overlay_deleted') == [{'id': '3'}]
+    assert viewer_b.get_received() == []
+
+
+def test_join_stream_switches_rooms(connect):
+    editor, viewer = connect('a'), connect('b')
+    viewer.emit('join_stream', {'stream_id': 'a'})
+    assert events(viewer, 'stream_joined') == [{'stream_id': 'a'}]
+
+    editor.emit('overlay_created', {'id': '1', 'stream_id': 'a'})
+    editor.emit('overlay_created', {'id': '2', 'stream_id': 'b'})
+    assert [event['id'] for event in events(viewer, 'overlay_created')] == ['1']
+
+
+def test_connect_without_a_stream_joins_the_default(connect):
+    viewer = connect()
+    assert events(viewer, 'connection_response') == [{'status': 'connected', 'stream_id': Config.DEFAULT_STREAM_ID}]
+    # The query string works for clients that can't send auth
+    other = connect(query_string='stream_id=b')
+    assert events(other, 'connection_response')[0]['stream_id'] == 'b'
+
+
+def test_live_moves_stay_in_their_stream(connect, monkeypatch):
+    # Relayed right away rather than on the next coalescer tick
+    monkeypatch.setattr(overlay_coalescer, 'tick_hz', 0)
+    editor, viewer_a, viewer_b = connect('a'), connect('a'), connect('b')
+    for sio in (viewer_a, viewer_b):
+        sio.get_received()
+    editor.emit('overlay_moved', {'id': 'x', 'stream_id': 'a', 'position': {'x': 1, 'y': 2}})
+    assert events(viewer_a, 'overlay_moved') == [{'id': 'x', 'stream_id': 'a', 'position': {'x': 1, 'y': 2}}]
+    assert viewer_b.get_received() == []
+
+
+def test_rest_bulk_events_reach_their_stream(connect, client):
+    viewer_a, viewer_b = connect('a'), connect('b')
+    for sio in (viewer_a, viewer_b):
+        sio.get_received()
+    overlay = {'type': 'text', 'content': 'hi', 'stream_id': 'a', 'position': {'x': 0, 'y': 0}, 'size': {'width': 1, 'height': 1}}
+    assert client.post('/api/overlays/bulk', json={'overlays': [overlay]}).status_code == 201
+
+    bulk, = events(viewer_a, 'overlays_bulk')
+    assert bulk['action'] == 'created'
+    assert [item['content'] for item in bulk['overlays']] == ['hi']
+    assert viewer_b.get_received() == []
@@ -0,0 +1,133 @@
+"""
+SQLiteStore: the embedded overlay backend
+"""
+
+import threading
+
+import pytest
+
+import storage
+from storage import SQLiteStore, RevisionMismatch
+
+
+def overlay(content, stream_id='default', **extra):
+    return {
+        'type': 'text', 'content': content, 'stream_id': stream_id,
+        'position': {'x': 0, 'y': 0}, 'size': {'width': 10, 'height': 10}, 'rev': 1, **extra
+    }
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'overlays.db')
+
+
+@pytest.fixture
+def store(path):
+    return SQLiteStore(path)
+
+
+def test_create_get_and_update_with_expected_rev(store):
+    overlay_id = store.create(overlay('first'))
+    assert store.get_by_id(overlay_id) == {**overlay('first'), '_id': overlay_id}
+
+    updated = store.update(overlay_id, {'content': 'second', 'position.x': 5}, expected_rev=1)
+    assert updated['rev'] == 2
+    assert updated['content'] == 'second'
+    assert updated['position'] == {'x': 5, 'y': 0}
+    assert store.get_by_id(overlay_id) == updated
+
+    with pytest.raises(RevisionMismatch) as mismatch:
+        store.update(overlay_id, {'content': 'stale'}, expected_rev=1)
+    assert mismatch.value.current['rev'] == 2
+    assert store.get_by_id(overlay_id)['content'] == 'second'
+
+    assert store.update('0' * 24, {'content': 'missing'}) is None
+
+
+def test_delete_with_expected_rev(store):
+    overlay_id = store.create(overlay('doomed'))
+    with pytest.raises(RevisionMismatch):
+        store.delete(overlay_id, expected_rev=7)
+    assert store.delete(overlay_id, expected_rev=1)['content'] == 'doomed'
+    assert store.get_by_id(overlay_id) is None
+    assert store.delete(overlay_id) is None
+
+
+def test_bulk_update_bumps_rev_unless_told_not_to(store):
+    first, second = store.create_many([overlay('a'), overlay('b')])
+
+    assert store.bulk_update({first: {'position': {'x': 1, 'y': 1}}, '0' * 24: {'content': 'x'}}) == 1
+    assert store.get_by_id(first)['rev'] == 2
+
+    assert store.bulk_update({first: {'position.x': 9}, second: {'size.width': 20}}, bump_rev=False) == 2
+    assert store.get_by_id(first)['rev'] == 2
+    assert store.get_by_id(first)['position'] == {'x': 9, 'y': 1}
+    assert store.get_by_id(second)['rev'] == 1
+    assert store.get_by_id(second)['size'] == {'width': 20, 'height': 10}
+
+
+def test_delete_many_and_stream_ids(store):
+    ids = store.create_many([overlay('a'), overlay('b', stream_id='lobby'), overlay('c')])
+    assert store.get_stream_ids(ids + ['0' * 24]) == {ids[0]: 'default', ids[1]: 'lobby', ids[2]: 'default'}
+    assert store.delete_many([ids[0], ids[1], '0' * 24]) == 2
+    assert [item['_id'] for item in store.get_all()] == [ids[2]]
+    assert store.delete_many([]) == 0
+
+
+def test_pagination_with_after_and_fields(store, monkeypatch):
+    # Small query batches, so pages span several of them
+    monkeypatch.setattr(storage, 'SQLITE_BATCH_SIZE', 4)
+    ids = store.create_many([overlay(f'overlay {i}', stream_id='lobby' if i % 3 == 0 else 'default') for i in range(20)])
+    assert ids == sorted(ids)
+
+    seen, after = [], None
+    while True:
+        page = list(store.iter_overlays(after=after, limit=7, fields=['content']))
+        if not page:
+            break
+        assert all(set(item) == {'_id', 'content'} for item in page)
+        seen += [item['_id'] for item in page]
+        after = page[-1]['_id']
+    assert seen == ids
+
+    lobby = [item['_id'] for item in store.iter_overlays(stream_id='lobby')]
+    assert lobby == ids[::3]
+    assert [item['_id'] for item in store.iter_overlays(stream_id='lobby', after=lobby[1], limit=2)] == lobby[2:4]
+
+
+def test_iteration_can_resume_on_another_thread(store, monkeypatch):
+    monkeypatch.setattr(storage, 'SQLITE_BATCH_SIZE', 3)
+    ids = store.create_many([overlay(f'overlay {i}') for i in range(10)])
+    overlays = store.iter_overlays()
+    seen = [next(overlays)['_id'] for _ in range(4)]
+
+    # The pool may resume a generator on a different thread, with its own connection
+    errors = []
+    def finish():
+        try:
+            seen.extend(item['_id'] for item in overlays)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=finish)
+    thread.start()
+    thread.join(5)
+    assert not errors
+    assert seen == ids
+
+
+def test_two_connections_share_the_wal_file(path):
+    writer, reader = SQLiteStore(path), SQLiteStore(path)
+    overlay_id = writer.create(overlay('shared'))
+    assert reader.get_by_id(overlay_id)['content'] == 'shared'
+
+    # A reader in the middle of a page doesn't block the writer (WAL)
+    writer.create_many([overlay(f'more {i}') for i in range(5)])
+    page = reader.iter_overlays()
+    next(page)
+    writer.update(overlay_id, {'content': 'edited'})
+    assert reader.get_by_id(overlay_id)['content'] == 'edited'
+    assert len(list(page)) == 5
+
+    conn = reader._connection()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
@@ -0,0 +1,86 @@
+"""
+Switching overlay storage from memory to MongoDB once it becomes reachable
+(mongomock stands in for the server)
+"""
+
+import threading
+
+import pytest
+from bson import ObjectId
+
+mongomock = pytest.importorskip('mongomock')
+
+from config import Config
+from models import Overlay
+
+
+@pytest.fixture
+def overlay_model(monkeypatch):
+    monkeypatch.setattr(Config, 'OVERLAY_STORAGE', 'memory')
+    return Overlay()
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient()[Config.DATABASE_NAME][Config.COLLECTION_NAME]
+
+
+def test_switchover_keeps_ids_and_waits_for_writes_in_flight(overlay_model, collection):
+    first, second, deleted = overlay_model.create_many([
+        {'type': 'text', 'content': content} for content in ('first', 'second', 'deleted')
+    ])
+    overlay_model.update(first, {'content': 'first, edited'})
+    memory = overlay_model.store
+
+    # Hold an update inside the memory store until the switch has started
+    in_store = threading.Event()
+    release = threading.Event()
+    memory_update = memory.update
+    def slow_update(*args, **kwargs):
+        in_store.set()
+        release.wait(5)
+        return memory_update(*args, **kwargs)
+    memory.update = slow_update
+
+    writer = threading.Thread(target=overlay_model.update, args=(second, {'content': 'second, edited'}))
+    writer.start()
+    assert in_store.wait(5)
+
+    version = overlay_model.version
+    switch = threading.Thread(target=overlay_model._on_database_connected, args=(collection,))
+    switch.start()
+    # However long the write takes, the switch waits for it
+    switch.join(1.5)
+    assert switch.is_alive(), 'switched while a write was still in flight'
+
+    # Writes issued during the switch wait for it and then go to MongoDB
+    late = []
+    late_writer = threading.Thread(target=lambda: late.append(overlay_model.create({'type': 'text', 'content': 'late'})))
+    late_writer.start()
+    deleter = threading.Thread(target=overlay_model.delete, args=(deleted,))
+    deleter.start()
+
+    release.set()
+    for thread in (writer, switch, late_writer, deleter):
+        thread.join(5)
+        assert not thread.is_alive()
+
+    assert overlay_model.backend == 'mongodb'
+    assert overlay_model.version != version
+    assert memory.snapshot() == {}
+    documents = {str(document['_id']): document for document in collection.find()}
+    assert set(documents) == {first, second, late[0]}
+    assert documents[first]['content'] == 'first, edited'
+    assert documents[second]['content'] == 'second, edited'
+    assert documents[second]['rev'] == 2
+    assert documents[late[0]]['content'] == 'late'
+
+
+def test_switchover_keeps_conflicting_mongodb_documents(overlay_model, collection):
+    overlay_id = overlay_model.create({'type': 'text', 'content': 'memory'})
+    collection.insert_one({'_id': ObjectId(overlay_id), 'type': 'text', 'content': 'mongodb', 'rev': 7})
+
+    overlay_model._on_database_connected(collection)
+
+    assert overlay_model.backend == 'mongodb'
+    assert overlay_model.get_by_id(overlay_id)['content'] == 'mongodb'
@@ -0,0 +1,284 @@
+"""
+StreamManager: input probing, codec selection, ABR commands, startup events,
+shared sources and their HLS files
+"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+import stream_manager
+from config import Config
+from stream_manager import StreamManager, parse_ladder, probe_input
+
+# ffprobe -show_entries stream=codec_type,codec_name,height -of json output of some cameras
+FFPROBE_OUTPUT = {
+    'h264_aac': {'streams': [
+        {'codec_name': 'h264', 'codec_type': 'video', 'height': 1080},
+        {'codec_name': 'aac', 'codec_type': 'audio'},
+    ]},
+    'hevc_pcm': {'streams': [
+        {'codec_name': 'hevc', 'codec_type': 'video', 'height': 2160},
+        {'codec_name': 'pcm_mulaw', 'codec_type': 'audio'},
+    ]},
+    'h264_pcm': {'streams': [
+        {'codec_name': 'h264', 'codec_type': 'video', 'height': 720},
+        {'codec_name': 'pcm_alaw', 'codec_type': 'audio'},
+    ]},
+    # Video only, with an ONVIF metadata track and a second video track
+    'h264_only': {'streams': [
+        {'codec_name': 'h264', 'codec_type': 'video', 'height': 480},
+        {'codec_type': 'data'},
+        {'codec_name': 'mjpeg', 'codec_type': 'video', 'height': 240},
+    ]},
+}
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    manager = StreamManager(str(tmp_path / 'hls'))
+    # Sources are registered but never probed or launched
+    monkeypatch.setattr(manager, '_begin', lambda stream: None)
+    monkeypatch.setattr(manager.supervisor, 'start', lambda: None)
+    return manager
+
+
+@pytest.fixture
+def events(manager):
+    events = []
+    manager.on_event(lambda event, data: events.append((event, data)))
+    return events
+
+
+@pytest.mark.parametrize('filename, options, matches', [
+    ('cam.m3u8', {}, True),
+    ('cam1700000000.ts', {}, True),
+    ('cam1700000000.m4s', {}, True),
+    ('cam_init.mp4', {}, True),
+    ('cam2.m3u8', {}, False),
+    ('cam21700000000.ts', {}, False),
+    ('cam2_init.mp4', {}, False),
+    ('cam_lobby.m3u8', {}, False),
+    ('cam_lobby1700000000.ts', {}, False),
+    ('cam_lobby_init.mp4', {}, False),
+    ('cam_overlay.m3u8', {}, False),
+    ('cam.m3u8.tmp', {}, False),
+    ('cam_overlay.m3u8', {'burn_in': {'stream_id': 'cam'}}, True),
+    ('cam_overlay1700000000.ts', {'burn_in': {'stream_id': 'cam'}}, True),
+    ('cam_lobby1700000000.ts', {'burn_in': {'stream_id': 'cam'}}, False),
+    ('cam.m3u8', {'abr': True}, True),
+    ('cam_0.m3u8', {'abr': True}, True),
+    ('cam_2_1700000000.ts', {'abr': True}, True),
+    ('cam_0_init.mp4', {'abr': True}, True),
+    ('cam1700000000.ts', {'abr': True}, False),
+    ('cam2_0.m3u8', {'abr': True}, False),
+    ('cam_lobby_0.m3u8', {'abr': True}, False),
+])
+def test_hls_file_pattern(manager, filename, options, matches):
+    pattern = manager._hls_file_pattern({'output_name': 'cam', **options})
+    assert bool(pattern.fullmatch(filename)) == matches
+
+
+def test_cleanup_leaves_other_sources_files(manager):
+    hls_dir = manager.hls_output_dir
+    names = ['cam.m3u8', 'cam1700000000.ts', 'cam2.m3u8', 'cam21700000000.ts', 'cam_lobby.m3u8']
+    for name in names:
+        open(os.path.join(hls_dir, name), 'w').close()
+
+    manager._cleanup_hls_files({'output_name': 'cam'})
+    assert sorted(os.listdir(hls_dir)) == ['cam2.m3u8', 'cam21700000000.ts', 'cam_lobby.m3u8']
+
+
+def test_stopping_one_of_two_streams_keeps_the_shared_ffmpeg(manager):
+    first = manager.start_stream('lobby', 'rtsp://camera.local/stream', codec_mode='copy')
+    second = manager.start_stream('entrance', 'rtsp://CAMERA.local/stream', codec_mode='copy')
+    assert first['hls_url'] == second['hls_url'] == '/hls/lobby.m3u8'
+
+    source = manager.active_streams['lobby']
+    assert manager.active_streams['entrance'] is source
+    # Stands in for FFmpeg, in its own process group like a launched one
+    process = subprocess.Popen(['sleep', '60'], start_new_session=True)
+    source['process'] = process
+    playlist = os.path.join(manager.hls_output_dir, 'lobby.m3u8')
+    open(playlist, 'w').close()
+
+    try:
+        assert manager.stop_stream('lobby')
+        assert 'lobby' not in manager.active_streams
+        assert source['stream_ids'] == {'entrance'}
+        assert process.poll() is None
+        assert os.path.exists(playlist)
+
+        assert manager.stop_stream('entrance')
+        assert process.wait(5) is not None
+        assert not os.path.exists(playlist)
+        assert manager.active_streams == {}
+        assert not manager.stop_stream('entrance')
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+
+@pytest.fixture
+def ffprobe(monkeypatch):
+    """Answer ffprobe with the FFPROBE_OUTPUT entry named by the URL's path"""
+    calls = []
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        assert cmd[0] == 'ffprobe'
+        name = cmd[-1].rsplit('/', 1)[-1]
+        if name not in FFPROBE_OUTPUT:
+            raise subprocess.CalledProcessError(1, cmd, stderr=b'Connection refused')
+        return subprocess.CompletedProcess(cmd, 0, stdout=json.dumps(FFPROBE_OUTPUT[name]).encode())
+    monkeypatch.setattr(stream_manager.subprocess, 'run', run)
+    return calls
+
+
+@pytest.mark.parametrize('name, codecs', [
+    ('h264_aac', {'video': 'h264', 'audio': 'aac', 'height': 1080}),
+    ('hevc_pcm', {'video': 'hevc', 'audio': 'pcm_mulaw', 'height': 2160}),
+    ('h264_only', {'video': 'h264', 'audio': None, 'height': 480}),
+    ('offline', None),
+])
+def test_probe_input(ffprobe, name, codecs):
+    assert probe_input(f'rtsp://camera.local/{name}') == codecs
+    assert ffprobe[0][-1] == f'rtsp://camera.local/{name}'
+
+
+@pytest.mark.parametrize('codec_mode, name, mode, codec_args', [
+    ('auto', 'h264_aac', 'passthrough', ['-c:v', 'copy', '-c:a', 'copy']),
+    ('auto', 'hevc_pcm', 'transcode', ['-c:v', 'libx264', '-c:a', 'aac']),
+    ('auto', 'h264_pcm', 'video_passthrough', ['-c:v', 'copy', '-c:a', 'aac']),
+    ('auto', 'h264_only', 'passthrough', ['-c:v', 'copy', '-c:a', 'copy']),
+    # Probing failed: transcoding always produces something playable
+    ('auto', 'offline', 'transcode', ['-c:v', 'libx264', '-c:a', 'aac']),
+    ('copy', 'hevc_pcm', 'passthrough', ['-c:v', 'copy', '-c:a', 'copy']),
+    ('transcode', 'h264_aac', 'transcode', ['-c:v', 'libx264', '-c:a', 'aac']),
+])
+def test_select_codecs(manager, ffprobe, codec_mode, name, mode, codec_args):
+    input_codecs = probe_input(f'rtsp://camera.local/{name}')
+    assert manager._select_codecs(codec_mode, input_codecs) == (mode, codec_args)
+
+
+def option(cmd, name):
+    return cmd[cmd.index(name) + 1]
+
+
+def test_parse_ladder():
+    assert parse_ladder(' 360:800, 1080:5000,720:2800') == [
+        {'height': 1080, 'bitrate_kbps': 5000},
+        {'height': 720, 'bitrate_kbps': 2800},
+        {'height': 360, 'bitrate_kbps': 800},
+    ]
+    for spec in ('', '720', '720:fast', '720p:2800'):
+        with pytest.raises(ValueError):
+            parse_ladder(spec)
+
+
+@pytest.mark.parametrize('source_height, heights', [
+    (1080, [1080, 720, 360]),
+    (720, [720, 360]),
+    (576, [360]),
+    # Smaller than every rung: the smallest one is kept rather than none
+    (240, [360]),
+    (None, [1080, 720, 360]),
+])
+def test_rungs_above_the_source_are_dropped(manager, monkeypatch, source_height, heights):
+    monkeypatch.setattr(Config, 'STREAM_ABR_LADDER', '1080:5000,720:2800,360:800')
+    input_codecs = {'video': 'h264', 'audio': 'aac', 'height': source_height}
+    assert [rung['height'] for rung in manager._select_ladder(input_codecs)] == heights
+
+
+def test_abr_command(manager, ffprobe):
+    ladder = manager._select_ladder(probe_input('rtsp://camera.local/h264_pcm'))
+    output_path = os.path.join(manager.hls_output_dir, 'cam.m3u8')
+    cmd = manager._build_abr_cmd('cam', 'rtsp://camera.local/h264_pcm', ladder, 'aac', 'standard', output_path)
+
+    assert option(cmd, '-i') == 'rtsp://camera.local/h264_pcm'
+    assert option(cmd, '-filter_complex') == '[0:v]split=2[v0][v1];[v0]scale=-2:720[v0out];[v1]scale=-2:360[v1out]'
+    assert option(cmd, '-b:v:0') == '2800k' and option(cmd, '-b:v:1') == '800k'
+    assert cmd.count('0:a:0') == 2
+    assert option(cmd, '-c:a') == 'aac'
+    assert option(cmd, '-var_stream_map') == 'v:0,a:0 v:1,a:1'
+    assert option(cmd, '-master_pl_name') == 'cam.m3u8'
+    assert option(cmd, '-hls_segment_filename') == os.path.join(manager.hls_output_dir, 'cam_%v_%d.ts')
+    assert cmd[-1] == os.path.join(manager.hls_output_dir, 'cam_%v.m3u8')
+    # Every variant and the master playlist are this source's files
+    pattern = manager._hls_file_pattern({'output_name': 'cam', 'abr': True})
+    for name in ('cam.m3u8', 'cam_0.m3u8', 'cam_1_1700000000.ts'):
+        assert pattern.fullmatch(name)
+
+
+def test_abr_command_without_audio_and_with_fmp4(manager):
+    ladder = parse_ladder('720:2800,360:800,180:300')
+    output_path = os.path.join(manager.hls_output_dir, 'cam.m3u8')
+    cmd = manager._build_abr_cmd('cam', 'rtsp://camera.local/h264_only', ladder, None, 'low', output_path)
+
+    assert option(cmd, '-var_stream_map') == 'v:0 v:1 v:2'
+    assert '0:a:0' not in cmd and '-c:a' not in cmd
+    assert option(cmd, '-master_pl_name') == 'cam.m3u8'
+    assert option(cmd, '-hls_segment_type') == 'fmp4'
+    assert option(cmd, '-hls_fmp4_init_filename') == 'cam_%v_init.mp4'
+    assert option(cmd, '-hls_segment_filename').endswith('cam_%v_%d.m4s')
+
+
+def write_playlist(path, segments):
+    with open(path, 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:1700000000\n')
+        for i in range(segments):
+            f.write(f'#EXTINF:2.0,\ncam{1700000000 + i}.ts\n')
+
+
+def test_first_segment_makes_the_stream_ready(manager, events):
+    manager.start_stream('cam', 'rtsp://camera.local/stream', codec_mode='copy')
+    stream = manager.active_streams['cam']
+    process = subprocess.Popen(['sleep', '60'], start_new_session=True)
+    try:
+        # A playlist left over from an earlier launch doesn't count
+        write_playlist(stream['output_path'], 3)
+        os.utime(stream['output_path'], (1, 1))
+        with manager._lock:
+            stream.update(process=process, requested_at=time.time() - 1.5, started_at=time.time())
+
+        watcher = threading.Thread(target=manager._watch_startup, args=(stream, process))
+        watcher.start()
+        time.sleep(0.3)
+        write_playlist(stream['output_path'], 0)
+        time.sleep(0.3)
+        assert events == []
+        assert stream['state'] == 'starting'
+
+        write_playlist(stream['output_path'], 1)
+        watcher.join(5)
+        assert not watcher.is_alive()
+    finally:
+        process.kill()
+        process.wait()
+
+    assert stream['state'] == 'running'
+    # Counted from the start request, probing included
+    assert 2.0 <= stream['startup_time_s'] < 5
+    assert events == [('stream_ready', {
+        'stream_id': 'cam', 'hls_url': '/hls/cam.m3u8', 'state': 'running', 'restarts': 0,
+        'startup_time_s': stream['startup_time_s'],
+    })]
+
+
+def test_failed_launch_emits_stream_failed(manager, events, monkeypatch):
+    manager.start_stream('cam', 'rtsp://camera.local/stream', codec_mode='copy')
+    manager.start_stream('lobby', 'rtsp://camera.local/stream', codec_mode='copy')
+    def missing_ffmpeg(*args, **kwargs):
+        raise FileNotFoundError('ffmpeg')
+    monkeypatch.setattr(stream_manager.subprocess, 'Popen', missing_ffmpeg)
+
+    stream = manager.active_streams['cam']
+    manager._prepare(stream)
+    assert stream['state'] == 'failed'
+    # One event per stream ID of the source
+    assert [(event, data['stream_id']) for event, data in events] == [('stream_failed', 'cam'), ('stream_failed', 'lobby')]
+    assert events[0][1]['reason'] == 'FFmpeg is not installed. Install it with: sudo apt-get install ffmpeg'
+    assert events[0][1]['state'] == 'failed'
@@ -0,0 +1,145 @@
+"""
+Stream registry: atomic persistence and adopting FFmpeg processes after a restart
+"""
+
+import os
+import subprocess
+import time
+
+import pytest
+
+from config import Config
+from stream_manager import StreamManager
+from stream_registry import AdoptedProcess, StreamRegistry
+
+# Stands in for FFmpeg: a long-running process in its own process group, like a launch
+COMMAND = ['sleep', '30']
+
+
+@pytest.fixture
+def process():
+    process = subprocess.Popen(COMMAND, start_new_session=True)
+    # Until the exec, /proc shows the forked Python process
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        with open(f'/proc/{process.pid}/cmdline', 'rb') as f:
+            if f.read().split(b'\0')[0] != b'sleep':
+                time.sleep(0.01)
+                continue
+        break
+    yield process
+    process.kill()
+    process.wait()
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_ADOPT', True)
+    monkeypatch.setattr(Config, 'STREAM_STATE_DIR', str(tmp_path / 'state'))
+    return tmp_path / 'state'
+
+
+def new_manager(tmp_path, monkeypatch):
+    manager = StreamManager(str(tmp_path / 'hls'))
+    manager.launched = []
+    monkeypatch.setattr(manager, '_begin', manager.launched.append)
+    monkeypatch.setattr(manager, '_launch', manager.launched.append)
+    monkeypatch.setattr(manager.supervisor, 'start', lambda: None)
+    return manager
+
+
+def running_source(manager, process, command=COMMAND):
+    """Register a source as if FFmpeg had been launched with this command and is writing its playlist"""
+    manager.start_stream('cam', 'rtsp://camera.local/cam', codec_mode='copy')
+    with manager._lock:
+        stream = manager.active_streams['cam']
+        stream.update(ffmpeg_cmd=command, process=process, state='running', started_at=time.time())
+        manager._save_registry()
+    with open(stream['watch_path'], 'w') as f:
+        f.write('#EXTM3U\n')
+    return stream
+
+
+def test_save_and_load(tmp_path, state_dir, monkeypatch, process):
+    manager = new_manager(tmp_path, monkeypatch)
+    running_source(manager, process)
+    path = state_dir / 'streams.json'
+    assert os.listdir(state_dir) == ['streams.json']
+
+    entry, = StreamRegistry(str(path)).load()
+    assert entry['pid'] == process.pid
+    assert entry['ffmpeg_cmd'] == COMMAND
+    assert entry['stream_ids'] == {'cam'}
+    assert entry['source_key'] == ('rtsp://camera.local/cam', 'copy', Config.STREAM_LATENCY_PROFILE, False, None)
+    assert entry['state'] == 'running'
+
+
+def test_failed_save_keeps_the_previous_registry(tmp_path, state_dir, monkeypatch, process):
+    manager = new_manager(tmp_path, monkeypatch)
+    stream = running_source(manager, process)
+    registry = StreamRegistry(str(state_dir / 'streams.json'))
+    before = (state_dir / 'streams.json').read_text()
+
+    stream['last_failure'] = {'reason': object()}
+    with pytest.raises(TypeError):
+        registry.save([stream])
+    assert (state_dir / 'streams.json').read_text() == before
+    assert registry.load()[0]['pid'] == process.pid
+
+
+def test_unreadable_registry_is_empty(tmp_path):
+    registry = StreamRegistry(str(tmp_path / 'streams.json'))
+    assert registry.load() == []
+    (tmp_path / 'streams.json').write_text('{"streams": [')
+    assert registry.load() == []
+
+
+def test_find_matches_the_command_line(process):
+    adopted = AdoptedProcess.find(process.pid, COMMAND)
+    assert adopted.pid == process.pid
+    assert adopted.poll() is None
+    # Only the arguments count, the executable may be resolved differently
+    assert AdoptedProcess.find(process.pid, ['/usr/bin/sleep', '30']) is not None
+    # A reused PID runs something else
+    assert AdoptedProcess.find(process.pid, ['sleep', '31']) is None
+    assert AdoptedProcess.find(process.pid, ['ffmpeg', '-i', 'rtsp://camera.local/cam']) is None
+    assert AdoptedProcess.find(None, COMMAND) is None
+
+    process.kill()
+    process.wait()
+    assert adopted.poll() == -1
+    assert AdoptedProcess.find(process.pid, COMMAND) is None
+
+
+def test_adopts_a_running_process(tmp_path, state_dir, monkeypatch, process):
+    running_source(new_manager(tmp_path, monkeypatch), process)
+
+    manager = new_manager(tmp_path, monkeypatch)
+    assert manager.adopt_streams() == {'adopted': 1, 'relaunched': 0, 'requeued': 0}
+    stream = manager.active_streams['cam']
+    assert stream['process'].pid == process.pid
+    assert manager.get_stream_info('cam')['status'] == 'running'
+    assert manager.launched == []
+
+
+def test_other_command_is_relaunched(tmp_path, state_dir, monkeypatch, process):
+    running_source(new_manager(tmp_path, monkeypatch), process, command=['sleep', '31'])
+
+    manager = new_manager(tmp_path, monkeypatch)
+    assert manager.adopt_streams() == {'adopted': 0, 'relaunched': 1, 'requeued': 0}
+    assert manager.launched == [manager.active_streams['cam']]
+    assert manager.active_streams['cam']['process'] is None
+    # Not ours to stop
+    assert process.poll() is None
+
+
+def test_stale_playlist_is_relaunched(tmp_path, state_dir, monkeypatch, process):
+    stream = running_source(new_manager(tmp_path, monkeypatch), process)
+    stale = time.time() - Config.STREAM_STALL_TIMEOUT - 5
+    os.utime(stream['watch_path'], (stale, stale))
+
+    manager = new_manager(tmp_path, monkeypatch)
+    assert manager.adopt_streams() == {'adopted': 0, 'relaunched': 1, 'requeued': 0}
+    assert manager.launched == [manager.active_streams['cam']]
+    # The stalled FFmpeg is stopped before the relaunch
+    assert process.wait(5) is not None
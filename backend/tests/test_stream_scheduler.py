@@ -0,0 +1,149 @@
+"""
+StreamScheduler: /proc sampling, admission against the resource budget, the
+priority queue and rejection
+"""
+
+import io
+import os
+import types
+
+import pytest
+
+import stream_scheduler
+from config import Config
+from stream_manager import StreamManager
+from stream_scheduler import AdmissionRejected, parse_cpu_list, parse_priority_map, read_process_usage
+
+MB = 1024 * 1024
+
+
+class RunningProcess:
+    def __init__(self, pid):
+        self.pid = pid
+
+    def poll(self):
+        return None
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    manager = StreamManager(str(tmp_path / 'hls'))
+    manager.begun = []
+    # Admitted sources are recorded instead of probed and launched
+    monkeypatch.setattr(manager, '_begin', manager.begun.append)
+    monkeypatch.setattr(manager.supervisor, 'start', lambda: None)
+    manager.scheduler.cpu_count = 1
+    return manager
+
+
+@pytest.fixture
+def usage(monkeypatch):
+    """Stubbed /proc: {pid: (CPU seconds, RSS bytes)} and a fake clock for the samples"""
+    usage = types.SimpleNamespace(processes={}, now=1000.0)
+    monkeypatch.setattr(stream_scheduler, 'read_process_usage', lambda pid: usage.processes.get(pid))
+    monkeypatch.setattr(stream_scheduler, 'time', types.SimpleNamespace(time=lambda: usage.now))
+    return usage
+
+
+def start(manager, stream_id, priority=None):
+    return manager.start_stream(stream_id, f'rtsp://camera.local/{stream_id}', codec_mode='copy', priority=priority)
+
+
+def test_budgets_are_opt_in(manager):
+    assert Config.STREAM_CPU_BUDGET == 0
+    assert Config.STREAM_RSS_BUDGET_MB == 0
+    assert Config.STREAM_ADMISSION == 'queue'
+    for number in range(20):
+        assert start(manager, f'cam{number}')['status'] == 'starting'
+    assert len(manager.begun) == 20
+    stats = manager.get_scheduler_stats()
+    assert stats['queue_depth'] == 0
+    assert stats['cpu_budget_percent'] is None
+    assert stats['rss_budget_mb'] is None
+
+
+def test_queue_by_priority_until_measured_usage_leaves_room(manager, usage, monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_CPU_BUDGET', 100)
+    # Two streams at the default estimate of 50% fill the budget
+    assert start(manager, 'a')['status'] == 'starting'
+    assert start(manager, 'b')['status'] == 'starting'
+    low = start(manager, 'c', priority='low')
+    high = start(manager, 'd', priority='high')
+    assert (low['status'], high['status']) == ('queued', 'queued')
+    assert manager.get_stream_info('d')['queue_position'] == 1
+    assert manager.get_stream_info('c')['queue_position'] == 2
+    assert manager.get_scheduler_stats()['queue_depth'] == 2
+
+    for pid, stream_id in ((101, 'a'), (102, 'b')):
+        manager.active_streams[stream_id]['process'] = RunningProcess(pid)
+        usage.processes[pid] = (0.0, 100 * MB)
+    # One sample gives no rate yet, so the streams still count at the estimate
+    manager.schedule()
+    assert [stream['output_name'] for stream in manager.begun] == ['a', 'b']
+    assert manager.active_streams['a']['resources'] == {'cpu_percent': None, 'rss_mb': 100.0}
+
+    # One CPU second each in ten seconds: 10% per stream, and the estimate follows
+    usage.now += 10
+    usage.processes = {101: (1.0, 100 * MB), 102: (1.0, 100 * MB)}
+    manager.schedule()
+    assert [stream['output_name'] for stream in manager.begun] == ['a', 'b', 'd', 'c']
+    assert manager.get_stream_info('c')['status'] == 'starting'
+    stats = manager.get_scheduler_stats()
+    assert stats['queue_depth'] == 0
+    assert stats['cpu_committed_percent'] == pytest.approx(40.0)
+
+
+def test_a_queued_stream_that_is_stopped_leaves_the_queue(manager, monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_RSS_BUDGET_MB', 200)
+    start(manager, 'a')
+    assert start(manager, 'b')['status'] == 'queued'
+    manager.stop_stream('b')
+    assert manager.scheduler.queue == []
+
+
+def test_reject_policy_raises(manager, monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_RSS_BUDGET_MB', 200)
+    monkeypatch.setattr(Config, 'STREAM_ADMISSION', 'reject')
+    start(manager, 'a')
+    with pytest.raises(AdmissionRejected, match='memory 150 of 200 MB'):
+        start(manager, 'b')
+    assert 'b' not in manager.active_streams
+
+
+def test_rejected_stream_is_a_503(client, monkeypatch):
+    # Not even one stream at the 150 MB estimate fits
+    monkeypatch.setattr(Config, 'STREAM_RSS_BUDGET_MB', 100)
+    monkeypatch.setattr(Config, 'STREAM_ADMISSION', 'reject')
+    response = client.post('/api/streams', json={'stream_id': 'cam', 'rtsp_url': 'rtsp://camera.local/cam'})
+    assert response.status_code == 503
+    body = response.get_json()
+    assert 'budget exhausted' in body['error']
+    assert body['scheduler']['rss_budget_mb'] == 100
+
+
+def test_read_process_usage(monkeypatch):
+    files = {
+        # The command name may contain spaces and parentheses
+        '/proc/42/stat': '42 (ffmpeg (cam 1)) S 1 42 42 0 -1 4194304 0 0 0 0 250 50 0 0 20 0 1 0',
+        '/proc/42/statm': '100000 2560 300 0 0 0 0',
+    }
+
+    def fake_open(path):
+        if path not in files:
+            raise FileNotFoundError(path)
+        return io.StringIO(files[path])
+    monkeypatch.setattr(stream_scheduler, 'open', fake_open, raising=False)
+    monkeypatch.setattr(stream_scheduler, 'CLOCK_TICKS', 100)
+    cpu_seconds, rss = read_process_usage(42)
+    assert cpu_seconds == 3.0
+    assert rss == 2560 * os.sysconf('SC_PAGE_SIZE')
+
+    # The process has exited
+    assert read_process_usage(43) is None
+
+
+def test_priority_settings():
+    assert parse_priority_map('high=-5; low=10', int) == {'high': -5, 'low': 10}
+    assert parse_cpu_list('0-3,6') == {0, 1, 2, 3, 6}
+    with pytest.raises(ValueError):
+        parse_priority_map('urgent=1', int)
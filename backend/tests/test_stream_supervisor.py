@@ -0,0 +1,208 @@
+"""
+StreamSupervisor: restart backoff with jitter, the restart cap and isolated loop steps
+"""
+
+import threading
+import time
+import types
+
+import pytest
+
+import stream_supervisor
+from config import Config
+from stream_supervisor import StreamSupervisor
+
+
+class ExitedProcess:
+    def __init__(self, code=1):
+        self.code = code
+
+    def poll(self):
+        return self.code
+
+
+class FakeManager:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.active_streams = {}
+        self.launch_result = True
+        self.launched = []
+        self.terminated = []
+        self.retired = []
+        self.notified = []
+
+    def _launch(self, stream):
+        if isinstance(self.launch_result, Exception):
+            raise self.launch_result
+        self.launched.append(stream['output_name'])
+        if self.launch_result:
+            stream['state'] = 'starting'
+            stream['process'] = None
+            stream['started_at'] = time.time()
+        return self.launch_result
+
+    def _terminate(self, stream_id, process):
+        self.terminated.append(stream_id)
+
+    def _retire_source(self, stream):
+        self.retired.append(stream['output_name'])
+
+    def _save_registry(self):
+        pass
+
+    def _notify(self, event, stream):
+        self.notified.append((event, stream['output_name']))
+
+    def schedule(self):
+        pass
+
+    def sync_shared(self):
+        pass
+
+
+def make_stream(name='cam', process=None):
+    return {
+        'output_name': name, 'state': 'running', 'process': process, 'telemetry': None,
+        'watch_path': '/nonexistent', 'started_at': time.time(), 'next_restart_at': None,
+        'restarts': 0, 'consecutive_failures': 0, 'last_failure': None,
+    }
+
+
+@pytest.fixture(autouse=True)
+def backoff(monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_RESTART_BACKOFF', 2)
+    monkeypatch.setattr(Config, 'STREAM_RESTART_BACKOFF_MAX', 60)
+    monkeypatch.setattr(Config, 'STREAM_MAX_RESTARTS', 3)
+
+
+@pytest.fixture
+def manager():
+    return FakeManager()
+
+
+@pytest.fixture
+def supervisor(manager):
+    return StreamSupervisor(manager)
+
+
+def test_backoff_doubles_with_jitter_up_to_the_cap(supervisor, monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_MAX_RESTARTS', 100)
+    stream = make_stream()
+    delays = []
+    for _ in range(8):
+        supervisor._record_failure('cam', stream, 'boom', 1000.0)
+        delays.append(stream['next_restart_at'] - 1000.0)
+    for failures, delay in enumerate(delays, start=1):
+        backoff = min(2 * 2 ** (failures - 1), 60)
+        assert 0.8 * backoff <= delay <= 1.2 * backoff
+    assert stream['state'] == 'restarting'
+    assert stream['restarts'] == 8
+
+    # Streams failing together don't restart together
+    first_delays = set()
+    for i in range(20):
+        other = make_stream(f'cam{i}')
+        supervisor._record_failure(f'cam{i}', other, 'link down', 1000.0)
+        first_delays.add(other['next_restart_at'])
+    assert len(first_delays) > 1
+
+
+def test_gives_up_after_max_restarts(supervisor, manager):
+    stream = make_stream()
+    for _ in range(3):
+        supervisor._record_failure('cam', stream, 'boom', 1000.0)
+        assert stream['state'] == 'restarting'
+    supervisor._record_failure('cam', stream, 'boom', 1000.0)
+    assert stream['state'] == 'failed'
+    assert stream['last_failure'] == {'reason': 'boom', 'at': 1000.0}
+    assert manager.retired == ['cam']
+
+
+def test_exited_process_is_restarted_after_backoff(supervisor, manager):
+    stream = make_stream(process=ExitedProcess(1))
+    manager.active_streams = {'cam': stream}
+
+    supervisor._check_stream('cam', time.time())
+    assert manager.terminated == ['cam']
+    assert stream['state'] == 'restarting'
+    assert stream['last_failure']['reason'] == 'FFmpeg exited with code 1'
+    assert manager.notified == [('stream_failed', 'cam')]
+
+    # Not before the backoff has passed
+    supervisor._check_stream('cam', stream['next_restart_at'] - 0.1)
+    assert manager.launched == []
+    supervisor._check_stream('cam', stream['next_restart_at'])
+    assert manager.launched == ['cam']
+    assert stream['state'] == 'starting'
+
+
+@pytest.mark.parametrize('result, reason', [
+    (False, 'Restart failed: FFmpeg was not launched'),
+    (Exception('FFmpeg is not installed'), 'Restart failed: FFmpeg is not installed'),
+])
+def test_restart_that_does_not_launch_backs_off(supervisor, manager, result, reason):
+    stream = make_stream()
+    stream.update(state='restarting', next_restart_at=0, consecutive_failures=1, restarts=1)
+    manager.active_streams = {'cam': stream}
+    manager.launch_result = result
+
+    supervisor._check_stream('cam', 1000.0)
+    assert stream['state'] == 'restarting'
+    assert stream['consecutive_failures'] == 2
+    assert stream['last_failure'] == {'reason': reason, 'at': 1000.0}
+    assert 1000.0 + 0.8 * 4 <= stream['next_restart_at'] <= 1000.0 + 1.2 * 4
+    assert manager.notified == [('stream_failed', 'cam')]
+
+
+def test_restart_of_a_stopped_stream_is_dropped(supervisor, manager):
+    stream = make_stream()
+    stream.update(state='restarting', next_restart_at=0)
+    manager.active_streams = {'cam': stream}
+    def launch(stream):
+        # Stopped while the supervisor was about to restart it
+        manager.active_streams.clear()
+        return False
+    manager._launch = launch
+
+    supervisor._check_stream('cam', 1000.0)
+    assert stream['consecutive_failures'] == 0
+    assert manager.notified == []
+
+
+def test_one_failing_stream_does_not_stop_the_others(supervisor, manager, monkeypatch):
+    broken, healthy = make_stream('broken'), make_stream('healthy', process=ExitedProcess(0))
+    broken['process'] = types.SimpleNamespace(poll=lambda: 1 / 0)
+    manager.active_streams = {'broken': broken, 'healthy': healthy}
+
+    supervisor.check_streams()
+    assert healthy['state'] == 'restarting'
+    assert broken['state'] == 'running'
+
+
+class StopLoop(BaseException):
+    pass
+
+
+def test_failing_loop_steps_do_not_skip_the_others(supervisor, manager, monkeypatch):
+    calls = []
+    def failing_schedule():
+        calls.append('schedule')
+        raise RuntimeError('scheduler broke')
+    def failing_check():
+        calls.append('check_streams')
+        raise RuntimeError('check broke')
+    manager.schedule = failing_schedule
+    manager.sync_shared = lambda: calls.append('sync_shared')
+    monkeypatch.setattr(supervisor, 'check_streams', failing_check)
+
+    sleeps = []
+    def sleep(seconds):
+        if len(sleeps) == 2:
+            raise StopLoop()
+        sleeps.append(seconds)
+    monkeypatch.setattr(stream_supervisor, 'time', types.SimpleNamespace(sleep=sleep, time=time.time))
+
+    with pytest.raises(StopLoop):
+        supervisor._run()
+    # The heartbeat (sync_shared) still runs every round
+    assert calls == ['check_streams', 'schedule', 'sync_shared'] * 2
@@ -0,0 +1,114 @@
+"""
+StreamTelemetry: parsing FFmpeg's -progress output and keeping the log tail
+"""
+
+import io
+
+from stream_telemetry import StreamTelemetry
+
+# Two -progress blocks as FFmpeg writes them; the snapshot reflects the last complete one
+PROGRESS = b"""frame=120
+fps=25.00
+stream_0_0_q=23.0
+bitrate=N/A
+total_size=N/A
+out_time_us=4800000
+out_time_ms=4800000
+out_time=00:00:04.800000
+dup_frames=0
+drop_frames=0
+speed=N/A
+progress=continue
+frame=250
+fps=24.97
+stream_0_0_q=23.0
+bitrate=1843.2kbits/s
+total_size=2304000
+out_time_us=10000000
+out_time_ms=10000000
+out_time=00:00:10.000000
+dup_frames=3
+drop_frames=1
+speed=0.998x
+progress=continue
+frame=260
+fps=2"""
+
+LOG = b"""Input #0, rtsp, from 'rtsp://camera.local/stream':
+  Duration: N/A, start: 0.000000, bitrate: N/A
+[hls @ 0x55d] Opening 'hls/cam1700000000.ts' for writing
+
+"""
+
+
+class FinishedProcess:
+    def __init__(self, stdout=b'', stderr=b''):
+        self.stdout = io.BytesIO(stdout)
+        self.stderr = io.BytesIO(stderr)
+
+    def poll(self):
+        return 0
+
+
+def test_snapshot_before_any_progress():
+    snapshot = StreamTelemetry('cam', FinishedProcess()).snapshot()
+    assert snapshot['fps'] is None
+    assert snapshot['falling_behind'] is False
+    assert snapshot['last_update_age_s'] is None
+
+
+def test_progress_blocks_from_the_pipe():
+    telemetry = StreamTelemetry('cam', FinishedProcess(stdout=PROGRESS))
+    telemetry._read_progress()
+    snapshot = telemetry.snapshot()
+    assert snapshot == {
+        'frame': 250,
+        'fps': 24.97,
+        'bitrate_kbps': 1843.2,
+        'speed': 0.998,
+        'out_time_s': 10.0,
+        'dropped_frames': 1,
+        'duplicated_frames': 3,
+        'falling_behind': False,
+        'last_update_age_s': snapshot['last_update_age_s'],
+    }
+    assert 0 <= snapshot['last_update_age_s'] < 5
+
+
+def test_slow_encoding_is_falling_behind():
+    telemetry = StreamTelemetry('cam', FinishedProcess(stdout=b'fps=12\nspeed=0.5x\nprogress=continue\n'))
+    telemetry._read_progress()
+    snapshot = telemetry.snapshot()
+    assert snapshot['speed'] == 0.5
+    assert snapshot['falling_behind'] is True
+    # Missing keys stay unknown
+    assert snapshot['bitrate_kbps'] is None
+    assert snapshot['out_time_s'] is None
+
+
+def test_progress_and_log_from_files(tmp_path):
+    progress_path, log_path = tmp_path / 'cam.progress', tmp_path / 'cam.log'
+    progress_path.write_bytes(PROGRESS)
+    log_path.write_bytes(LOG)
+    telemetry = StreamTelemetry(
+        'cam', FinishedProcess(), log_lines=2, progress_path=str(progress_path), log_path=str(log_path)
+    )
+    telemetry._read_progress()
+    telemetry._read_log()
+
+    assert telemetry.snapshot()['out_time_s'] == 10.0
+    # Blank lines are dropped and only log_lines are kept
+    assert telemetry.recent_log() == [
+        '  Duration: N/A, start: 0.000000, bitrate: N/A',
+        "[hls @ 0x55d] Opening 'hls/cam1700000000.ts' for writing",
+    ]
+    assert telemetry.recent_log(1) == ["[hls @ 0x55d] Opening 'hls/cam1700000000.ts' for writing"]
+
+
+def test_reader_threads_drain_both_pipes():
+    telemetry = StreamTelemetry('cam', FinishedProcess(stdout=PROGRESS, stderr=LOG)).start()
+    for thread in telemetry._threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert telemetry.snapshot()['fps'] == 24.97
+    assert len(telemetry.recent_log()) == 3
@@ -2,6 +2,7 @@
 
 import type React from "react"
 import { useState, useEffect } from "react"
+import { io } from "socket.io-client"
 import { Stamp as Stop, Plus, AlertCircle, Info, RefreshCw } from "lucide-react"
 import { startStream, stopStream, listStreams, checkHealth, type Stream } from "@/lib/api"
 
@@ -24,6 +25,30 @@ export default function RTSPStreamManager() {
     loadStreams()
   }, [])
 
+  // Streams start in the background; the backend announces when playback can begin
+  useEffect(() => {
+    const socket = io(API_URL)
+
+    socket.on("stream_ready", (data: { stream_id: string; startup_time_s: number | null }) => {
+      setStreams((current) =>
+        current.map((s) =>
+          s.stream_id === data.stream_id ? { ...s, status: "running", startup_time_s: data.startup_time_s } : s,
+        ),
+      )
+    })
+
+    socket.on("stream_failed", (data: { stream_id: string; state: "restarting" | "failed"; reason: string | null }) => {
+      setStreams((current) => current.map((s) => (s.stream_id === data.stream_id ? { ...s, status: data.state } : s)))
+      if (data.state === "failed") {
+        setError(`Stream ${data.stream_id} failed: ${data.reason}`)
+      }
+    })
+
+    return () => {
+      socket.disconnect()
+    }
+  }, [])
+
   const checkBackendConnection = async () => {
     const isConnected = await checkHealth()
     setBackendConnected(isConnected)
@@ -215,7 +240,7 @@ export default function RTSPStreamManager() {
                   <p className="text-xs text-slate-400 truncate">{stream.rtsp_url}</p>
                 </div>
                 <div className="flex items-center gap-1">
-                  <div className={`w-2 h-2 rounded-full ${stream.status === 'running' ? 'bg-green-500' : 'bg-red-500'}`}></div>
+                  <div className={`w-2 h-2 rounded-full ${stream.status === 'running' ? 'bg-green-500' : stream.status === 'starting' || stream.status === 'restarting' ? 'bg-amber-500' : 'bg-red-500'}`}></div>
                   <span className="text-xs text-slate-400">{stream.status}</span>
                 </div>
               </div>
@@ -229,7 +254,8 @@ export default function RTSPStreamManager() {
                   onClick={() => {
                     navigator.clipboard.writeText(`${API_URL}${stream.hls_url}`)
                   }}
-                  className="flex-1 px-3 py-1 bg-slate-800 hover:bg-slate-700 text-white text-xs font-medium rounded transition-colors"
+                  disabled={stream.status !== 'running'}
+                  className="flex-1 px-3 py-1 bg-slate-800 hover:bg-slate-700 text-white text-xs font-medium rounded transition-colors disabled:opacity-50"
                 >
                   Copy HLS URL
                 </button>
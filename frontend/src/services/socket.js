@@ -75,32 +75,59 @@ class SocketService {
   onOverlayCreated(callback) {
     if (this.socket) {
       this.socket.on('overlay_created', callback);
+      this._onOverlaysBulk('created', callback);
     }
   }
 
+  // Bulk updates carry only the changed fields
   onOverlayUpdated(callback) {
     if (this.socket) {
       this.socket.on('overlay_updated', callback);
+      this._onOverlaysBulk('updated', ({ id, ...fields }) => callback({ _id: id, ...fields }));
     }
   }
 
   onOverlayDeleted(callback) {
     if (this.socket) {
       this.socket.on('overlay_deleted', callback);
+      this._onOverlaysBulk('deleted', callback);
     }
   }
 
   onOverlayMoved(callback) {
     if (this.socket) {
       this.socket.on('overlay_moved', callback);
+      this._onOverlayBatch('position', callback);
     }
   }
 
   onOverlayResized(callback) {
     if (this.socket) {
       this.socket.on('overlay_resized', callback);
+      this._onOverlayBatch('size', callback);
     }
   }
+
+  // Bulk REST requests send one 'overlays_bulk' event per stream instead of one per overlay
+  _onOverlaysBulk(action, callback) {
+    this.socket.on('overlays_bulk', (data) => {
+      if (data.action === action) {
+        data.overlays.forEach((overlay) => callback(overlay));
+      }
+    });
+  }
+
+  // Server coalesces live moves/resizes into one 'overlay_batch' frame per tick
+  _onOverlayBatch(field, callback) {
+    this.socket.on('overlay_batch', (data) => {
+      data.overlays.forEach((change) => {
+        if (change.origin && change.origin === this.socket.id) return;
+        if (change[field]) {
+          callback({ id: change.id, [field]: change[field] });
+        }
+      });
+    });
+  }
 }
 
 export default new SocketService();
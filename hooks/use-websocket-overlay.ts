@@ -9,17 +9,22 @@ interface Overlay {
   content: string
   position: { x: number; y: number }
   size: { width: number; height: number }
+  stream_id?: string
 }
 
 interface UseWebSocketOverlayProps {
+  /** Stream whose overlay events this client receives (server default when omitted) */
+  streamId?: string
   onOverlayCreated: (overlay: Overlay) => void
-  onOverlayUpdated: (id: string, overlay: Overlay) => void
+  /** Receives the whole overlay, or only the changed fields for bulk updates */
+  onOverlayUpdated: (id: string, overlay: Partial<Overlay>) => void
   onOverlayDeleted: (id: string) => void
   onOverlayMoved: (id: string, position: { x: number; y: number }) => void
   onOverlayResized: (id: string, size: { width: number; height: number }) => void
 }
 
 export function useWebSocketOverlay({
+  streamId,
   onOverlayCreated,
   onOverlayUpdated,
   onOverlayDeleted,
@@ -36,6 +41,7 @@ export function useWebSocketOverlay({
       reconnectionDelay: 1000,
       reconnectionDelayMax: 5000,
       reconnectionAttempts: 5,
+      auth: streamId ? { stream_id: streamId } : {},
     })
 
     socketRef.current = socket
@@ -75,6 +81,46 @@ export function useWebSocketOverlay({
       onOverlayResized(data.id, data.size)
     })
 
+    // Server coalesces live moves/resizes into one frame per tick
+    socket.on(
+      "overlay_batch",
+      (data: {
+        seq: number
+        overlays: {
+          id: string
+          origin?: string
+          position?: { x: number; y: number }
+          size?: { width: number; height: number }
+        }[]
+      }) => {
+        for (const change of data.overlays) {
+          if (change.origin && change.origin === socket.id) continue
+          if (change.position) onOverlayMoved(change.id, change.position)
+          if (change.size) onOverlayResized(change.id, change.size)
+        }
+      },
+    )
+
+    // Bulk REST requests send one event per stream instead of one per overlay
+    socket.on(
+      "overlays_bulk",
+      (data: {
+        action: "created" | "updated" | "deleted"
+        overlays: (Overlay | ({ id: string } & Partial<Overlay>))[]
+      }) => {
+        console.log(`[v0] ${data.overlays.length} overlays ${data.action} via WebSocket`)
+        for (const item of data.overlays) {
+          if (data.action === "created") {
+            onOverlayCreated(item as Overlay)
+          } else {
+            const { id, ...fields } = item as { id: string } & Partial<Overlay>
+            if (data.action === "updated") onOverlayUpdated(id, fields)
+            else onOverlayDeleted(id)
+          }
+        }
+      },
+    )
+
     socket.on("connection_response", (data) => {
       console.log("[v0] Connection response:", data)
     })
@@ -82,7 +128,7 @@ export function useWebSocketOverlay({
     return () => {
       socket.disconnect()
     }
-  }, [onOverlayCreated, onOverlayUpdated, onOverlayDeleted, onOverlayMoved, onOverlayResized])
+  }, [streamId, onOverlayCreated, onOverlayUpdated, onOverlayDeleted, onOverlayMoved, onOverlayResized])
 
   // Emit events to other clients
   const emitOverlayCreated = useCallback((overlay: Overlay) => {
@@ -8,8 +8,9 @@ export interface Stream {
   stream_id: string
   rtsp_url: string
   hls_url: string
-  status: 'running' | 'stopped'
-  pid: number
+  status: 'starting' | 'running' | 'restarting' | 'failed' | 'stopped'
+  pid: number | null
+  startup_time_s?: number | null
 }
 
 export interface StartStreamRequest {